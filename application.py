@@ -8,9 +8,11 @@
 
 import atexit
 from flask import Flask, flash, redirect, render_template, request, session, url_for, jsonify, send_from_directory, Response, stream_with_context
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timezone, timedelta
 from sqlalchemy.sql.expression import or_ as OR, and_ as AND
+from sqlalchemy.orm import selectinload, joinedload
 from flask_login import login_required, fresh_login_required, login_user, logout_user, current_user
 from re import match
 from flask_mail import Mail, Message
@@ -20,13 +22,23 @@ from flask_migrate import Migrate
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from flask_wtf import Form
-from wtforms_sqlalchemy.orm import model_form, model_fields
+from wtforms_sqlalchemy.orm import model_form
 from os.path import join, exists
-from os import makedirs
+from os import makedirs, environ
 from werkzeug.utils import secure_filename
 from time import strftime
 from database_models import *
 from helpers import *
+from grant_status import *
+from organization_standing import *
+from cuts import *
+from grant_export import *
+from change_feed import *
+from project_search import *
+from organization_index import organization_index
+from page_cache import page_cache, cached_page
+from http_caching import http_caching, conditional_grant_page
+from request_metrics import request_metrics
 
 # create Flask server
 app = Flask(__name__)
@@ -36,6 +48,8 @@ migrate = Migrate(app, db)
 app.config['UPLOAD_FOLDER'] = join(app.instance_path, "uploads")
 if not exists(app.config['UPLOAD_FOLDER']):
     makedirs(app.config['UPLOAD_FOLDER'])
+# Seconds browsers may reuse an uploaded PDF before revalidating it
+upload_max_age = 3600
 
 # ensure responses aren't cached
 if app.config["DEBUG"]:
@@ -45,8 +59,10 @@ if app.config["DEBUG"]:
         response.headers["Expires"] = 0
         response.headers["Pragma"] = "no-cache"
         return response
-else:
+elif not environ.get('NOVA_DISABLE_SCHEDULER'):
     # Send owed money emails every 14 days if not debug
+    # (scripts which import this module, like the email dispatcher and benchmark, set
+    # NOVA_DISABLE_SCHEDULER so that they do not run these jobs too)
     scheduler = BackgroundScheduler()
     scheduler.start()
     scheduler.add_job(
@@ -79,9 +95,22 @@ app.jinja_env.filters["swap_quotes"] = swap_quotes
 install_secret_key(app)
 
 # setup database connection
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+# (benchmark.py points NOVA_DATABASE_URI at a scratch database)
+app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('NOVA_DATABASE_URI', 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Wait for the SQLite write lock during submission bursts rather than failing
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
 db.init_app(app)
+# Work out the status of each grant being saved, and then (from the statuses) the change
+# in its organization's standing. Registered here so that they run in this order
+event.listen(db.session, 'before_flush', update_grant_status)
+event.listen(db.session, 'before_flush', update_organization_standing)
+# Record per-endpoint timings for /metrics (set PROFILE_SAMPLE_RATE to also profile requests),
+# and count each request's SQL statements for query_budget
+app.config.setdefault('ENFORCE_QUERY_BUDGETS', False)
+request_metrics.init_app(app)
+# Send validators with read-only pages and files, and link static files by content hash
+http_caching.init_app(app)
 
 # Enable authentication
 login_manager = LoginManager()
@@ -202,7 +231,7 @@ def new_grant():
     # get arguments from query string
     args = get_grant_args(request.query_string)
     # Verify security key
-    sec_key = Config.query.filter_by(key='security_key').first().value
+    sec_key = config_cache.get('security_key')
     if not args.get('k') or sec_key != args.get('k')[0]:
         return "Invalid Security Key. You do not have access to this system."
 
@@ -212,14 +241,10 @@ def new_grant():
         return redirect(url_for('non_nova_application_submit'))
 
     # Get Next Grant ID
-    council_semester = Config.query.filter_by(key='council_semester').first()
-    current_week = Config.query.filter_by(key='grant_week').first()
-    grant_prefix = council_semester.value + '-' + current_week.value
-    grant_number = Grants_Week.query.filter_by(grant_week=grant_prefix).first()
-    # This is not atomic, which seems like a potential problem...
-    grant_number.num_grants += 1
-    db.session.commit()
-    grant_id = grant_prefix + "-" + str(grant_number.num_grants)
+    grant_prefix = config_cache.get('council_semester') + '-' + config_cache.get('grant_week')
+    grant_id = next_grant_id(grant_prefix)
+    if not grant_id:
+        return "Error: Grants week " + grant_prefix + " does not exist"
 
     # Create New Grant
     grant = Grant(grant_id)
@@ -248,99 +273,41 @@ def new_grant():
     if args.get('project_end'): grant.project_end = eastern.localize(datetime.strptime(args.get('project_end')[0], '%m/%d/%Y')).astimezone(utc)
     if args.get('college_attendees'): grant.college_attendees = int(args.get('college_attendees')[0])
     if args.get('facebook_link'): grant.facebook_link = args.get('facebook_link')[0]
-    if args.get('revenue1_type'): grant.revenue1_type = args.get('revenue1_type')[0]
-    if args.get('revenue1_description'): grant.revenue1_description = args.get('revenue1_description')[0]
-    if args.get('revenue1_amount'): grant.revenue1_amount = float(args.get('revenue1_amount')[0])
-    if args.get('revenue2_type'): grant.revenue2_type = args.get('revenue2_type')[0]
-    if args.get('revenue2_description'): grant.revenue2_description = args.get('revenue2_description')[0]
-    if args.get('revenue2_amount'): grant.revenue2_amount = float(args.get('revenue2_amount')[0])
-    if args.get('revenue3_type'): grant.revenue3_type = args.get('revenue3_type')[0]
-    if args.get('revenue3_description'): grant.revenue3_description = args.get('revenue3_description')[0]
-    if args.get('revenue3_amount'): grant.revenue3_amount = float(args.get('revenue3_amount')[0])
-    if args.get('revenue4_type'): grant.revenue4_type = args.get('revenue4_type')[0]
-    if args.get('revenue4_description'): grant.revenue4_description = args.get('revenue4_description')[0]
-    if args.get('revenue4_amount'): grant.revenue4_amount = float(args.get('revenue4_amount')[0])
-    if args.get('revenue5_type'): grant.revenue5_type = args.get('revenue5_type')[0]
-    if args.get('revenue5_description'): grant.revenue5_description = args.get('revenue5_description')[0]
-    if args.get('revenue5_amount'): grant.revenue5_amount = float(args.get('revenue5_amount')[0])
-    if args.get('revenue6_type'): grant.revenue6_type = args.get('revenue6_type')[0]
-    if args.get('revenue6_description'): grant.revenue6_description = args.get('revenue6_description')[0]
-    if args.get('revenue6_amount'): grant.revenue6_amount = float(args.get('revenue6_amount')[0])
-    if args.get('revenue7_type'): grant.revenue7_type = args.get('revenue7_type')[0]
-    if args.get('revenue7_description'): grant.revenue7_description = args.get('revenue7_description')[0]
-    if args.get('revenue7_amount'): grant.revenue7_amount = float(args.get('revenue7_amount')[0])
-    if args.get('revenue8_type'): grant.revenue8_type = args.get('revenue8_type')[0]
-    if args.get('revenue8_description'): grant.revenue8_description = args.get('revenue8_description')[0]
-    if args.get('revenue8_amount'): grant.revenue8_amount = float(args.get('revenue8_amount')[0])
-    if args.get('revenue9_type'): grant.revenue9_type = args.get('revenue9_type')[0]
-    if args.get('revenue9_amount'): grant.revenue9_amount = float(args.get('revenue9_amount')[0])
-    if args.get('revenue10_type'): grant.revenue10_type = args.get('revenue10_type')[0]
-    if args.get('revenue10_description'): grant.revenue10_description = args.get('revenue10_description')[0]
-    if args.get('revenue10_amount'): grant.revenue10_amount = float(args.get('revenue10_amount')[0])
-    if args.get('app_expense1_type'): grant.app_expense1_type = args.get('app_expense1_type')[0]
-    if args.get('app_expense1_description'): grant.app_expense1_description = args.get('app_expense1_description')[0]
-    if args.get('app_expense1_amount'): grant.app_expense1_amount = float(args.get('app_expense1_amount')[0])
-    if args.get('app_expense2_type'): grant.app_expense2_type = args.get('app_expense2_type')[0]
-    if args.get('app_expense2_description'): grant.app_expense2_description = args.get('app_expense2_description')[0]
-    if args.get('app_expense2_amount'): grant.app_expense2_amount = float(args.get('app_expense2_amount')[0])
-    if args.get('app_expense3_type'): grant.app_expense3_type = args.get('app_expense3_type')[0]
-    if args.get('app_expense3_description'): grant.app_expense3_description = args.get('app_expense3_description')[0]
-    if args.get('app_expense3_amount'): grant.app_expense3_amount = float(args.get('app_expense3_amount')[0])
-    if args.get('app_expense4_type'): grant.app_expense4_type = args.get('app_expense4_type')[0]
-    if args.get('app_expense4_description'): grant.app_expense4_description = args.get('app_expense4_description')[0]
-    if args.get('app_expense4_amount'): grant.app_expense4_amount = float(args.get('app_expense4_amount')[0])
-    if args.get('app_expense5_type'): grant.app_expense5_type = args.get('app_expense5_type')[0]
-    if args.get('app_expense5_description'): grant.app_expense5_description = args.get('app_expense5_description')[0]
-    if args.get('app_expense5_amount'): grant.app_expense5_amount = float(args.get('app_expense5_amount')[0])
-    if args.get('app_expense6_type'): grant.app_expense6_type = args.get('app_expense6_type')[0]
-    if args.get('app_expense6_description'): grant.app_expense6_description = args.get('app_expense6_description')[0]
-    if args.get('app_expense6_amount'): grant.app_expense6_amount = float(args.get('app_expense6_amount')[0])
-    if args.get('app_expense7_type'): grant.app_expense7_type = args.get('app_expense7_type')[0]
-    if args.get('app_expense7_description'): grant.app_expense7_description = args.get('app_expense7_description')[0]
-    if args.get('app_expense7_amount'): grant.app_expense7_amount = float(args.get('app_expense7_amount')[0])
-    if args.get('app_expense8_type'): grant.app_expense8_type = args.get('app_expense8_type')[0]
-    if args.get('app_expense8_description'): grant.app_expense8_description = args.get('app_expense8_description')[0]
-    if args.get('app_expense8_amount'): grant.app_expense8_amount = float(args.get('app_expense8_amount')[0])
-    if args.get('app_expense9_type'): grant.app_expense9_type = args.get('app_expense9_type')[0]
-    if args.get('app_expense9_description'): grant.app_expense9_description = args.get('app_expense9_description')[0]
-    if args.get('app_expense9_amount'): grant.app_expense9_amount = float(args.get('app_expense9_amount')[0])
-    if args.get('app_expense10_type'): grant.app_expense10_type = args.get('app_expense10_type')[0]
-    if args.get('app_expense10_description'): grant.app_expense10_description = args.get('app_expense10_description')[0]
-    if args.get('app_expense10_amount'): grant.app_expense10_amount = float(args.get('app_expense10_amount')[0])
-    if args.get('app_expense11_type'): grant.app_expense11_type = args.get('app_expense11_type')[0]
-    if args.get('app_expense11_description'): grant.app_expense11_description = args.get('app_expense11_description')[0]
-    if args.get('app_expense11_amount'): grant.app_expense11_amount = float(args.get('app_expense11_amount')[0])
-    if args.get('app_expense12_type'): grant.app_expense12_type = args.get('app_expense12_type')[0]
-    if args.get('app_expense12_description'): grant.app_expense12_description = args.get('app_expense12_description')[0]
-    if args.get('app_expense12_amount'): grant.app_expense12_amount = float(args.get('app_expense12_amount')[0])
     if args.get('application_comments'): grant.application_comments = args.get('application_comments')[0]
+    grant.revenues = get_line_items(args, 'revenue', GrantRevenue)
+    grant.app_expenses = get_line_items(args, 'app_expense', GrantApplicationExpense)
 
     # Determine if Small Grant
     # (small_grant_cap and small_grant_expense_types defined in databse_models.py for convenience)
     if nfloat(grant.amount_requested) and nfloat(grant.amount_requested) < small_grant_cap:
         # Parse small grant candidate to rule out grants that are applying for inelligible categories
-        expenses = [grant.app_expense1_type,grant.app_expense2_type,grant.app_expense3_type,grant.app_expense4_type,grant.app_expense5_type,grant.app_expense6_type,grant.app_expense7_type,grant.app_expense8_type,grant.app_expense9_type,grant.app_expense10_type,grant.app_expense11_type,grant.app_expense12_type]
         grant.is_small_grant = True
-        for expense in expenses:
-            if expense and expense not in small_grant_expense_types:
+        for expense in grant.app_expenses:
+            if expense.type and expense.type not in small_grant_expense_types:
                 grant.is_small_grant = False
 
-    # If the organization does not yet exist in our Organizations Database, add the organization
-    if grant.organization:
-        org = Organization.query.filter_by(name=grant.organization).first()
-        if org == None:
-            org = Organization(grant.organization)
-            db.session.add(org)
-
-    # Commit New Grant to Database
+    # Commit New Grant to Database, along with its confirmation email
     try:
         db.session.add(grant)
+        send_templated_email('application_submitted', grant)
         db.session.commit()
     except IntegrityError:
+        db.session.rollback()
         return "Error: Grant already exists"
 
-    # Send Confirmation Email
-    email_application_submitted(grant)
+    # If the organization does not yet exist in our Organizations Database, add the organization
+    # (in its own transaction, so that a simultaneous submission from the same new organization
+    # cannot cause this application to be lost)
+    if grant.organization:
+        org = Organization.query.filter_by(name=grant.organization).first()
+        if org == None:
+            try:
+                db.session.add(Organization(grant.organization))
+                db.session.commit()
+                organization_index.invalidate()
+            except IntegrityError:
+                # Another submission added the organization first
+                db.session.rollback()
 
     return redirect(url_for('application_submitted', grant_id=grant_id))
 
@@ -374,12 +341,8 @@ def receipts(overwrite = False):
 
     if overwrite:
         # Zero out all previous values if overwriting a receipts record
-        grant.expense1_description=grant.expense1_amount=grant.expense2_description=grant.expense2_amount=grant.expense3_description=\
-        grant.expense3_amount=grant.expense4_description=grant.expense4_amount=grant.expense5_description=grant.expense5_amount=\
-        grant.expense6_description=grant.expense6_amount=grant.expense7_description=grant.expense7_amount=grant.expense8_description=\
-        grant.expense8_amount=grant.expense9_description=grant.expense9_amount=grant.expense10_description=grant.expense10_amount=\
-        grant.expense11_description=grant.expense11_amount=grant.expense12_description=grant.expense12_amount=grant.completed_proj_comments\
-        = None
+        grant.receipt_lines = []
+        grant.completed_proj_comments = None
 
         # update receipt resubmission history
         if grant.receipts_resubmit_history:
@@ -401,30 +364,7 @@ def receipts(overwrite = False):
         grant.receipt_images = receipts
 
     # Add Other Grant Values from Parsed Query String
-    if args.get('expense1_description'): grant.expense1_description = args.get('expense1_description')[0]
-    if args.get('expense1_amount'): grant.expense1_amount = float(args.get('expense1_amount')[0])
-    if args.get('expense2_description'): grant.expense2_description = args.get('expense2_description')[0]
-    if args.get('expense2_amount'): grant.expense2_amount = float(args.get('expense2_amount')[0])
-    if args.get('expense3_description'): grant.expense3_description = args.get('expense3_description')[0]
-    if args.get('expense3_amount'): grant.expense3_amount = float(args.get('expense3_amount')[0])
-    if args.get('expense4_description'): grant.expense4_description = args.get('expense4_description')[0]
-    if args.get('expense4_amount'): grant.expense4_amount = float(args.get('expense4_amount')[0])
-    if args.get('expense5_description'): grant.expense5_description = args.get('expense5_description')[0]
-    if args.get('expense5_amount'): grant.expense5_amount = float(args.get('expense5_amount')[0])
-    if args.get('expense6_description'): grant.expense6_description = args.get('expense6_description')[0]
-    if args.get('expense6_amount'): grant.expense6_amount = float(args.get('expense6_amount')[0])
-    if args.get('expense7_description'): grant.expense7_description = args.get('expense7_description')[0]
-    if args.get('expense7_amount'): grant.expense7_amount = float(args.get('expense7_amount')[0])
-    if args.get('expense8_description'): grant.expense8_description = args.get('expense8_description')[0]
-    if args.get('expense8_amount'): grant.expense8_amount = float(args.get('expense8_amount')[0])
-    if args.get('expense9_description'): grant.expense9_description = args.get('expense9_description')[0]
-    if args.get('expense9_amount'): grant.expense9_amount = float(args.get('expense9_amount')[0])
-    if args.get('expense10_description'): grant.expense10_description = args.get('expense10_description')[0]
-    if args.get('expense10_amount'): grant.expense10_amount = float(args.get('expense10_amount')[0])
-    if args.get('expense11_description'): grant.expense11_description = args.get('expense11_description')[0]
-    if args.get('expense11_amount'): grant.expense11_amount = float(args.get('expense11_amount')[0])
-    if args.get('expense12_description'): grant.expense12_description = args.get('expense12_description')[0]
-    if args.get('expense12_amount'): grant.expense12_amount = float(args.get('expense12_amount')[0])
+    grant.receipt_lines += get_line_items(args, 'expense', GrantReceiptLine)
     if args.get('completed_proj_comments'): grant.completed_proj_comments = args.get('completed_proj_comments')[0]
 
     # Set Submission Metadata
@@ -432,7 +372,7 @@ def receipts(overwrite = False):
     grant.receipts_submitted = True
 
     # Send notification email to user that the receipts were received
-    email_receipts_submitted(grant)
+    send_templated_email('receipts_submitted', grant)
 
     # Commit database changes
     db.session.commit()
@@ -444,6 +384,8 @@ def resubmit_receipts():
     return receipts(True)
 
 @app.route('/grant/<grant_id>')
+@conditional_grant_page('key')
+@cached_page('key')
 def grant(grant_id):
     """ Retrieves grant info for applicants to track grant progress """
 
@@ -466,160 +408,62 @@ def grant(grant_id):
         editable = True
 
     # Calculate Progress through grant process for template progress bar
-    progress = {'percentage': 0, 'message': ""}
-    # Upfront Grants
-    if grant.is_upfront:
-        # Upfront small grant
-        if grant.is_small_grant:
-            if grant.hearing_requested and not grant.hearing_occurred:
-                progress['percentage'] = 0.9
-                progress['message'] = "Hearing Requested."
-            elif grant.must_reimburse_uc:
-                if grant.reimbursed_uc:
-                    progress['percentage'] = 1.0
-                    progress['message'] = "Reimbursement Processed. Grant Complete."
-                else:
-                    progress['percentage'] = 0.9
-                    progress['message'] = "Some money unspent. Reimbursement required."
-            elif grant.receipts_reviewed:
-                progress['percentage'] = 1.0
-                progress['message'] = "Receipts Reviewed. Grant Complete."
-            elif grant.receipts_submitted:
-                progress['percentage'] = 0.85
-                progress['message'] = "Receipts Processing"
-            elif grant.is_paid:
-                progress['percentage'] = 0.68
-                if grant.is_direct_deposit == None:
-                    progress['message'] = "Submit Receipts"
-                elif grant.is_direct_deposit:
-                    if grant.pay_date:
-                        progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date) +". Submit Receipts."
-                    else:
-                        progress['message'] = "Funds Direct Deposited. Submit Receipts."
-                else:
-                    progress['message'] = "Check Written. Submit Receipts."
-            elif grant.council_approved and grant.amount_allocated:
-                progress['percentage'] = 0.51
-                progress['message'] = "Funds Processing"
-            elif grant.council_approved:
-                progress['percentage'] = 1.0
-                progress['message'] = "Grant Denied"
-            elif grant.small_grant_is_reviewed:
-                progress['percentage'] = 0.34
-                progress['message'] = "Docketed for Council Vote"
-            else:
-                progress['percentage'] = 0.17
-                progress['message'] = "Application Being Reviewed"
-        # Upfront non-small grant
+    status = grant.status
+    progress = {'percentage': status_progress[(bool(grant.is_upfront), bool(grant.is_small_grant))].get(status, 0), 'message': ""}
+    if status == GrantStatus.HEARING:
+        progress['message'] = "Hearing Requested."
+    elif status == GrantStatus.OWES_MONEY:
+        progress['message'] = "Some money unspent. Reimbursement required."
+    elif status == GrantStatus.COMPLETE and grant.is_upfront:
+        if grant.must_reimburse_uc:
+            progress['message'] = "Reimbursement Processed. Grant Complete."
         else:
-            if grant.hearing_requested and not grant.hearing_occurred:
-                progress['percentage'] = 0.9
-                progress['message'] = "Hearing Requested."
-            elif grant.must_reimburse_uc:
-                if grant.reimbursed_uc:
-                    progress['percentage'] = 1.0
-                    progress['message'] = "Reimbursement Processed. Grant Complete."
-                else:
-                    progress['percentage'] = 0.9
-                    progress['message'] = "Some money unspent. Reimbursement required."
-            elif grant.receipts_reviewed:
-                progress['percentage'] = 1.0
-                progress['message'] = "Receipts Reviewed. Grant Complete."
-            elif grant.receipts_submitted:
-                progress['percentage'] = 0.84
-                progress['message'] = "Receipts Processing"
-            elif grant.is_paid:
-                progress['percentage'] = 0.70
-                if grant.is_direct_deposit == None:
-                    progress['message'] = "Submit Receipts"
-                elif grant.is_direct_deposit:
-                    if grant.pay_date:
-                        progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date) +". Submit Receipts."
-                    else:
-                        progress['message'] = "Funds Direct Deposited. Submit Receipts."
-                else:
-                    progress['message'] = "Check Written. Submit Receipts."
-            elif grant.council_approved and grant.amount_allocated:
-                progress['percentage'] = 0.56
-                progress['message'] = "Funds Processing"
-            elif grant.council_approved:
-                progress['percentage'] = 1.0
-                progress['message'] = "Grant Denied"
-            elif grant.interview_occurred:
-                progress['percentage'] = 0.42
-                progress['message'] = "Docketed for Council Vote"
-            elif grant.interview_schedule_date:
-                progress['percentage'] = 0.28
-                progress['message'] = "Interview scheduled for " + utc_to_east_datetime(grant.interview_schedule_date)
+            progress['message'] = "Receipts Reviewed. Grant Complete."
+    elif status == GrantStatus.COMPLETE:
+        # Retroactive grants are complete once paid
+        if grant.is_direct_deposit == None:
+            progress['message'] = "Grant Completed."
+        elif grant.is_direct_deposit:
+            if grant.pay_date:
+                progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date)
             else:
-                progress['percentage'] = 0.14
-                progress['message'] = "Interview being scheduled"
-    # Retroactive Grants
-    else:
-        # Retroactive small grant
-        if grant.is_small_grant:
-            if grant.hearing_requested and not grant.hearing_occurred:
-                progress['percentage'] = 0.9
-                progress['message'] = "Hearing Requested."
-            elif grant.is_paid:
-                progress['percentage'] = 1.0
-                if grant.is_direct_deposit == None:
-                    progress['message'] = "Grant Completed."
-                elif grant.is_direct_deposit:
-                    if grant.pay_date:
-                        progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date)
-                    else:
-                        progress['message'] = "Funds Direct Deposited into Your Account"
-                else:
-                    progress['message'] = "Check Written"
-            elif grant.receipts_submitted:
-                progress['percentage'] = 0.8
-                progress['message'] = "Receipts Processing"
-            elif grant.council_approved:
-                progress['percentage'] = 0.6
-                progress['message'] = "Submit Receipts"
-            elif grant.small_grant_is_reviewed:
-                progress['percentage'] = 0.4
-                progress['message'] = "Docketed for Council Vote"
-            else:
-                progress['percentage'] = 0.2
-                progress['message'] = "Application Being Reviewed"
-        # Retroactive non-small grant
+                progress['message'] = "Funds Direct Deposited into Your Account"
         else:
-            if grant.hearing_requested and not grant.hearing_occurred:
-                progress['percentage'] = 0.9
-                progress['message'] = "Hearing Requested."
-            elif grant.is_paid:
-                progress['percentage'] = 1.0
-                if grant.is_direct_deposit == None:
-                    progress['message'] = "Grant Completed."
-                elif grant.is_direct_deposit:
-                    if grant.pay_date:
-                        progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date)
-                    else:
-                        progress['message'] = "Funds Direct Deposited into Your Account"
-                else:
-                    progress['message'] = "Check Written"
-            elif grant.receipts_submitted:
-                progress['percentage'] = 0.81
-                progress['message'] = "Receipts Processing"
-            elif grant.council_approved:
-                progress['percentage'] = 0.65
-                progress['message'] = "Submit Receipts"
-            elif grant.interview_occurred:
-                progress['percentage'] = 0.49
-                progress['message'] = "Docketed for Council Vote"
-            elif grant.interview_schedule_date:
-                progress['percentage'] = 0.33
-                progress['message'] = "Interview scheduled for " + utc_to_east_datetime(grant.interview_schedule_date)
+            progress['message'] = "Check Written"
+    elif status == GrantStatus.RECEIPTS_SUBMITTED:
+        progress['message'] = "Receipts Processing"
+    elif status == GrantStatus.PAID:
+        if grant.is_direct_deposit == None:
+            progress['message'] = "Submit Receipts"
+        elif grant.is_direct_deposit:
+            if grant.pay_date:
+                progress['message'] = "Funds Direct Deposited on " + utc_to_east_date(grant.pay_date) +". Submit Receipts."
             else:
-                progress['percentage'] = 0.17
-                progress['message'] = "Interview being scheduled"
+                progress['message'] = "Funds Direct Deposited. Submit Receipts."
+        else:
+            progress['message'] = "Check Written. Submit Receipts."
+    elif status == GrantStatus.APPROVED:
+        if grant.is_upfront:
+            progress['message'] = "Funds Processing"
+        else:
+            progress['message'] = "Submit Receipts"
+    elif status == GrantStatus.DENIED:
+        progress['message'] = "Grant Denied"
+    elif status == GrantStatus.DOCKETED:
+        progress['message'] = "Docketed for Council Vote"
+    elif status == GrantStatus.INTERVIEW_SCHEDULED:
+        progress['message'] = "Interview scheduled for " + utc_to_east_datetime(grant.interview_schedule_date)
+    elif grant.is_small_grant:
+        progress['message'] = "Application Being Reviewed"
+    else:
+        progress['message'] = "Interview being scheduled"
 
     # Render grant status page to user
     return render_template("grant_status.html", grant=grant, progress=progress, editable=editable)
 
 @app.route('/grant/<grant_id>/application')
+@conditional_grant_page()
+@cached_page()
 def grant_application(grant_id):
     """ Retrieves the original grant application for applicants to review """
 
@@ -638,6 +482,8 @@ def grant_application(grant_id):
     return render_template("grant_application.html", grant=grant)
 
 @app.route('/grant/<grant_id>/allocations')
+@conditional_grant_page()
+@cached_page()
 def grant_allocations(grant_id):
     """ Retrieves the categories and amounts allocated for this grant """
 
@@ -661,11 +507,12 @@ def grant_allocations(grant_id):
 
 @app.route('/interview')
 @login_required
+@query_budget(3)
 def interviews():
     """ Displays a searchable list of grants eligible for interviews """
 
     # Get list of all grants eligible for interviews
-    grants = Grant.query.filter_by(interview_occurred=False, is_small_grant=False).all()
+    grants = grant_query('interviews').filter_by(interview_occurred=False, is_small_grant=False).all()
 
     # Render page to user
     return render_template("interviews.html", grants=grants)
@@ -744,7 +591,7 @@ def grant_interview(grant_id):
             grant.interviewer = current_user.first_name + " " + current_user.last_name
 
             # Send notification email to user
-            email_interview_completed(grant)
+            send_templated_email('interview_completed', grant)
 
             # Generate Flashed Success Message
             flash('\'' + grant.organization + '\' Interview Submitted Successfully', 'success')
@@ -763,11 +610,12 @@ def grant_interview(grant_id):
 
 @app.route('/small-grant-review')
 @login_required
+@query_budget(3)
 def small_grants():
     """ Displays a list of grants eligible for small-grant processing """
 
     # Get list of all small-grant elligible grants
-    grants = Grant.query.filter_by(is_small_grant=True, small_grant_is_reviewed=False).all()
+    grants = grant_query('small_grants').filter_by(is_small_grant=True, small_grant_is_reviewed=False).all()
 
     # Render page to user
     return render_template("small_grants.html", grants=grants)
@@ -834,6 +682,7 @@ def small_grant_review(grant_id):
 @app.route('/grants-pack/edit', methods=['GET','POST'])
 @login_required
 @admin_required
+@query_budget(5)
 def grants_pack_edit(grants_pack=None):
     """ Displays page to review and select grants that are elligible for adding to a grants pack,
         and processes updates POSTed by the page """
@@ -850,9 +699,7 @@ def grants_pack_edit(grants_pack=None):
         # Default to current Grants Pack
         else:
             # Get Current Grants Pack
-            council_semester = Config.query.filter_by(key='council_semester').first()
-            current_week = Config.query.filter_by(key='grant_week').first()
-            grants_pack = council_semester.value + '-' + current_week.value
+            grants_pack = config_cache.get('council_semester') + '-' + config_cache.get('grant_week')
             grants_pack_db = Grants_Week.query.filter_by(grant_week=grants_pack).first()
 
         # Ensure that the grants pack has not been locked (by approved council vote)
@@ -860,8 +707,8 @@ def grants_pack_edit(grants_pack=None):
             return "This grants pack has already been finalized and approved by the council."
 
         # query for all grants currently without a grants pack
-        orphan_grants = Grant.query.filter(OR(AND(Grant.grants_pack==None,Grant.interview_occurred==True), AND(Grant.grants_pack==None,Grant.small_grant_is_reviewed==True))).all()
-        child_grants = Grant.query.filter_by(grants_pack=grants_pack).all()
+        orphan_grants = grant_query('grants_pack_edit').filter(OR(AND(Grant.grants_pack==None,Grant.interview_occurred==True), AND(Grant.grants_pack==None,Grant.small_grant_is_reviewed==True))).all()
+        child_grants = grant_query('grants_pack_edit').filter_by(grants_pack=grants_pack).all()
 
         # Render page to user
         return render_template('grants_pack_edit.html', orphan_grants=orphan_grants, child_grants=child_grants, grants_pack=grants_pack)
@@ -878,19 +725,8 @@ def grants_pack_edit(grants_pack=None):
                 grants_pack_db = Grants_Week.query.filter_by(grant_week=grants_pack).first()
                 if grants_pack_db.grants_pack_finalized:
                     return "This grants pack has already been finalized and approved by the council.",400
-                # For each grant, update its value in the database
-                for grant in grants:
-                    grant_id = grant.get('grant_id')
-                    selected = grant.get('selected')
-                    # Ensure that grant_id was provided and selected is valid
-                    if grant_id and selected != None:
-                        # This slightly ugly syntax uses far fewer SQL calls than the alternative
-                        if selected:
-                            Grant.query.filter(Grant.grant_id==grant_id).update({ "grants_pack" : grants_pack })
-                        else:
-                            Grant.query.filter(Grant.grant_id==grant_id).update({ "grants_pack" : None })
-                        db.session.commit()
-                return "OK"
+                # Move all of the grants in one transaction and report what changed
+                return jsonify(update_grants_pack_membership(grants_pack, grants))
         # On failure, return error with HTTP 400 "Bad Request" Status Code
         return 'Error',400
 
@@ -904,6 +740,7 @@ def grants_pack_edit_pack(grants_pack):
 @app.route('/grants-pack/cuts', methods=['GET','POST'])
 @login_required
 @admin_required
+@query_budget(6)
 def grants_pack_cuts(grants_pack=None):
     """ Displays a page to the user with the calculated cut amounts """
 
@@ -919,96 +756,64 @@ def grants_pack_cuts(grants_pack=None):
         # Default to current Grants Pack
         else:
             # Get Current Grants Pack
-            council_semester = Config.query.filter_by(key='council_semester').first()
-            current_week = Config.query.filter_by(key='grant_week').first()
-            grants_pack = council_semester.value + '-' + current_week.value
+            grants_pack = config_cache.get('council_semester') + '-' + config_cache.get('grant_week')
             grants_pack_db = Grants_Week.query.filter_by(grant_week=grants_pack).first()
 
         # Ensure that the grants pack has not been locked (by approved council vote)
         if grants_pack_db.grants_pack_finalized:
             return "This grants pack has already been finalized and approved by the council."
 
-        # Get all grants in grants pack from the DB
-        grants = Grant.query.filter_by(grants_pack=grants_pack).all()
-
         # Get this grants pack's budget
         budget = grants_pack_db.budget
 
-        # Calculate expendature for this week
-        allocated = 0
-        cut_immune = 0
-        for grant in grants:
-            # Sum grant
-            grant.amount_allocated = 0
-            if grant.food_allocated: grant.amount_allocated += grant.food_allocated
-            if grant.travel_allocated: grant.amount_allocated += grant.travel_allocated
-            if grant.publicity_allocated: grant.amount_allocated += grant.publicity_allocated
-            if grant.materials_allocated: grant.amount_allocated += grant.materials_allocated
-            if grant.venue_allocated: grant.amount_allocated += grant.venue_allocated
-            if grant.decorations_allocated: grant.amount_allocated += grant.decorations_allocated
-            if grant.media_allocated: grant.amount_allocated += grant.media_allocated
-            if grant.admissions_allocated: grant.amount_allocated += grant.admissions_allocated
-            if grant.hupd_allocated: grant.amount_allocated += grant.hupd_allocated
-            if grant.personnel_allocated: grant.amount_allocated += grant.personnel_allocated
-            if grant.other_allocated: grant.amount_allocated += grant.other_allocated
-            # Add to allocated costs
-            allocated += grant.amount_allocated
-            # If immune from cuts, add to cut_immune
-            if grant.is_collaboration_confirmed:
-                cut_immune += grant.amount_allocated
-
-        # See if we went overbudget, and calculate cut percentage
-        cuts = 0
-        if allocated > budget:
-            deductable = allocated - cut_immune
-            remaining = budget - cut_immune
-            cuts = 1.0 - (remaining / deductable)
-
-        # Apply the recommended cuts for each grant
-        for grant in grants:
-            if grant.is_collaboration_confirmed:
-                grant.percentage_cut = 0.0
-            else:
-                grant.percentage_cut = cuts
-
-        percentage_cut = round(100 * cuts, 2)
-        cut_multiplier = 1.0 - cuts
-
-        return render_template('grants_pack_cuts.html', grants=grants, grants_pack=grants_pack, budget=budget, allocated=allocated, cut_immune=cut_immune, percentage_cut=percentage_cut, cut_multiplier=cut_multiplier)
+        # Read the cut policy and any per-category caps
+        policy = request.args.get('policy', 'proportional')
+        if policy not in cut_policies:
+            return "Unknown cut policy " + policy + ".",400
+        caps = {}
+        for category in allocation_categories:
+            cap = request.args.get('cap_' + category)
+            if cap:
+                if not isfloat(cap):
+                    return "Invalid cap for " + category + ".",400
+                caps[category] = float(cap)
+
+        # Load the pack's allocations and calculate the recommended cuts
+        matrix = AllocationMatrix.load(Grant.grants_pack==grants_pack)
+        cuts = recommend_cuts(matrix, budget, policy, caps)
+        grants = [grant._replace(amount_allocated=total) for grant, total in zip(matrix.grants, matrix.totals)]
+        allocated = matrix.allocated
+        cut_immune = matrix.cut_immune
+
+        # Overall cut, as a share of the money which could be cut
+        deductable = allocated - cut_immune
+        percentage_cut = round(100 * sum(total * cut for total, cut in zip(matrix.totals, cuts)) / deductable, 2) if deductable else 0.0
+
+        return render_template('grants_pack_cuts.html', grants=zip(grants, cuts), grants_pack=grants_pack, budget=budget, allocated=allocated, cut_immune=cut_immune, percentage_cut=percentage_cut, policy=policy, policies=sorted(cut_policies), caps=caps, categories=allocation_categories)
 
     # User is POSTing form data updates back to the server
     else:
         # Format posted data and get grant_pack value
-        values = dict(request.form)
+        values = request.form.to_dict(flat=False)
         grants_pack = values.pop('grants_pack')[0]
-        # Update Weekly running total while calculating grants
+        # Ensure that the grants pack has not been locked (by approved council vote)
         grant_week = Grants_Week.query.filter_by(grant_week=grants_pack).first()
-        grant_week.allocated = 0.0
-        grant_week.requested = 0.0
-        # Process each grant
-        for grant_id,cut in values.items():
-            # Get the percentage gut in the correct format
-            cut = float(cut[0])
-            # Update grant record with cut and final allocated amount
-            grant = Grant.query.filter_by(grant_id=grant_id).first()
-            # Sum grant
-            allocated = 0
-            if grant.food_allocated: allocated += grant.food_allocated
-            if grant.travel_allocated: allocated += grant.travel_allocated
-            if grant.publicity_allocated: allocated += grant.publicity_allocated
-            if grant.materials_allocated: allocated += grant.materials_allocated
-            if grant.venue_allocated: allocated += grant.venue_allocated
-            if grant.decorations_allocated: allocated += grant.decorations_allocated
-            if grant.media_allocated: allocated += grant.media_allocated
-            if grant.admissions_allocated: allocated += grant.admissions_allocated
-            if grant.hupd_allocated: allocated += grant.hupd_allocated
-            if grant.personnel_allocated: allocated += grant.personnel_allocated
-            if grant.other_allocated: allocated += grant.other_allocated
-            # Save cut and calculate final amount allocated
-            grant.percentage_cut = cut
-            grant.amount_allocated = round((100 - cut) / 100 * allocated, 2)
-            grant_week.allocated += grant.amount_allocated
-            grant_week.requested += grant.amount_requested
+        if not grant_week:
+            return "Grants Pack " + grants_pack + " does not exist.",400
+        if grant_week.grants_pack_finalized:
+            return "This grants pack has already been finalized and approved by the council.",400
+
+        # Load every posted grant's allocations at once, and make no changes if any are missing
+        matrix = AllocationMatrix.load(Grant.grant_id.in_(list(values)))
+        missing = sorted(set(values) - set(grant.grant_id for grant in matrix.grants))
+        if missing:
+            return "Invalid Grant_ID Submitted: " + ", ".join(missing),400
+        if not all(isfloat(values[grant.grant_id][0]) for grant in matrix.grants):
+            return "Invalid percentage cut submitted.",400
+        percentage_cuts = [float(values[grant.grant_id][0]) for grant in matrix.grants]
+        # Save the cuts and final amounts together, updating the weekly running total
+        grant_week.allocated = save_cuts(matrix, percentage_cuts)
+        grant_week.requested = sum(grant.amount_requested or 0.0 for grant in matrix.grants)
 
         # Notify user of successful submit
         flash("Grants Pack " + grants_pack + " submitted successfully.", 'success')
@@ -1017,26 +822,27 @@ def grants_pack_cuts(grants_pack=None):
         grant_week_config = Config.query.filter_by(key="grant_week").first()
         if not grant_week_config:
             return "Error: grant_week not defined in Config database"
-        council_semester = Config.query.filter_by(key="council_semester").first()
+        council_semester = config_cache.get('council_semester')
         if not council_semester:
             return "Error: council semester not defined in config database"
 
         # If this was the current grants_pack, create a new one and set it as current
-        if grant_week.grant_week == council_semester.value + '-' + grant_week_config.value:
+        if grant_week.grant_week == council_semester + '-' + grant_week_config.value:
 
             # Get the next uncreated grants_week in the semester
+            existing_weeks = set(week for (week,) in db.session.query(Grants_Week.grant_week).filter(Grants_Week.grant_week.like(council_semester + '-%')))
             next_grant_week = int(grant_week_config.value) + 1
-            while Grants_Week.query.filter_by(grant_week=(council_semester.value + '-' + str(next_grant_week))).first() != None:
+            while council_semester + '-' + str(next_grant_week) in existing_weeks:
                 next_grant_week += 1
 
-            # Query for default budget
-            budget = Config.query.filter_by(key="default_budget").first()
-            if not budget:
-                "Error: Default Budget not defined in Config database"
+            # Get the default budget
+            budget = config_cache.get('default_budget', float)
+            if budget == None:
+                return "Error: Default Budget not defined in Config database"
 
             # Create the new grants week
-            next_grant_week_db = Grants_Week(council_semester.value + '-' + str(next_grant_week))
-            next_grant_week_db.budget = float(budget.value)
+            next_grant_week_db = Grants_Week(council_semester + '-' + str(next_grant_week))
+            next_grant_week_db.budget = budget
             db.session.add(next_grant_week_db)
 
             # Update the config
@@ -1060,6 +866,7 @@ def grants_pack_cuts_pack(grants_pack):
 @app.route('/grants-pack')
 @login_required
 @admin_required
+@query_budget(3)
 def grants_packs():
     """ Shows page listing all grants packs and their status """
     # Query for all existing grants packs
@@ -1129,10 +936,10 @@ def grants_pack_council_approve(grants_pack):
             grant.council_approved = True
             if grant.amount_allocated == 0:
                 # Send "denied" notification email to user
-                email_application_denied(grant)
+                send_templated_email('application_denied', grant)
             else:
                 # Send "passed" notification email to user
-                email_application_passed(grant)
+                send_templated_email('application_passed', grant)
 
         # Update database to approve grants pack
         grants_pack_db.grants_pack_finalized = True
@@ -1151,59 +958,108 @@ def search():
     """ Allows the user to search for grants by Organization, Project, or Grant ID """
 
     # Get Security Key
-    sec_key = Config.query.filter_by(key="security_key").first()
+    sec_key = config_cache.get('security_key')
     if sec_key == None:
         return "Security Key not set."
 
     # User is requesting the search form
     if request.method == 'GET':
 
-        # Render the page to the user
-        return render_template('search.html', k=sec_key.value)
+        # Render the page to the user (the organization list version lets browsers keep
+        # their prefetched copy until an organization is added)
+        return render_template('search.html', k=sec_key, organizations_version=organization_index.prefetch()[0])
 
 @app.route('/search/organizations')
 def organizations():
     """ Provides an API endpoint which returns a list of all organizations in JSON """
 
     # Get Security Key
-    sec_key = Config.query.filter_by(key="security_key").first()
+    sec_key = config_cache.get('security_key')
     if sec_key == None:
         return "Security Key not set."
 
     # Verify the security key
-    if request.args.get('k') != sec_key.value:
+    if request.args.get('k') != sec_key:
         return "Invlalid Security Key. You do not have access to this system."
 
     # See if there is a query
     query = request.args.get('query')
     if query:
         # Search for the query
-        orgs = [i.name for i in Organization.query.filter(Organization.name.like('%' + query + '%'))]
+        return jsonify(organization_index.search(query))
+
+    # Respond with JSON of all organizations. A request for the current version (v=) may be
+    # cached, and any other may be revalidated with its ETag
+    version, payload = organization_index.prefetch()
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(version)
+    if request.args.get('v') == version:
+        response.headers['Cache-Control'] = 'private, max-age=86400'
     else:
-        # Respond with JSON of all organizations
-        orgs = [i.name for i in Organization.query.all()]
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@app.route('/search/standing')
+def organization_standing():
+    """ Provides an API endpoint which returns an organization's standing in JSON """
+
+    # Get Security Key
+    sec_key = config_cache.get('security_key')
+    if sec_key == None:
+        return "Security Key not set."
+
+    # Verify the security key
+    if request.args.get('k') != sec_key:
+        return "Invlalid Security Key. You do not have access to this system."
+
+    # Get Search criteria
+    query = request.args.get('query')
+
+    # Ensure that query was specified
+    if not query:
+        return "Must specify query"
+
+    # Look up the organization's running totals (organizations without grants have none)
+    standing = OrganizationStanding.query.get(query)
+    if not standing:
+        standing = OrganizationStanding(query)
+    add_overdue_receipts([standing])
+    result = {column : getattr(standing, column) or 0 for column in standing_totals}
+    result['amount_owed'] = standing.total_owed
+    result['overdue_receipts'] = standing.overdue_receipts
+    result['organization'] = query
+    result['in_bad_standing'] = standing.in_bad_standing
 
     # Return the JSON response
-    return jsonify(orgs)
+    return jsonify(result)
 
 @app.route('/search/projects')
 def projects():
-    """ Provides an API endpoint for which projects can be queried """
+    """ Provides an API endpoint for which projects can be queried. Returns the best matching
+        projects first, per_page (default 20) at a time """
 
     # Get Security Key
-    sec_key = Config.query.filter_by(key="security_key").first()
+    sec_key = config_cache.get('security_key')
     if sec_key == None:
         return "Security Key not set."
 
     # Verify the security key
-    if request.args.get('k') != sec_key.value:
+    if request.args.get('k') != sec_key:
         return "Invlalid Security Key. You do not have access to this system."
 
+    # Read the page of results to return
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), 100)
+    except ValueError:
+        return "Page and per_page must be numbers.",400
+
     # See if there is a query
     query = request.args.get('query')
     if query:
-        # Search for the query
-        projects = [grant.project for grant in Grant.query.filter(Grant.project.like('%' + query + '%'))]
+        # Search the full-text index (interviewer notes are only searched for admins)
+        columns = [column for column, weight in search_columns] if current_user.is_authenticated and current_user.admin else public_search_columns
+        projects = [grant.project for grant in search_projects(query, page, per_page, columns)]
     else:
         # If there is no query, return an empty response
         return "[]"
@@ -1216,12 +1072,12 @@ def lookup_grants():
     """ API endpoint that returns a list of all grants from an organization """
 
     # Get Security Key
-    sec_key = Config.query.filter_by(key="security_key").first()
+    sec_key = config_cache.get('security_key')
     if sec_key == None:
         return "Security Key not set."
 
     # Verify the security key
-    if request.args.get('k') != sec_key.value:
+    if request.args.get('k') != sec_key:
         return "Invlalid Security Key. You do not have access to this system."
 
     # Get Search criteria
@@ -1231,41 +1087,98 @@ def lookup_grants():
     if not query:
         return "Must specify query"
 
-    # Query for grants by organization
-    org_grants = Grant.query.filter_by(organization=query).all()
+    # Return every grant from the organization or with the project name, in JSON form
+    grants, after, more = lookup_grants_page([query])
+    return jsonify(grants)
+
+@app.route('/api/grants/lookup')
+def grants_lookup():
+    """ API endpoint which pages through the grants whose organization or project name matches
+        any of the query parameters, in grant order. Optionally takes a comma-separated list of
+        the fields to return. Each response includes the cursor to pass as after= to fetch the
+        next page """
+
+    # Get Security Key
+    sec_key = config_cache.get('security_key')
+    if sec_key == None:
+        return "Security Key not set."
+
+    # Verify the security key
+    if request.args.get('k') != sec_key:
+        return "Invlalid Security Key. You do not have access to this system."
+
+    # Get Search criteria (query may be given more than once)
+    queries = [query for query in request.args.getlist('query') if query]
+    if not queries:
+        return "Must specify query",400
+
+    # Read the fields to return
+    fields = list(serialized_grant_fields)
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',')]
+        unknown = [field for field in fields if field not in serialized_grant_fields]
+        if unknown:
+            return "Unknown field(s): " + ', '.join(unknown),400
+
+    # Read the page size and cursor
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return "Limit and cursor must be numbers.",400
+    if limit < 1:
+        return "Limit must be positive.",400
+
+    # Look up the next page of grants
+    grants, after, more = lookup_grants_page(queries, after, limit, fields)
 
-    # Build list of grant data for JSON serialization
-    results = list(map(serialize_grant, org_grants))
+    # Return the JSON response
+    return jsonify({'grants' : grants, 'next' : after, 'has_more' : more})
 
-    # Query for grants by project name
-    project_grants = Grant.query.filter_by(project=query).all()
+@app.route('/api/changes')
+def changes():
+    """ API endpoint which pages through the grants changed since a cursor, oldest change first.
+        Each response includes the cursor to pass as since= to fetch the next page """
 
-    # Add grant if it exists
-    if grant:
-        results += list(map(serialize_grant, project_grants))
+    # Get Security Key
+    sec_key = config_cache.get('security_key')
+    if sec_key == None:
+        return "Security Key not set."
 
-    # Return results in JSON form
-    return jsonify(results)
+    # Verify the security key
+    if request.args.get('k') != sec_key:
+        return "Invlalid Security Key. You do not have access to this system."
+
+    # Read the page size
+    try:
+        limit = min(int(request.args.get('limit', 500)), 5000)
+    except ValueError:
+        return "Limit must be a number.",400
+    if limit < 1:
+        return "Limit must be positive.",400
+
+    # Look up the next page of changes
+    cursor = request.args.get('since')
+    try:
+        changes, cursor, more = grant_changes(cursor, limit)
+    except ValueError:
+        return "Invalid cursor " + cursor + ".",400
+
+    # Return the JSON response
+    return jsonify({'changes' : changes, 'next' : cursor, 'has_more' : more})
 
 @app.route('/treasurer')
 @login_required
 @admin_required
+@query_budget(4)
 def review_receipts():
     """ Displays a page to the user of grants that are ready to have receipts verified """
 
-    # Query for relevant grants
-    retroactive_grants = Grant.query.filter_by(council_approved=True,is_upfront=False,receipts_submitted=True,is_paid=False).all()
-    upfront_grants = Grant.query.filter(AND(AND(Grant.council_approved==True,Grant.is_upfront==True),AND(Grant.is_paid==False,Grant.amount_allocated!=0))).all()
-    upfront_receipts = Grant.query.filter_by(council_approved=True,is_upfront=True,is_paid=True,receipts_submitted=True,receipts_reviewed=False).all()
-
-    # Query for orgs in bad standing
-    no_receipts = Grant.query.filter(AND(AND(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.receipts_submitted==False), Grant.receipts_due < datetime.now()), Grant.amount_dispensed>0), Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
-    unspent_money = Grant.query.filter(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.must_reimburse_uc==True),Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
-    hearings = Grant.query.filter(AND(Grant.hearing_requested==True,Grant.hearing_occurred==False))
-    bad_orgs = set([x.organization for x in no_receipts] + [x.organization for x in unspent_money] + [x.organization for x in hearings])
+    # Sort the grants needing attention (and the organizations in bad standing) in one pass
+    dashboard = treasurer_dashboard()
 
     # Render grants page to the user
-    return render_template('review_receipts.html', retroactive_grants=retroactive_grants,upfront_grants=upfront_grants,upfront_receipts=upfront_receipts, bad_orgs=bad_orgs)
+    return render_template('review_receipts.html', retroactive_grants=dashboard['retroactive_grants'], upfront_grants=dashboard['upfront_grants'], upfront_receipts=dashboard['upfront_receipts'], bad_orgs=dashboard['bad_orgs'])
 
 @app.route('/treasurer/<grant_id>', methods=['GET','POST'])
 @login_required
@@ -1292,9 +1205,10 @@ def review_grant_receipts(grant_id):
     if request.method == 'GET':
 
         # Query for the organization information and validate
-        organization = Organization.query.filter_by(name=grant.organization).first()
+        organization = Organization.query.options(joinedload(Organization.standing)).filter_by(name=grant.organization).first()
         if not organization:
             return "Internal Error: Organization not listed in database"
+        add_overdue_receipts([organization.standing])
 
         # Ensure that the percentage cut was specified
         if grant.percentage_cut == None:
@@ -1333,13 +1247,13 @@ def review_grant_receipts(grant_id):
             grant.check_number = request.form.get('check_number')
 
             # Send notification email to user to pickup check
-            email_check(grant)
+            send_templated_email('check', grant)
 
         else:
             grant.is_direct_deposit = True
 
             # Send notification email to user that direct deposit occurred
-            email_direct_deposit(grant)
+            send_templated_email('direct_deposit', grant)
 
         # Commit all changes to database
         db.session.commit()
@@ -1350,6 +1264,14 @@ def review_grant_receipts(grant_id):
         # Redirect to treasurer page
         return redirect(url_for('review_receipts'))
 
+@app.route('/metrics')
+@login_required
+@admin_required
+def metrics():
+    """ Reports request counts, timings, SQL usage and response sizes for every endpoint,
+        and the grant page cache's hit rate, in Prometheus text format """
+    return Response(request_metrics.prometheus() + page_cache.prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/settings')
 @login_required
 @admin_required
@@ -1360,45 +1282,45 @@ def settings():
     # Query for all users
     users = User.query.all()
 
-    # Query for default weekly budget
-    default_budget = Config.query.filter_by(key="default_budget").first()
+    # Look up default weekly budget
+    default_budget = config_cache.get('default_budget')
     if not default_budget:
         return "Error: Default budget not specified in database"
 
-    # Query for emails enabled
-    enable_email = Config.query.filter_by(key="enable_email").first()
+    # Look up emails enabled
+    enable_email = config_cache.get('enable_email')
     if not enable_email:
         return "Error: enable_email not specified in database"
 
-    # Query for grants email username
-    grants_email_username = Config.query.filter_by(key="grants_email_username").first()
+    # Look up grants email username
+    grants_email_username = config_cache.get('grants_email_username')
     if not grants_email_username:
         return "Error: grants_email_username not specified in database"
 
-    # Query for treasurer email username
-    treasurer_email_username = Config.query.filter_by(key="treasurer_email_username").first()
+    # Look up treasurer email username
+    treasurer_email_username = config_cache.get('treasurer_email_username')
     if not treasurer_email_username:
         return "Error: treasurer_email_username not specified in database"
 
-    # Query for treasurer name
-    treasurer_name = Config.query.filter_by(key="treasurer_name").first()
+    # Look up treasurer name
+    treasurer_name = config_cache.get('treasurer_name')
     if not treasurer_name:
         return "Error: treasurer_name not specified in database"
 
-    # Query for current council semester
-    council_semester = Config.query.filter_by(key="council_semester").first()
+    # Look up current council semester
+    council_semester = config_cache.get('council_semester')
     if not council_semester:
         return "Error: Council semester not specified in database"
 
-    # Query for current grants week
-    grant_week = Config.query.filter_by(key="grant_week").first()
+    # Look up current grants week
+    grant_week = config_cache.get('grant_week')
     if not grant_week:
         return "Error: Grant week not specified in database"
 
-    grants_pack = council_semester.value + '-' + grant_week.value
+    grants_pack = council_semester + '-' + grant_week
 
     # Render page to user
-    return render_template('settings.html', users=users, default_budget=default_budget.value, council_semester=council_semester.value, grants_pack=grants_pack, enable_email=enable_email.value, grants_email_username=grants_email_username.value, treasurer_email_username=treasurer_email_username.value, treasurer_name=treasurer_name.value)
+    return render_template('settings.html', users=users, default_budget=default_budget, council_semester=council_semester, grants_pack=grants_pack, enable_email=enable_email, grants_email_username=grants_email_username, treasurer_email_username=treasurer_email_username, treasurer_name=treasurer_name)
 
 @app.route('/settings/edit-user', methods=['GET','POST'])
 @login_required
@@ -1918,9 +1840,10 @@ def upfront_payment(grant_id):
         return "This grant is not eligible for Treasurer review -- it has already been paid"
 
     # Query for the organization information and validate
-    organization = Organization.query.filter_by(name=grant.organization).first()
+    organization = Organization.query.options(joinedload(Organization.standing)).filter_by(name=grant.organization).first()
     if not organization:
         return "Internal Error: Organization not listed in database"
+    add_overdue_receipts([organization.standing])
 
     # User is requesting page
     if request.method == 'GET':
@@ -1954,13 +1877,13 @@ def upfront_payment(grant_id):
             grant.check_number = request.form.get('check_number')
 
             # Send notification email to user to pickup check
-            email_check(grant)
+            send_templated_email('check', grant)
 
         else:
             grant.is_direct_deposit = True
 
             # Send notification email to user that direct deposit occurred
-            email_direct_deposit(grant)
+            send_templated_email('direct_deposit', grant)
 
         db.session.commit()
 
@@ -2017,12 +1940,12 @@ def upfront_review(grant_id):
             grant.must_reimburse_uc = True
             grant.reimburse_uc_amount = amount_owed
 
+        # Send an email about the grant status to applicant
+        send_templated_email('receipts_reviewed', grant)
+
         # Commit changes to database
         db.session.commit()
 
-        # Send an email about the grant status to applicant
-        email_receipts_reviewed(grant)
-
         # flash message to user
         flash("\'" + grant.project + "\' Receipts Successfully Reviewed", 'success')
 
@@ -2032,6 +1955,7 @@ def upfront_review(grant_id):
 @app.route('/schedule', methods=['GET','POST'])
 @login_required
 @admin_required
+@query_budget(10)
 def schedule_interviews():
     """ A page for the admins to schedule interviews for the coming week """
 
@@ -2039,7 +1963,7 @@ def schedule_interviews():
     if request.method == 'GET':
 
         # Query for interview-eligible grants
-        grants = Grant.query.filter_by(interview_occurred=False,is_small_grant=False).all()
+        grants = grant_query('interviews').filter_by(interview_occurred=False,is_small_grant=False).all()
 
         # Render template to user
         return render_template("schedule_interviews.html", grants=grants)
@@ -2053,25 +1977,31 @@ def schedule_interviews():
         if not date_str:
             return "No Date Specified"
         date = eastern.localize(datetime.strptime(date_str, '%Y-%m-%d'))
-        # Loop through all arguments looking for intervie times
+        # Collect the interview times submitted for each grant
+        times = {}
         for (name,value) in request.form.items():
-            # If we have found grant info, update interview time
+            # If we have found grant info, parse the interview time
             if name.startswith("grant:") and value:
-                grant_id = name.split("grant:")[1]
-                grant = Grant.query.filter_by(grant_id=grant_id).first()
-                if not grant:
-                    return "Invalid Grant_ID Submitted"
-                hours = int(value.split(":")[0])
-                minutes = int(value.split(":")[1])
-                # Save interview history if necessary
-                if grant.interview_schedule_date:
-                    if grant.interview_schedule_history:
-                        grant.interview_schedule_history += ", " + grant.interview_schedule_date.strftime("%d/%m/%Y %H:%M")
-                    else:
-                        grant.interview_schedule_history = grant.interview_schedule_date.strftime("%d/%m/%Y %H:%M")
-                grant.interview_schedule_date = date.replace(hour=hours, minute=minutes).astimezone(utc)
-                # Send email for grant interview time
-                email_interview_scheduled(grant)
+                try:
+                    hours, minutes = [int(part) for part in value.split(":")]
+                except ValueError:
+                    return "Invalid Interview Time Submitted"
+                times[name.split("grant:")[1]] = (hours, minutes)
+        # Load every grant at once, and make no changes if any are missing
+        grants, missing = prefetch_grants(times)
+        if missing:
+            return "Invalid Grant_ID Submitted: " + ", ".join(missing)
+        for grant_id, (hours, minutes) in times.items():
+            grant = grants[grant_id]
+            # Save interview history if necessary
+            if grant.interview_schedule_date:
+                if grant.interview_schedule_history:
+                    grant.interview_schedule_history += ", " + grant.interview_schedule_date.strftime("%d/%m/%Y %H:%M")
+                else:
+                    grant.interview_schedule_history = grant.interview_schedule_date.strftime("%d/%m/%Y %H:%M")
+            grant.interview_schedule_date = date.replace(hour=hours, minute=minutes).astimezone(utc)
+            # Send email for grant interview time
+            send_templated_email('interview_scheduled', grant)
 
         db.session.commit()
 
@@ -2094,16 +2024,18 @@ def receipts_reminder():
     else:
         grants = Grant.query.filter(AND(AND(Grant.receipts_submitted==False,Grant.council_approved==True), Grant.amount_allocated>0)).all()
         for grant in grants:
-            email_submit_receipts(grant)
+            send_templated_email('submit_receipts', grant)
+        db.session.commit()
         return "Emails sent"
 
 @app.route('/owed-money')
 @login_required
 @admin_required
+@query_budget(4)
 def owed_money():
     # Query for relevant grants
-    no_receipts = Grant.query.filter(AND(AND(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.receipts_submitted==False), Grant.receipts_due < datetime.now()), Grant.amount_dispensed>0), Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
-    unspent_money = Grant.query.filter(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.must_reimburse_uc==True),Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
+    no_receipts = grant_query('owed_money').filter(Grant.status==GrantStatus.PAID, Grant.receipts_due < datetime.now(), Grant.amount_dispensed>0).all()
+    unspent_money = grant_query('owed_money').filter_by(status=GrantStatus.OWES_MONEY).all()
     # Sum owed money
     total = 0
     for grant in no_receipts:
@@ -2133,9 +2065,9 @@ def process_owed_money(grant_id):
         grant.reimbursed_uc = True
         if request.form.get("reimbursement_amount"):
             grant.reimburse_uc_amount = request.form.get("reimbursement_amount")
-        db.session.commit()
         # Send Email
-        email_reimbursement_complete(grant)
+        send_templated_email('reimbursement_complete', grant)
+        db.session.commit()
         # Notify Admin
         flash("Successfully Processed Owed Money for " + grant.project, 'success')
         return redirect(url_for('owed_money'))
@@ -2144,7 +2076,7 @@ def process_owed_money(grant_id):
 @login_required
 @treasurer_required
 def raw_grant_edit(grant_id):
-    GrantForm = model_form(Grant, Form)
+    GrantForm = model_form(Grant, Form, exclude=grant_line_items + ['status', 'updated_at'])
     grant = Grant.query.filter_by(grant_id=grant_id).first()
     if not grant:
         flash("Grant does not exist", 'error')
@@ -2179,6 +2111,8 @@ def send_owe():
     return redirect(url_for('index'))
 
 @app.route('/grant/<grant_id>/receipts')
+@conditional_grant_page()
+@cached_page()
 def view_receipts(grant_id):
     """ Displays receipts for specified grant in read-only format """
     # Ensure that grant_id was specified
@@ -2199,9 +2133,10 @@ def view_receipts(grant_id):
 @app.route('/hearings')
 @login_required
 @admin_required
+@query_budget(3)
 def hearings():
     """ An interface to view and schedule all pending hearings """
-    grants = Grant.query.filter(AND(Grant.hearing_requested==True,OR(Grant.hearing_occurred==False,Grant.hearing_occurred==None))).all()
+    grants = grant_query('hearings').filter_by(status=GrantStatus.HEARING).all()
     return render_template("hearings.html", grants=grants)
 
 @app.route('/request-hearing', methods=['POST'])
@@ -2227,8 +2162,8 @@ def request_hearing():
 @app.route('/expenses')
 def expenses():
     """ Lists all expenses in the current council's budget """
-    council_semester = Config.query.filter_by(key="council_semester").first()
-    council = council_semester.value[:2] if council_semester else None
+    council_semester = config_cache.get('council_semester')
+    council = council_semester[:2] if council_semester else None
     funds = Fund.query.filter_by(council=council).all()
     return render_template("expenses.html", funds=funds)
 
@@ -2276,17 +2211,24 @@ def add_budget():
 @app.route('/budget/<council>')
 def council_budget(council):
     """ Supplies the budget PDF file for a given council """
-    budget = Budget.query.filter_by(council=council).first()
-    if not budget:
-        flash("Budget does not exist", 'error')
-        return redirect(url_for("index"))
-    return send_from_directory(app.config['UPLOAD_FOLDER'], budget.file)
+    # Each council's budget is fixed once uploaded
+    return send_budget(council, upload_max_age)
 
 @app.route('/budget')
 def budget():
     """ Supplies the budget PDF file for the current given council """
     council = db.session.query(db.func.max(Budget.council)).scalar()
-    return council_budget(council)
+    # The current council changes, so this must always be revalidated
+    return send_budget(council)
+
+def send_budget(council, max_age=None):
+    """ Sends the budget PDF file for a given council, which browsers may use without
+        revalidating for max_age seconds (if given) """
+    budget = Budget.query.filter_by(council=council).first()
+    if not budget:
+        flash("Budget does not exist", 'error')
+        return redirect(url_for("index"))
+    return http_caching.send_upload(budget.file, max_age)
 
 @app.route('/expenses/manage')
 @login_required
@@ -2376,22 +2318,73 @@ def expense_legislation(id):
     if not expense.legislation_file:
         flash("Expense does not have attached legislation", 'error')
         return redirect(url_for("index"))
-    return send_from_directory(app.config['UPLOAD_FOLDER'], expense.legislation_file)
+    return http_caching.send_upload(expense.legislation_file, upload_max_age)
 
 @app.route('/export', methods=['GET','POST'])
 @login_required
 def export():
-    """ Export all Grants data as CSV """
-    fields = sorted(list(model_fields(Grant).keys()))
-    def generate():
-        # Write header
-        yield ','.join(fields) + '\n'
-        for grant in Grant.query.all():
-            for field in fields:
-                val = '\"' + str(getattr(grant,field)).replace('\n', ' ').replace('\r', '').replace('\"', '\"\"') + '\"' if getattr(grant,field) is not None else ""
-                yield val + ','
-            yield '\n'
-    return Response(stream_with_context(generate()), mimetype='text/csv')
+    """ Export Grants data, streamed in constant memory, as CSV (the default), NDJSON, Parquet
+        or an Arrow stream. Optionally takes a comma-separated list of columns, a from/to range
+        (YYYY-MM-DD) of application submission dates, and a since timestamp for incremental
+        exports (pass the previous export's X-Export-As-Of header). modified_since instead
+        exports the grants changed since a timestamp (see also /api/changes). Incremental
+        exports leave out the last change_feed_settle of submissions and changes, which the
+        next incremental export includes """
+    # Read the format
+    format = request.values.get('format', 'csv')
+    if format not in export_formats:
+        return "Unknown export format " + format + ".",400
+    if format in ('parquet', 'arrow') and pyarrow is None:
+        return "Exporting as " + format + " requires the pyarrow package to be installed.",501
+
+    # Read the columns to export (line items are exported as one summary column each)
+    fields = export_fields + grant_line_items
+    if request.values.get('columns'):
+        fields = [field.strip() for field in request.values['columns'].split(',')]
+        unknown = [field for field in fields if field not in export_fields and field not in grant_line_items]
+        if unknown:
+            return "Unknown export column(s): " + ', '.join(unknown),400
+
+    # Read the date range, which includes the whole of the 'to' day. Incremental exports are of
+    # the data as of change_feed_settle ago: submissions and changes are stamped before they
+    # commit, so a later export starting from this one's as_of still sees those which commit after it
+    as_of = datetime.utcnow()
+    if request.values.get('since') or request.values.get('modified_since'):
+        as_of -= change_feed_settle
+    criteria = []
+    try:
+        if request.values.get('from'):
+            criteria.append(Grant.application_submit_time >= datetime.strptime(request.values['from'], "%Y-%m-%d"))
+        if request.values.get('to'):
+            criteria.append(Grant.application_submit_time < datetime.strptime(request.values['to'], "%Y-%m-%d") + timedelta(days=1))
+    except ValueError:
+        return "Dates must be formatted YYYY-MM-DD.",400
+    try:
+        if request.values.get('since'):
+            criteria.append(Grant.application_submit_time >= datetime.fromisoformat(request.values['since']))
+        if request.values.get('modified_since'):
+            criteria.append(Grant.updated_at >= datetime.fromisoformat(request.values['modified_since']))
+            # Grants changed from then on belong to the next incremental export
+            criteria.append(Grant.updated_at < as_of)
+    except ValueError:
+        return "Since must be an ISO 8601 timestamp (e.g. 2017-09-01T12:00:00).",400
+    # Grants submitted from as_of on belong to the next incremental export
+    criteria.append(OR(Grant.application_submit_time < as_of, Grant.application_submit_time == None))
+
+    mimetype, extension = export_formats[format]
+    headers = {'Vary': 'Accept-Encoding', 'X-Export-As-Of': as_of.isoformat(),
+               'Content-Disposition': 'attachment; filename=grants.' + extension}
+    if format == 'csv':
+        chunks = export_csv(fields, *criteria)
+    elif format == 'ndjson':
+        chunks = export_ndjson(fields, *criteria)
+    else:
+        # (Parquet is compressed already, so these are not gzipped)
+        chunks = export_arrow(fields, format, *criteria)
+    if format in ('csv', 'ndjson') and 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
 @app.route('/expenses/<id>/edit', methods=['GET','POST'])
 @login_required
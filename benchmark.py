@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+#
+# benchmark.py
+#
+# Contains a script that times NOVA's busiest pages against
+# databases of growing size. A scratch SQLite database is seeded
+# with random grants (from the dummy_data generators) directly
+# through the models, the pages are requested through Flask's test
+# client, and the timings are written to a JSON report which can be
+# compared against an earlier report to catch regressions.
+#
+# Checks can also be run against the seeded database at each size:
+# that every dashboard query is answered from an index, that no view
+# runs more SQL statements than its query_budget, how much time and
+# memory loading grants takes with and without column profiles, and
+# how long moving grants into and out of a grants pack takes.
+#
+# Example usage: `python3 benchmark.py --sizes 1000 10000 --output report.json`
+#                `python3 benchmark.py --sizes 100000 --endpoints --checks query_plans query_budgets`
+#                `python3 benchmark.py --sizes 50000 --endpoints --checks hydration`
+#
+
+import argparse
+import json
+import tracemalloc
+from os import environ, remove, makedirs
+from os.path import exists, getsize, abspath, dirname
+from sys import exit, version
+from random import seed, random, choice, randrange, uniform
+from datetime import datetime, timedelta
+from time import perf_counter
+from statistics import median
+from urllib.parse import quote
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from database_models import db, Config, Grants_Week, Grant, Organization, GrantRevenue, GrantApplicationExpense, GrantReceiptLine, allocation_categories, grant_profiles
+import project_search # (creates the project search index alongside the grant table)
+from dummy_data import clubs, rand_club, rand_dollar, rand_bool, rand_sentence, rand_phrase, rand_word, rand_name, rand_phone, rand_date, rand_revenue, rand_expense, new_grant_query_string, receipts_query_string, security_key
+
+# Grants in each week's grants pack
+grants_per_pack = 50
+# Council semester used for the benchmark's Grant IDs
+council_semester = '35F'
+# Credentials of the benchmark's administrator account
+admin_email = 'benchmark@nova.local'
+admin_password = 'benchmark'
+
+# Fewest bytes per seeded grant a full export may stream (a grant's row is about a kilobyte)
+export_row_bytes = 200
+# Every endpoint that can be timed, in report order
+endpoint_names = ['new_grant', 'receipts', 'grant', 'treasurer', 'export', 'grants_pack_cuts', 'search_projects', 'grants_lookup']
+# Every check that can be run against the seeded database, in report order
+check_names = ['query_plans', 'query_budgets', 'hydration', 'pack_membership']
+
+def install(uri, weeks):
+    """ Creates the scratch database's tables and the configuration the app reads when
+        it is imported. Uses a plain engine, since the app cannot be imported before this """
+    engine = create_engine(uri)
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        for key, value in [('security_key', security_key), ('council_semester', council_semester), ('grant_week', str(weeks)),
+                           ('default_budget', '10000'), ('enable_email', '0'), ('server_name', 'localhost'),
+                           ('grants_email_username', 'grants@nova.local'), ('grants_email_password', ''),
+                           ('treasurer_email_username', 'treasurer@nova.local'), ('treasurer_email_password', ''),
+                           ('treasurer_name', 'Benchmark Treasurer')]:
+            session.add(Config(key, value))
+        session.commit()
+    engine.dispose()
+
+def line_items(model, count, type_generator=None, max_amt=1200.00):
+    """ Returns count random line items of the given model (receipt lines have no type) """
+    lines = []
+    for i in range(1, count + 1):
+        fields = {'description': rand_sentence(), 'amount': float(rand_dollar(max_amt))}
+        if type_generator:
+            fields['type'] = type_generator()
+        lines.append(model(i, **fields))
+    return lines
+
+def random_grant(number):
+    """ Returns the number-th benchmark grant (counting from 0), filled in by the dummy_data
+        generators and moved to a random stage of its lifecycle """
+    week = number // grants_per_pack + 1
+    grant = Grant(council_semester + '-' + str(week) + '-' + str(number % grants_per_pack + 1))
+    grant.is_small_grant = random() < 0.3
+    grant.is_upfront = rand_bool()
+    grant.amount_requested = float(rand_dollar(200.00 if grant.is_small_grant else 1200.00))
+    grant.is_collaboration = rand_bool()
+    if grant.is_collaboration:
+        grant.collaborators = rand_club()
+        grant.collaboration_explanation = rand_sentence()
+    grant.contact_first_name = rand_name()
+    grant.contact_last_name = rand_name()
+    grant.contact_email = 'benchmark@nova.local'
+    grant.contact_phone = rand_phone()
+    grant.contact_role = rand_word()
+    grant.organization = rand_club()
+    grant.project = rand_phrase()
+    grant.project_description = rand_sentence() + " " + rand_sentence()
+    grant.is_event = rand_bool()
+    grant.project_location = rand_word()
+    grant.project_start = grant.project_end = datetime.strptime(rand_date(), "%m/%d/%Y")
+    grant.college_attendees = randrange(1, 200)
+    grant.facebook_link = "facebook.com/" + rand_word()
+    grant.application_comments = rand_sentence()
+    # Submitted well before the benchmark, like the rest of an archive
+    grant.application_submit_time = datetime.utcnow() - timedelta(days=randrange(60, 400), seconds=randrange(86400))
+    grant.revenues = line_items(GrantRevenue, randrange(1, 4), rand_revenue)
+    grant.app_expenses = line_items(GrantApplicationExpense, randrange(1, 5), lambda: rand_expense(grant.is_small_grant))
+
+    # Stages: 0 submitted, 1 interviewed, 2 docketed in a pack, 3 approved, 4 paid,
+    # 5 receipts submitted, 6 receipts reviewed
+    stage = choice([0, 1, 2, 3, 3, 4, 4, 5, 5, 6, 6, 6])
+    now = datetime.now()
+    if stage == 0 and not grant.is_small_grant and rand_bool():
+        grant.interview_schedule_date = now + timedelta(days=randrange(1, 14))
+    if stage >= 1:
+        grant.interview_occurred = not grant.is_small_grant
+        grant.small_grant_is_reviewed = grant.is_small_grant
+        for category in allocation_categories[:randrange(1, 4)]:
+            setattr(grant, category + '_allocated', float(rand_dollar(grant.amount_requested / 2)))
+            setattr(grant, category + '_allocated_notes', rand_sentence())
+    if stage >= 2:
+        grant.grants_pack = council_semester + '-' + str(week)
+    if stage >= 3:
+        grant.council_approved = True
+        grant.percentage_cut = round(uniform(0, 20), 2)
+        grant.amount_allocated = round(sum(getattr(grant, category + '_allocated') or 0.0 for category in allocation_categories) * (100 - grant.percentage_cut) / 100, 2)
+        grant.receipts_due = now + timedelta(days=randrange(-60, 60))
+    if stage >= 4 and grant.is_upfront:
+        grant.is_paid = True
+        grant.pay_date = now - timedelta(days=randrange(1, 60))
+        grant.is_direct_deposit = rand_bool()
+        grant.amount_dispensed = grant.amount_allocated
+    if stage >= 5:
+        grant.receipts_submitted = True
+        grant.receipts_submit_date = now - timedelta(days=randrange(1, 30))
+        grant.receipt_images = ", ".join(str(randrange(1000, 10000)) + ".jpg" for i in range(randrange(1, 4)))
+        grant.receipt_lines = line_items(GrantReceiptLine, randrange(1, 4), max_amt=300.00)
+    if stage >= 6:
+        grant.receipts_reviewed = grant.is_upfront
+        grant.is_paid = True
+        if grant.is_upfront and random() < 0.2:
+            grant.must_reimburse_uc = True
+            grant.reimburse_uc_amount = float(rand_dollar(50.00))
+            grant.reimbursed_uc = rand_bool()
+    if random() < 0.02:
+        grant.hearing_requested = True
+    return grant
+
+def grow(app, start, stop, batch=1000):
+    """ Adds grants start to stop-1 (and their grants weeks) through the ORM, so the
+        status and standing listeners run just as they do for real submissions """
+    with app.app_context():
+        for first in range(start, stop, batch):
+            last = min(first + batch, stop)
+            for number in range(first, last):
+                if number == first or number % grants_per_pack == 0:
+                    name = council_semester + '-' + str(number // grants_per_pack + 1)
+                    grants_week = db.session.get(Grants_Week, name)
+                    if grants_week is None:
+                        grants_week = Grants_Week(name)
+                        db.session.add(grants_week)
+                grants_week.num_grants = number % grants_per_pack + 1
+                db.session.add(random_grant(number))
+            db.session.commit()
+            db.session.expunge_all()
+        # The change feed stamps each grant as changed at seeding; backdate them to their
+        # submission (a bulk update, with the value given, so that onupdate leaves it be)
+        Grant.query.update({Grant.updated_at: Grant.application_submit_time}, synchronize_session=False)
+        # Every grants pack but the current one has been voted on
+        weeks = (stop - 1) // grants_per_pack + 1
+        Grants_Week.query.filter(Grants_Week.grant_week != council_semester + '-' + str(weeks)) \
+            .update({Grants_Week.grants_pack_finalized: True}, synchronize_session=False)
+        # (through the ORM, so that the config cache sees the new week)
+        Config.query.filter_by(key='grant_week').first().value = str(weeks)
+        db.session.commit()
+
+def percentile(timings, fraction):
+    """ Returns the timing below which the given fraction of the sorted timings fall """
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))]
+
+def check_status(path, response):
+    """ Exits if a request failed, since its timing would not be of the page """
+    if response.status_code >= 400:
+        exit("Fatal: GET " + path.split('?')[0] + " returned HTTP " + str(response.status_code))
+
+def check_export(grants, timing):
+    """ Exits if the export streamed too little to hold every seeded grant, since its
+        timing would not be of the whole archive """
+    if timing['bytes'] < grants * export_row_bytes:
+        exit("Fatal: GET /export returned " + str(timing['bytes']) + " bytes for " + str(grants) + " grants")
+
+def time_endpoint(app, client, paths, repeat, request_metrics):
+    """ Requests each of the paths (one per repetition, after an untimed warm up request)
+        and returns the endpoint's timings in milliseconds. Exits if any request fails """
+    # request_metrics keeps its totals under the name of the view
+    key = (app.url_map.bind('localhost').match(paths[0].split('?')[0])[0], 'GET')
+    check_status(paths[0], client.get(paths[0]))
+    before = request_metrics.endpoints.get(key)
+    before = (before.count, before.sql_statements, before.sql_seconds, before.template_seconds) if before else (0, 0, 0.0, 0.0)
+    timings = []
+    for path in paths[1:repeat + 1]:
+        start = perf_counter()
+        response = client.get(path)
+        size = len(response.get_data())
+        timings.append((perf_counter() - start) * 1000)
+        check_status(path, response)
+    metrics = request_metrics.endpoints[key]
+    count = metrics.count - before[0]
+    timings.sort()
+    return {
+        'path': paths[1].split('?')[0],
+        'status': response.status_code,
+        'bytes': size,
+        'requests': len(timings),
+        'min_ms': round(timings[0], 2),
+        'median_ms': round(median(timings), 2),
+        'p95_ms': round(percentile(timings, 0.95), 2),
+        'max_ms': round(timings[-1], 2),
+        'sql_statements': round((metrics.sql_statements - before[1]) / count, 1),
+        'sql_ms': round((metrics.sql_seconds - before[2]) / count * 1000, 2),
+        'template_ms': round((metrics.template_seconds - before[3]) / count * 1000, 2),
+    }
+
+def endpoint_paths(app, name, count):
+    """ Returns count paths to request from the named endpoint """
+    if name == 'new_grant':
+        return ['/new_grant?' + new_grant_query_string('benchmark@nova.local', rand_bool())[1] for i in range(count)]
+    if name == 'search_projects':
+        # Each keystroke of typing project names into the search page
+        keystrokes = []
+        while len(keystrokes) < count:
+            phrase = rand_phrase()
+            keystrokes += [phrase[:i] for i in range(1, len(phrase) + 1)]
+        return ['/search/projects?k=' + security_key + '&query=' + quote(keystroke) for keystroke in keystrokes[:count]]
+    if name == 'grants_lookup':
+        # The first page of each organization's grants
+        return ['/api/grants/lookup?k=' + security_key + '&query=' + quote(rand_club()) for i in range(count)]
+    with app.app_context():
+        if name == 'receipts':
+            # Each submission needs a grant which is still waiting for receipts
+            grant_ids = [row.grant_id for row in db.session.query(Grant.grant_id).filter_by(council_approved=True, receipts_submitted=False).limit(count)]
+            if len(grant_ids) < count:
+                exit("Fatal: Not enough approved grants to submit receipts for")
+            return ['/receipts?' + receipts_query_string(grant_id) for grant_id in grant_ids]
+        if name == 'grant':
+            total = db.session.query(db.func.max(Grant.id)).scalar()
+            grant_ids = [db.session.get(Grant, randrange(1, total + 1)).grant_id for i in range(count)]
+            return ['/grant/' + grant_id for grant_id in grant_ids]
+    path = {'treasurer': '/treasurer', 'export': '/export', 'grants_pack_cuts': '/grants-pack/cuts'}[name]
+    return [path] * count
+
+def query_plan(statement):
+    """ Returns the steps of SQLite's plan for the statement """
+    compiled = statement.compile(db.engine, compile_kwargs={'render_postcompile': True})
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [row[3] for row in db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), parameters)]
+
+def dashboard_queries():
+    """ Returns the dashboards' grant queries (with the same filters as the views and the
+        scheduled emails), each with the index it must be answered from """
+    from grant_status import GrantStatus
+    from helpers import treasurer_dashboard_statuses
+    from organization_standing import overdue_receipts_query
+    now = datetime.now()
+    return [
+        # organizations_in_bad_standing() and add_overdue_receipts()
+        ('overdue_receipts', overdue_receipts_query(now), 'ix_grant_status'),
+        # review_receipts()
+        ('treasurer', db.session.query(Grant.id).filter(Grant.status.in_(treasurer_dashboard_statuses)), 'ix_grant_status'),
+        # owed_money() and send_owe_money_emails()
+        ('owed_money_no_receipts', Grant.query.filter(Grant.status==GrantStatus.PAID, Grant.receipts_due < now, Grant.amount_dispensed>0), 'ix_grant_status'),
+        ('owed_money_unspent', Grant.query.filter_by(status=GrantStatus.OWES_MONEY), 'ix_grant_status'),
+        # hearings()
+        ('hearings', Grant.query.filter_by(status=GrantStatus.HEARING), 'ix_grant_status'),
+        # receipts_reminder() and send_receipt_reminder_emails()
+        ('receipts_reminder', Grant.query.filter(db.and_(db.and_(Grant.receipts_submitted==False, Grant.council_approved==True), Grant.amount_allocated>0)), 'ix_grant_receipts_outstanding'),
+    ]
+
+def check_query_plans(app):
+    """ Checks that SQLite answers each dashboard query from its index rather than by
+        scanning the grant table. Returns each query's plan, and exits if any does not
+        use its index """
+    plans = {}
+    with app.app_context():
+        for name, query, index in dashboard_queries():
+            plan = query_plan(getattr(query, 'statement', query))
+            plans[name] = plan
+            print("  " + name.ljust(24) + "; ".join(plan))
+            if not any(('INDEX ' + index + ' ') in (step + ' ') for step in plan):
+                exit("Fatal: The " + name + " query does not use " + index + ": " + "; ".join(plan))
+    return plans
+
+def logged_in_client(app):
+    """ Returns a test client logged in as the benchmark's administrator """
+    client = app.test_client()
+    client.post('/login', data={'email': admin_email, 'password': admin_password})
+    with client.session_transaction() as session:
+        if '_user_id' not in session:
+            exit("Fatal: Could not log in as " + admin_email)
+    return client
+
+def budget_requests(app):
+    """ Returns the (method, path, data) of the requests to make to every view with a
+        query_budget: a GET of each page, and a POST of each batch form covering a whole
+        grants pack or week of interviews """
+    requests = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if hasattr(app.view_functions[rule.endpoint], 'query_budget') and not rule.arguments:
+            requests.append(('GET', rule.rule, None))
+    with app.app_context():
+        grants_pack = council_semester + '-' + Config.query.filter_by(key='grant_week').first().value
+        pack = db.session.query(Grant.grant_id, Grant.percentage_cut).filter_by(grants_pack=grants_pack).all()
+        interviews = db.session.query(Grant.grant_id).filter_by(interview_occurred=False, is_small_grant=False).limit(grants_per_pack).all()
+    requests.append(('POST', '/grants-pack/edit', {'json': {'grants_pack': grants_pack, 'grants': [{'grant_id': grant.grant_id, 'selected': True} for grant in pack]}}))
+    schedule = dict(('grant:' + grant.grant_id, str(9 + i % 8) + ':' + str(i % 4 * 15)) for i, grant in enumerate(interviews))
+    schedule['date'] = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
+    requests.append(('POST', '/schedule', {'data': schedule}))
+    # (last, since it moves the app on to the next grants pack)
+    cuts = dict((grant.grant_id, str(grant.percentage_cut or 0.0)) for grant in pack)
+    cuts['grants_pack'] = grants_pack
+    requests.append(('POST', '/grants-pack/cuts', {'data': cuts}))
+    return requests
+
+def check_query_budgets(app):
+    """ Makes a request to every view with a query_budget, failing any view which runs
+        more queries than its budget. Returns the queries each request ran (counting
+        those of logging in), and exits if any view went over its budget """
+    from flask import g
+    from helpers import QueryBudgetExceeded
+    app.config['ENFORCE_QUERY_BUDGETS'] = True
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    queries = {}
+    failures = []
+    # (the with block keeps each request's g, holding its request_metrics counts, until the next)
+    with logged_in_client(app) as client:
+        for method, path, data in budget_requests(app):
+            try:
+                response = client.open(path, method=method, **(data or {}))
+            except QueryBudgetExceeded as error:
+                failures.append(method + " " + path + ": " + str(error))
+                continue
+            check_status(path, response)
+            queries[method + ' ' + path] = g.sql_selects
+            print("  " + (method + " " + path).ljust(24) + str(g.sql_selects).rjust(4) + " queries")
+    app.config['ENFORCE_QUERY_BUDGETS'] = False
+    app.config['PROPAGATE_EXCEPTIONS'] = None
+    for failure in failures:
+        print("Over budget: " + failure)
+    if failures:
+        exit("Fatal: " + str(len(failures)) + " view(s) ran more queries than their query budget")
+    return queries
+
+def hydrate(query, repeat=3):
+    """ Loads every row of the query into a fresh session. Returns the number of rows, the
+        fastest load time in milliseconds, and the peak memory allocated while loading (in
+        kilobytes, measured in a separate load, since tracing allocations slows it down) """
+    timings = []
+    for i in range(repeat + 1):
+        db.session.expunge_all()
+        if i == repeat:
+            tracemalloc.start()
+        start = perf_counter()
+        rows = query.all()
+        timings.append((perf_counter() - start) * 1000)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    count = len(rows)
+    del rows
+    db.session.expunge_all()
+    return count, round(min(timings[:repeat]), 2), round(peak / 1024)
+
+def check_hydration(app):
+    """ Loads every grant as full Grant objects and as each dashboard's column profile
+        (the treasurer dashboard's as plain rows), and returns the time and memory each takes """
+    from helpers import grant_query
+    results = {}
+    with app.app_context():
+        grants, full_ms, full_kb = hydrate(Grant.query)
+        print("  " + "all columns".ljust(20) + str(full_ms).rjust(10) + " ms " + str(full_kb).rjust(10) + " KB for " + str(grants) + " grants")
+        results['all_columns'] = {'ms': full_ms, 'kb': full_kb}
+        for profile in ['interviews', 'small_grants', 'hearings', 'owed_money', 'grants_pack_edit', 'treasurer_dashboard']:
+            if profile == 'treasurer_dashboard':
+                query = db.session.query(*[getattr(Grant, column) for column in grant_profiles[profile]])
+            else:
+                query = grant_query(profile)
+            grants, ms, kb = hydrate(query)
+            results[profile] = {'ms': ms, 'kb': kb}
+            print("  " + profile.ljust(20) + str(ms).rjust(10) + " ms " + str(kb).rjust(10) + " KB ("
+                  + str(round(100.0 * ms / full_ms)) + "% of the time, " + str(round(100.0 * kb / full_kb)) + "% of the memory)")
+    return results
+
+def update_membership_per_row(grants_pack, grants):
+    """ Moves grants into and out of grants_pack as the grants pack edit page used to, with
+        an UPDATE and a commit for each grant """
+    for grant in grants:
+        Grant.query.filter(Grant.grant_id==grant['grant_id']).update({'grants_pack': grants_pack if grant['selected'] else None})
+        db.session.commit()
+
+def check_pack_membership(app, count=100, repeat=5):
+    """ Times moving count grants which are in no grants pack into the current pack and
+        back out again, one grant at a time and with update_grants_pack_membership. Returns
+        the median milliseconds each way takes to move them in and out, and exits if any
+        grant was left in the pack """
+    from helpers import update_grants_pack_membership
+    results = {}
+    with app.app_context():
+        grants_pack = council_semester + '-' + Config.query.filter_by(key='grant_week').first().value
+        grant_ids = [grant_id for (grant_id,) in db.session.query(Grant.grant_id).filter_by(grants_pack=None).limit(count)]
+        for name, update in [('per_row', update_membership_per_row), ('set_based', update_grants_pack_membership)]:
+            timings = []
+            for i in range(repeat):
+                start = perf_counter()
+                for selected in (True, False):
+                    update(grants_pack, [{'grant_id': grant_id, 'selected': selected} for grant_id in grant_ids])
+                timings.append((perf_counter() - start) * 1000)
+            results[name] = round(median(timings), 2)
+        if db.session.query(Grant.id).filter(Grant.grant_id.in_(grant_ids), Grant.grants_pack != None).count():
+            exit("Fatal: Grants were left in " + grants_pack)
+    print("  " + str(len(grant_ids)) + " grants in and out: " + str(results['per_row']) + " ms one at a time, "
+          + str(results['set_based']) + " ms set-based (" + str(round(results['per_row'] / results['set_based'], 1)) + "x faster)")
+    results['grants'] = len(grant_ids)
+    return results
+
+def run(sizes, repeat, endpoints, database, checks=()):
+    """ Seeds the database up to each size in turn, and times the endpoints and runs the
+        checks at each size. Returns the report """
+    uri = 'sqlite:///' + abspath(database)
+    if exists(database):
+        remove(database)
+    makedirs(dirname(abspath(database)), exist_ok=True)
+    install(uri, 1)
+    # The app binds its database when it is imported, and must not start its scheduled jobs
+    environ['NOVA_DATABASE_URI'] = uri
+    environ['NOVA_DISABLE_SCHEDULER'] = '1'
+    from application import app, request_metrics
+    from helpers import create_user
+    with app.app_context():
+        user = create_user(admin_email, 'Benchmark', 'Admin', admin_password, True)
+        user.treasurer = True
+        user.force_pw_update = False
+        db.session.add(user)
+        db.session.add_all(Organization(name) for name in sorted(set(clubs)))
+        db.session.commit()
+
+    report = {'generated': datetime.now().isoformat(), 'python': version.split()[0], 'repeat': repeat, 'sizes': []}
+    seeded = 0
+    for size in sorted(sizes):
+        start = perf_counter()
+        grow(app, seeded, size)
+        seeded = size
+        result = {'grants': size, 'seed_seconds': round(perf_counter() - start, 2), 'database_bytes': getsize(database), 'endpoints': {}, 'checks': {}}
+        print("Seeded " + str(size) + " grants in " + str(result['seed_seconds']) + "s")
+
+        client = logged_in_client(app)
+        for name in endpoints:
+            timing = time_endpoint(app, client, endpoint_paths(app, name, repeat + 1), repeat, request_metrics)
+            result['endpoints'][name] = timing
+            if name == 'export':
+                check_export(size, timing)
+            print("  " + name.ljust(18) + str(timing['median_ms']).rjust(10) + " ms median, " + str(timing['p95_ms']).rjust(10)
+                  + " ms p95, " + str(timing['sql_statements']) + " statements, HTTP " + str(timing['status']))
+        for name in checks:
+            print("  Checking " + name)
+            result['checks'][name] = {'query_plans': check_query_plans, 'query_budgets': check_query_budgets, 'hydration': check_hydration,
+                                      'pack_membership': check_pack_membership}[name](app)
+        report['sizes'].append(result)
+    return report
+
+def regressions(report, baseline, tolerance, floor):
+    """ Returns a description of each endpoint whose median time is more than tolerance
+        (a fraction) and floor milliseconds slower than in the baseline report """
+    found = []
+    old_sizes = dict((size['grants'], size) for size in baseline['sizes'])
+    for size in report['sizes']:
+        old_size = old_sizes.get(size['grants'])
+        if not old_size:
+            continue
+        for name, timing in size['endpoints'].items():
+            old = old_size['endpoints'].get(name)
+            if old and timing['median_ms'] > old['median_ms'] * (1 + tolerance) and timing['median_ms'] - old['median_ms'] > floor:
+                found.append(name + " at " + str(size['grants']) + " grants: " + str(old['median_ms']) + " ms -> " + str(timing['median_ms']) + " ms")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Times NOVA's key pages against seeded databases of growing size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="numbers of grants to seed (default: 1000 10000 100000)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed requests per endpoint at each size (default: 5)")
+    parser.add_argument('--endpoints', nargs='*', choices=endpoint_names, default=endpoint_names, help="endpoints to time (default: all)")
+    parser.add_argument('--checks', nargs='*', choices=check_names, default=[], help="checks to run against the seeded database at each size (default: none)")
+    parser.add_argument('--database', default='instance/benchmark.db', help="scratch database file, replaced on every run (default: instance/benchmark.db)")
+    parser.add_argument('--output', default='instance/benchmark.json', help="file to write the JSON report to (default: instance/benchmark.json)")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against; exits with an error if any endpoint regressed")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="fraction a median may slow down by before it counts as a regression (default: 0.25)")
+    parser.add_argument('--floor', type=float, default=5.0, help="milliseconds a median may slow down by regardless of tolerance (default: 5)")
+    args = parser.parse_args()
+
+    seed(0)
+    report = run(args.sizes, args.repeat, args.endpoints, args.database, args.checks)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Report written to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance, args.floor)
+        for regression in found:
+            print("Regression: " + regression)
+        if found:
+            exit("Fatal: " + str(len(found)) + " endpoint(s) slower than the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#
+# change_feed.py
+#
+# Keeps Grant, Organization and Expense updated_at columns current
+# and pages through the grants changed since a cursor, so that
+# integrations can pull just what has changed instead of exporting
+# the whole archive.
+#
+
+from datetime import datetime, timedelta
+from sqlalchemy import event, select, or_, and_
+from database_models import db, Grant, Organization, Expense, GrantRevenue, GrantApplicationExpense, GrantReceiptLine
+from grant_export import export_fields
+
+# Models whose rows record when they last changed
+tracked_models = (Grant, Organization, Expense)
+# Models whose changes count as changes to their grant
+line_item_models = (GrantRevenue, GrantApplicationExpense, GrantReceiptLine)
+
+# Changes are only listed once they are this old. A save stamps updated_at before it waits
+# for the SQLite write lock (for up to 30 seconds), so a change can commit after a later
+# stamped one; waiting until every save stamped before the cursor has committed means a
+# cursor never skips past a change
+change_feed_settle = timedelta(seconds=60)
+
+@event.listens_for(db.session, 'before_flush')
+def update_timestamps(session, flush_context, instances):
+    """ Stamps every new or modified Grant, Organization and Expense, and every grant whose
+        line items were added, changed or removed. (Bulk UPDATE statements skip this, and
+        are stamped by the columns' onupdate instead) """
+    now = datetime.utcnow()
+    with session.no_autoflush:
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, line_item_models):
+                grant = obj.grant
+                if grant is None and obj.grant_pk is not None:
+                    # Removed from its grant's collection
+                    grant = session.get(Grant, obj.grant_pk)
+                if grant is not None and grant not in session.deleted:
+                    grant.updated_at = now
+            elif isinstance(obj, tracked_models) and obj not in session.deleted and session.is_modified(obj):
+                obj.updated_at = now
+
+def encode_cursor(updated_at, grant_pk):
+    """ Returns the cursor which follows the grant with the given updated_at and primary key """
+    return updated_at.isoformat() + '_' + str(grant_pk)
+
+def decode_cursor(cursor):
+    """ Returns the (updated_at, grant primary key) of a cursor. A bare ISO 8601 timestamp
+        is also accepted, starting from the changes made at that time. Raises ValueError if
+        the cursor is invalid """
+    if '_' in cursor:
+        updated_at, grant_pk = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(updated_at), int(grant_pk)
+    return datetime.fromisoformat(cursor), 0
+
+def change_value(value):
+    """ Formats a value for the JSON change feed """
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def grant_changes(cursor=None, limit=500, fields=export_fields):
+    """ Returns (changes, next cursor, whether there are more changes) for the grants changed
+        after the cursor (or every grant, if there is no cursor), oldest change first. Each
+        change is a dict of the grant's fields as they are now. Grants are never deleted, so
+        there are no deletions to list """
+    columns = [Grant.id, Grant.updated_at] + [getattr(Grant, field) for field in fields]
+    query = select(*columns).where(Grant.updated_at < datetime.utcnow() - change_feed_settle)
+    if cursor:
+        updated_at, grant_pk = decode_cursor(cursor)
+        query = query.where(or_(Grant.updated_at > updated_at, and_(Grant.updated_at == updated_at, Grant.id > grant_pk)))
+    rows = db.session.execute(query.order_by(Grant.updated_at, Grant.id).limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    changes = [dict((field, change_value(value)) for field, value in zip(fields, row[2:])) for row in rows]
+    if rows:
+        cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    return changes, cursor, more
@@ -0,0 +1,140 @@
+#
+# cuts.py
+#
+# Contains the engine which works out funding cuts for a grants pack.
+# A pack's allocations are loaded once into a matrix of grants by
+# allocation category, and a cut policy then turns the matrix and the
+# pack's budget into the fraction cut from each grant.
+#
+
+from collections import namedtuple
+from sqlalchemy import update, bindparam
+from database_models import db, Grant, allocation_categories
+from organization_standing import apply_standing_deltas
+
+allocation_columns = [category + '_allocated' for category in allocation_categories]
+
+# Grant columns loaded alongside the allocations
+CutGrant = namedtuple('CutGrant', ['id', 'grant_id', 'organization', 'project', 'is_collaboration_confirmed',
+                                   'amount_requested', 'amount_allocated'])
+
+# Default tiers for the tiered policy: (dollars above which the rate applies, cut rate)
+default_cut_tiers = [(0, 1.0), (500, 1.5), (1000, 2.0)]
+
+class AllocationMatrix(object):
+    """ The allocations of a set of grants, one row per grant and one column per allocation
+        category, loaded in a single query """
+
+    def __init__(self, grants, rows):
+        self.grants = grants
+        self.rows = rows
+        self.totals = [sum(row) for row in rows]
+        self.immune = [bool(grant.is_collaboration_confirmed) for grant in grants]
+
+    @classmethod
+    def load(cls, *criteria):
+        """ Loads the grants matching the given filter criteria, in grant order """
+        columns = [getattr(Grant, column) for column in CutGrant._fields + tuple(allocation_columns)]
+        grants, rows = [], []
+        for row in db.session.query(*columns).filter(*criteria).order_by(Grant.id):
+            grants.append(CutGrant(*row[:len(CutGrant._fields)]))
+            rows.append([value or 0.0 for value in row[len(CutGrant._fields):]])
+        return cls(grants, rows)
+
+    @property
+    def allocated(self):
+        return sum(self.totals)
+
+    @property
+    def cut_immune(self):
+        return sum(total for total, immune in zip(self.totals, self.immune) if immune)
+
+    def capped_totals(self, caps):
+        """ Returns each grant's total with the given {category: maximum} caps applied to
+            every grant which is not immune from cuts """
+        limits = [caps.get(category) for category in allocation_categories]
+        totals = []
+        for row, total, immune in zip(self.rows, self.totals, self.immune):
+            if immune or not caps:
+                totals.append(total)
+            else:
+                totals.append(sum(value if limit is None else min(value, limit) for value, limit in zip(row, limits)))
+        return totals
+
+def solve_cut(needed, cut_at, high):
+    """ Returns the rate in [0,high] at which cut_at(rate), the total cut, reaches needed.
+        cut_at must never decrease as the rate rises """
+    if cut_at(high) <= needed:
+        return high
+    low = 0.0
+    for i in range(60):
+        middle = (low + high) / 2
+        if cut_at(middle) < needed:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def proportional_cuts(totals, immune, needed):
+    """ Cuts the same percentage from every grant """
+    deductable = sum(total for total, is_immune in zip(totals, immune) if not is_immune)
+    cut = min(1.0, needed / deductable) if deductable else 0.0
+    return [cut for total in totals]
+
+def flat_cuts(totals, immune, needed):
+    """ Cuts the same dollar amount from every grant, or all of a grant if it is smaller """
+    cut_at = lambda amount: sum(min(total, amount) for total, is_immune in zip(totals, immune) if not is_immune)
+    amount = solve_cut(needed, cut_at, max(totals or [0.0]))
+    return [min(total, amount) / total if total else 0.0 for total in totals]
+
+def tier_weight(total, tiers):
+    """ Returns a grant's total with each dollar weighted by the rate of its tier """
+    bounds = [tier[0] for tier in tiers[1:]] + [float('inf')]
+    return sum(max(0.0, min(total, upper) - lower) * rate for (lower, rate), upper in zip(tiers, bounds))
+
+def tiered_cuts(totals, immune, needed, tiers=default_cut_tiers):
+    """ Cuts larger grants by a larger percentage, cutting each dollar at the rate of its tier """
+    weights = [tier_weight(total, tiers) for total in totals]
+    cut_at = lambda rate: sum(min(total, rate * weight) for total, weight, is_immune in zip(totals, weights, immune) if not is_immune)
+    rate = solve_cut(needed, cut_at, 1.0 / min(rate for lower, rate in tiers))
+    return [min(total, rate * weight) / total if total else 0.0 for total, weight in zip(totals, weights)]
+
+cut_policies = {
+    'proportional' : proportional_cuts,
+    'flat' : flat_cuts,
+    'tiered' : tiered_cuts,
+}
+
+def recommend_cuts(matrix, budget, policy='proportional', caps=None):
+    """ Returns the fraction of each grant in the matrix to cut so that the grants fit within
+        the budget. Caps on categories are applied first, then the policy cuts what is still
+        over budget. Grants immune from cuts are never cut """
+    totals = matrix.capped_totals(caps or {})
+    needed = sum(totals) - budget
+    cuts = cut_policies[policy](totals, matrix.immune, needed) if needed > 0 else [0.0] * len(totals)
+    fractions = []
+    for total, capped, cut, immune in zip(matrix.totals, totals, cuts, matrix.immune):
+        if immune or not total:
+            fractions.append(0.0)
+        else:
+            fractions.append(1.0 - capped * (1.0 - cut) / total)
+    return fractions
+
+def save_cuts(matrix, percentage_cuts):
+    """ Saves each grant's percentage cut (out of 100) and final amount allocated with one
+        bulk UPDATE, and returns the total allocated. The bulk UPDATE skips the flush
+        listeners, so the organizations' allocated totals are adjusted here """
+    values = []
+    deltas = {}
+    for grant, total, cut in zip(matrix.grants, matrix.totals, percentage_cuts):
+        amount = round((100 - cut) / 100 * total, 2)
+        values.append({'grant_pk': grant.id, 'percentage_cut': cut, 'amount_allocated': amount})
+        if grant.organization is not None:
+            delta = deltas.setdefault(grant.organization, {'amount_allocated': 0.0})
+            delta['amount_allocated'] += amount - (grant.amount_allocated or 0.0)
+    if values:
+        statement = update(Grant.__table__).where(Grant.__table__.c.id == bindparam('grant_pk')) \
+            .values(percentage_cut=bindparam('percentage_cut'), amount_allocated=bindparam('amount_allocated'))
+        db.session.execute(statement, values)
+        apply_standing_deltas(db.session, deltas)
+    return sum(value['amount_allocated'] for value in values)
@@ -20,6 +20,8 @@ db = SQLAlchemy()
 small_grant_cap = 200.00
 # Set small grant elligible funding categories
 small_grant_expense_types = ['Food', 'Publicity']
+# Grant relationships which hold line items rather than columns
+grant_line_items = ['revenues', 'app_expenses', 'receipt_lines']
 
 #
 # --------- Database Models -----------
@@ -30,6 +32,7 @@ class Grant(db.Model):
     # General Grant Info
     id = db.Column(db.Integer, primary_key=True)
     grant_id = db.Column(db.Text, unique=True)
+    status = db.Column(db.Text, default='submitted', index=True) # Lifecycle stage, kept up to date by grant_status.py
     # Application Info
     application_submit_time = db.Column(db.DateTime, default=datetime.utcnow)
     amount_requested = db.Column(db.Float)
@@ -42,9 +45,9 @@ class Grant(db.Model):
     contact_phone = db.Column(db.Text)
     contact_role = db.Column(db.Text)
     is_upfront = db.Column(db.Boolean)
-    organization = db.Column(db.Text)
+    organization = db.Column(db.Text, index=True)
     tax_id = db.Column(db.Text)
-    project = db.Column(db.Text)
+    project = db.Column(db.Text, index=True)
     project_description = db.Column(db.Text)
     is_event = db.Column(db.Boolean)
     project_location = db.Column(db.Text)
@@ -52,72 +55,7 @@ class Grant(db.Model):
     project_end = db.Column(db.DateTime)
     college_attendees = db.Column(db.Integer)
     facebook_link = db.Column(db.Text)
-    revenue1_type = db.Column(db.Text)
-    revenue1_description = db.Column(db.Text)
-    revenue1_amount = db.Column(db.Float)
-    revenue2_type = db.Column(db.Text)
-    revenue2_description = db.Column(db.Text)
-    revenue2_amount = db.Column(db.Float)
-    revenue3_type = db.Column(db.Text)
-    revenue3_description = db.Column(db.Text)
-    revenue3_amount = db.Column(db.Float)
-    revenue4_type = db.Column(db.Text)
-    revenue4_description = db.Column(db.Text)
-    revenue4_amount = db.Column(db.Float)
-    revenue5_type = db.Column(db.Text)
-    revenue5_description = db.Column(db.Text)
-    revenue5_amount = db.Column(db.Float)
-    revenue6_type = db.Column(db.Text)
-    revenue6_description = db.Column(db.Text)
-    revenue6_amount = db.Column(db.Float)
-    revenue7_type = db.Column(db.Text)
-    revenue7_description = db.Column(db.Text)
-    revenue7_amount = db.Column(db.Float)
-    revenue8_type = db.Column(db.Text)
-    revenue8_description = db.Column(db.Text)
-    revenue8_amount = db.Column(db.Float)
-    revenue9_type = db.Column(db.Text)
-    revenue9_description = db.Column(db.Text)
-    revenue9_amount = db.Column(db.Float)
-    revenue10_type = db.Column(db.Text)
-    revenue10_description = db.Column(db.Text)
-    revenue10_amount = db.Column(db.Float)
-    app_expense1_type = db.Column(db.Text)
-    app_expense1_description = db.Column(db.Text)
-    app_expense1_amount = db.Column(db.Float)
-    app_expense2_type = db.Column(db.Text)
-    app_expense2_description = db.Column(db.Text)
-    app_expense2_amount = db.Column(db.Float)
-    app_expense3_type = db.Column(db.Text)
-    app_expense3_description = db.Column(db.Text)
-    app_expense3_amount = db.Column(db.Float)
-    app_expense4_type = db.Column(db.Text)
-    app_expense4_description = db.Column(db.Text)
-    app_expense4_amount = db.Column(db.Float)
-    app_expense5_type = db.Column(db.Text)
-    app_expense5_description = db.Column(db.Text)
-    app_expense5_amount = db.Column(db.Float)
-    app_expense6_type = db.Column(db.Text)
-    app_expense6_description = db.Column(db.Text)
-    app_expense6_amount = db.Column(db.Float)
-    app_expense7_type = db.Column(db.Text)
-    app_expense7_description = db.Column(db.Text)
-    app_expense7_amount = db.Column(db.Float)
-    app_expense8_type = db.Column(db.Text)
-    app_expense8_description = db.Column(db.Text)
-    app_expense8_amount = db.Column(db.Float)
-    app_expense9_type = db.Column(db.Text)
-    app_expense9_description = db.Column(db.Text)
-    app_expense9_amount = db.Column(db.Float)
-    app_expense10_type = db.Column(db.Text)
-    app_expense10_description = db.Column(db.Text)
-    app_expense10_amount = db.Column(db.Float)
-    app_expense11_type = db.Column(db.Text)
-    app_expense11_description = db.Column(db.Text)
-    app_expense11_amount = db.Column(db.Float)
-    app_expense12_type = db.Column(db.Text)
-    app_expense12_description = db.Column(db.Text)
-    app_expense12_amount = db.Column(db.Float)
+    # (revenues and expenses are stored in GrantRevenue and GrantApplicationExpense)
     application_comments = db.Column(db.Text)
     # Small Grant Info
     is_small_grant = db.Column(db.Boolean, default=False)
@@ -157,31 +95,7 @@ class Grant(db.Model):
     amount_allocated = db.Column(db.Float) # Total Amount allocated with all cuts factored in
     is_collaboration_confirmed = db.Column(db.Boolean)
     receipts_due = db.Column(db.DateTime) # The date receipts are due
-    # Completed Project Info
-    expense1_description = db.Column(db.Text)
-    expense1_amount = db.Column(db.Float)
-    expense2_description = db.Column(db.Text)
-    expense2_amount = db.Column(db.Float)
-    expense3_description = db.Column(db.Text)
-    expense3_amount = db.Column(db.Float)
-    expense4_description = db.Column(db.Text)
-    expense4_amount = db.Column(db.Float)
-    expense5_description = db.Column(db.Text)
-    expense5_amount = db.Column(db.Float)
-    expense6_description = db.Column(db.Text)
-    expense6_amount = db.Column(db.Float)
-    expense7_description = db.Column(db.Text)
-    expense7_amount = db.Column(db.Float)
-    expense8_description = db.Column(db.Text)
-    expense8_amount = db.Column(db.Float)
-    expense9_description = db.Column(db.Text)
-    expense9_amount = db.Column(db.Float)
-    expense10_description = db.Column(db.Text)
-    expense10_amount = db.Column(db.Float)
-    expense11_description = db.Column(db.Text)
-    expense11_amount = db.Column(db.Float)
-    expense12_description = db.Column(db.Text)
-    expense12_amount = db.Column(db.Float)
+    # Completed Project Info (receipt line items are stored in GrantReceiptLine)
     receipt_images = db.Column(db.Text) # comma-separated file numbers
     completed_proj_comments = db.Column(db.Text)
     receipts_submit_date = db.Column(db.DateTime)
@@ -210,7 +124,15 @@ class Grant(db.Model):
     hearing_requested = db.Column(db.Boolean, default=False) # Whether a hearing needs to occur
     hearing_occurred = db.Column(db.Boolean, default=False)
     hearing_date = db.Column(db.DateTime)
+    # Last change to the grant or its line items, kept up to date by change_feed.py
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
+    # Partial index covering only the approved grants still missing receipts, used by the
+    # receipt reminder emails. (SQLite only uses a partial index when the query repeats its
+    # WHERE terms, e.g. council_approved==True)
+    __table_args__ = (
+        db.Index('ix_grant_receipts_outstanding', 'reimbursed_uc', 'receipts_due', sqlite_where=db.text('council_approved = 1 AND receipts_submitted = 0')),
+    )
 
     def __init__(self, grant_id):
         self.grant_id = grant_id
@@ -220,6 +142,85 @@ class Grant(db.Model):
     def __repr__(self):
         return '<Grant %r>' % self.grant_id
 
+#
+# --------- Grant Column Profiles -----------
+#
+
+# Categories in which interviewers allocate funds (each has a '<category>_allocated'
+# amount and a '<category>_allocated_notes' column on Grant)
+allocation_categories = ['food', 'travel', 'publicity', 'materials', 'venue', 'decorations', 'media', 'admissions', 'hupd', 'personnel', 'other']
+
+# The Grant table is very wide, so list pages load only the columns their templates
+# display. Each profile is used via grant_query() in helpers.py
+grant_list_columns = ['grant_id', 'organization', 'project']
+grant_profiles = {
+    'organization' : ['organization'],
+    'interviews' : grant_list_columns + ['interview_schedule_date'],
+    'small_grants' : grant_list_columns + ['application_submit_time'],
+    'treasurer' : grant_list_columns + ['amount_allocated', 'receipts_submit_date'],
+    'treasurer_dashboard' : grant_list_columns + ['amount_allocated', 'receipts_submit_date', 'status', 'is_upfront', 'is_paid',
+        'council_approved'],
+    'hearings' : grant_list_columns + ['hearing_date'],
+    'owed_money' : grant_list_columns + ['amount_dispensed', 'reimburse_uc_amount'],
+    'grants_pack_edit' : grant_list_columns + ['is_small_grant', 'interviewer', 'small_grant_reviewer', 'interviewer_notes'] +
+        [category + '_allocated' for category in allocation_categories] + [category + '_allocated_notes' for category in allocation_categories],
+}
+
+class GrantRevenue(db.Model):
+    """ A single source of revenue listed on a grant application """
+    id = db.Column(db.Integer, primary_key=True)
+    grant_pk = db.Column(db.Integer, db.ForeignKey('grant.id'), nullable=False, index=True)
+    grant = db.relationship('Grant', backref=db.backref('revenues', order_by='GrantRevenue.line', cascade='all, delete-orphan'), lazy=True)
+    line = db.Column(db.Integer) # Line number on the application form
+    type = db.Column(db.Text)
+    description = db.Column(db.Text)
+    amount = db.Column(db.Float)
+
+    def __init__(self, line, type=None, description=None, amount=None):
+        self.line = line
+        self.type = type
+        self.description = description
+        self.amount = amount
+
+    def __repr__(self):
+        return '<GrantRevenue %r>' % self.line
+
+class GrantApplicationExpense(db.Model):
+    """ A single projected expense listed on a grant application """
+    id = db.Column(db.Integer, primary_key=True)
+    grant_pk = db.Column(db.Integer, db.ForeignKey('grant.id'), nullable=False, index=True)
+    grant = db.relationship('Grant', backref=db.backref('app_expenses', order_by='GrantApplicationExpense.line', cascade='all, delete-orphan'), lazy=True)
+    line = db.Column(db.Integer) # Line number on the application form
+    type = db.Column(db.Text)
+    description = db.Column(db.Text)
+    amount = db.Column(db.Float)
+
+    def __init__(self, line, type=None, description=None, amount=None):
+        self.line = line
+        self.type = type
+        self.description = description
+        self.amount = amount
+
+    def __repr__(self):
+        return '<GrantApplicationExpense %r>' % self.line
+
+class GrantReceiptLine(db.Model):
+    """ A single actual expense listed on a grant's receipts submission """
+    id = db.Column(db.Integer, primary_key=True)
+    grant_pk = db.Column(db.Integer, db.ForeignKey('grant.id'), nullable=False, index=True)
+    grant = db.relationship('Grant', backref=db.backref('receipt_lines', order_by='GrantReceiptLine.line', cascade='all, delete-orphan'), lazy=True)
+    line = db.Column(db.Integer) # Line number on the receipts form
+    description = db.Column(db.Text)
+    amount = db.Column(db.Float)
+
+    def __init__(self, line, description=None, amount=None):
+        self.line = line
+        self.description = description
+        self.amount = amount
+
+    def __repr__(self):
+        return '<GrantReceiptLine %r>' % self.line
+
 class Organization(db.Model):
     """ Contains information about student organizations on campus """
     id = db.Column(db.Integer, primary_key=True)
@@ -227,6 +228,9 @@ class Organization(db.Model):
     bank_name = db.Column(db.Text)
     training_required = db.Column(db.Boolean, default=False) # Sexual Assault Training
     training_occurred = db.Column(db.Boolean, default=False) # Sexual Assault Training
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Kept up to date by change_feed.py
+    standing = db.relationship('OrganizationStanding', uselist=False, viewonly=True,
+        primaryjoin='foreign(OrganizationStanding.organization) == Organization.name')
 
     def __init__(self, name):
         self.name = name
@@ -234,6 +238,34 @@ class Organization(db.Model):
     def __repr__(self):
         return '<Organization %r>' % self.name
 
+class OrganizationStanding(db.Model):
+    """ Contains a running summary of each organization's grants, kept up to date as grants
+        are saved (see organization_standing.py), so an organization's standing can be read
+        without scanning its grants. Overdue receipts depend on the time they are read, so
+        they are not stored, and are only set by organization_standing.add_overdue_receipts """
+    organization = db.Column(db.Text, primary_key=True)
+    amount_owed = db.Column(db.Float, default=0.0) # Unspent upfront money which must be paid back
+    grants_owing_money = db.Column(db.Integer, default=0) # Upfront grants which must pay the UC back
+    open_hearings = db.Column(db.Integer, default=0)
+    amount_requested = db.Column(db.Float, default=0.0) # Lifetime total
+    amount_allocated = db.Column(db.Float, default=0.0) # Lifetime total
+    overdue_receipts = 0 # Paid grants whose receipts are overdue
+    overdue_amount = 0.0 # Money paid out for the overdue receipts
+
+    def __init__(self, organization):
+        self.organization = organization
+
+    @property
+    def total_owed(self):
+        return (self.amount_owed or 0.0) + (self.overdue_amount or 0.0)
+
+    @property
+    def in_bad_standing(self):
+        return bool(self.overdue_receipts or self.grants_owing_money or self.open_hearings)
+
+    def __repr__(self):
+        return '<OrganizationStanding %r>' % self.organization
+
 class Config(db.Model):
     """ Contains configuration <key,value> pairs used for general application setup """
     key = db.Column(db.Text, primary_key=True)
@@ -333,6 +365,7 @@ class Expense(db.Model):
     fund = db.relationship('Fund', backref='expenses', lazy=True)
     legislation_file = db.Column(db.Text, default=None)
     legislation_number = db.Column(db.Text, default=None)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow) # Kept up to date by change_feed.py
 
     def __init__(self, name, fund, budget):
         self.name = name
@@ -354,3 +387,29 @@ class Budget(db.Model):
 
     def __repr__(self):
         return '<Budget %r>' % self.council
+
+class EmailOutbox(db.Model):
+    """ An email waiting to be sent (or already sent) by the email dispatcher. Rows are
+        added in the same transaction as the change they describe, so notifications
+        survive restarts and are never sent for changes that were rolled back. """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.Text, nullable=False) # Key into email_kinds in helpers.py
+    grant_pk = db.Column(db.Integer, db.ForeignKey('grant.id'), nullable=False)
+    grant = db.relationship('Grant', lazy=True)
+    status = db.Column(db.Text, nullable=False, default='pending') # 'pending', 'sending', 'sent' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Not sent before this time
+    claimed_by = db.Column(db.Text) # Token of the dispatcher batch currently sending this email
+    claimed_at = db.Column(db.DateTime)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    sent = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt'),)
+
+    def __init__(self, kind, grant):
+        self.kind = kind
+        self.grant = grant
+
+    def __repr__(self):
+        return '<EmailOutbox %r: %r>' % (self.id, self.kind)
@@ -5,12 +5,22 @@
 #
 # Contains a script that populates the NOVA database
 # with dummy data that is useful for testing via HTTP
-# requests.
+# requests. Can also generate concurrent load against a
+# local server (run with --help for options).
 #
-from random import uniform, choice, randrange
-from requests import get
+import argparse
+import json
+from random import uniform, choice, randrange, choices
+from requests import get, Session
+from requests.exceptions import RequestException
 from urllib.parse import quote
-from sys import exit
+from sys import exit, argv
+from threading import local, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+# The security key set by installation.py, which the API endpoints require
+security_key = "ZmL1kNBW1i"
 
 # A list of all clubs on campus
 clubs = ["Act On A Dream","Africa Business and Investment Club (HABIC)","African Students Association (HASA)","Aikikai","Alzheimer's Buddies","Anime Society","Archery","Armenian Students Association","Asian American Association (AAA)","Asian American Brotherhood (AAB)","Asian American Dance Troupe (AADT)","Asian American Women's Association","Asian Baptist Student Koinonia (ABSK)","Association for the Promotion of Interplanetary Expansion (HAPIE)","Association for U.S.-China Relations (HAUSCR)","Association of Black Harvard Women (ABHW)","Athena Conference","Bach Society Orchestra (BachSoc)","Badminton","Baha'i Association","Ballet Company","Ballroom Dance","Ballroom Dance Team (HBDT)","Baroque Chamber Orchestra","Baseball","Beekeepers","Bhangra","Billiards","Biomedical Engineering Society (BMES)","Biotechnology Association","Black Community and Student Theater Group (BlackC.A.S.T.)","Black Men's Forum (BMF)","Black Pre-Law Association (BPLA)","Black Students Association (BSA)","Book Review","Bowling","Boxing","Brattle Street Chamber Players","Brazilian Association (HUBA)","Breakers","British Club","Broomball","Bulgarian Club","BWISE: BSC Fellows for a Whole Integrated Student Experience","Canadian Club","Candela Dance Troupe","Capoeira","Caribbean Club","Catholic Student Association (CSA)","Chado Society","Cheerleading","Chess Club","China Forum (HCCF)","Chinese Music Ensemble (HCME)","Chinese Students Association (CSA)","Christian Impact","Christians on Campus","CityStep","Climbing","Coalition for East African Peace","College Bowl","College Events Board","Collegium","Colombian Students Association","Community Garden","Community of Humanists, Atheists, and Agnostics","Composers Association","Computer Society (HCS)","Concilio Latino","Consent Advocates and Relationship Educators (CARE)","Consulting Group (HCCG)","Consulting on Business and the Environment","Contact Peer Counseling","Convrgency","Cornhole","Cricket","Crimson","Crimson Dance","Crimson Key Society (CKS)","CrimsonEMS","Crunch Magazine","Cuban-American Undergraduate Student Association (CAUSA)","Cube Club","Curling","Cycling","Dancing to Heal","Data Ventures","Debate Council","Debating Union","Deepam","Democrats","Developers for Development","Development Think Tank","Dharma","Digital Literacy Project","Din & Tonics","DirecTutor","Disability Alliance","DREAM","Dreamporte","Drug and Alcohol Peer Advisors (DAPA)","Eating Concerns Hotline and Outreach (ECHO)","Ecdysis","Ecomarathon Team","Economics Association","Economics Review","Effective Altruism","Electronic Music Collective","Eleganza","Engineering Society (HCES)","Engineers Without Borders (EWB)","Episcopal Students","eSports Association","European Business Group","European Society","Evening with Champions","Expressions","Faith and Action (HCFA)","Fallen Angels","Fencing","Field Hockey","Figure Skating","Film Festival","Financial Analysts Club","First Generation Student Union","First-Year Outdoor Program (FOP)","First-Year Social Committee (FYSC)","Flute Ensemble","Food Lab for Kids","Food Literacy Project","Foundation for International Medical Relief of Children (FIMRC)","Francophone Society","Franklin Fellowship","Friends of Project Sunshine","Fuerza Latina","FUSIAN","Futsal","Future Surgeons","G-Chat: First-Year Discussion Group","Gender Inclusivity in Math","Geological Society","Gilbert & Sullivan Players (HRG&SP)","Glee Club","Global Health and AIDS Coalition","Global Health Forum (HUGHF)","Golf","Green Medicine Initiative","HackHarvardCollege","Haitian Alliance","Half Asian People's Association (HAPA)","Hapkido","Harvard College Coaches","Harvard Organization for Latin America (HOLA)","Harvard Undergraduate BGLTQ Business Society (HUBBS)","Harvard Undergraduates Raising Autism Awareness! (HURAA!)","Harvard University Band","Harvard-Radcliffe Orchestra (HRO)","Hasty Pudding Theatricals (HPT)","HBASIS (Harvard College Bisexual, Gay, Lesbian, Transgender, Queer & Allied Students in the Sciences)","Healing Thoughts","Health Advocacy Program (HAP)","Health Leads","Healthcare Associates","HealthPALs - Health Peer Advisors & Liaisons","High-Tech & Business Group","Hillel","History Club","Holoimua O Hawaii","Hong Kong Society","Honor Council","House and Neighborhood Development (HAND)","HRDC (Harvard--Radcliffe Dramatic Club)","Human Rights in North Korea (HRiNK)","Human Rights Review","Humanities Initiative","Hyperion Shakespeare Company","IDENTITIES Fashion Show","iGEM","Immediate Gratification Players (IGP)","Impact Investing Group","Indigo Peer Counseling","Institute of Politics (IOP)","Interfaith Forum","International Negotiation Program","International Relations Council (IRC)","International Relations on Campus","International Review","International Women's Rights Collective (IWRC)","Iranian Association","Islamic Society (HIS)","Israel Public Affairs","Japan Initiative","Jazz Bands","Jiu Jitsu","John Adams Society","Kendo","KeyChange","Kidney Disease Screening and Awareness Program (KDSAP)","Korean Adoptee Mentorship Program","Krav Maga","La Organizacion de Puertorriquenos en Harvard","Latino Men's Collective (LMC)","Latinos in Health Careers","Latter-day Saint Student Association (LDSSA)","Law Society","Leadership Institute at Harvard College (LIHC)","Lowell House Opera Society","Lowell House Society of Russian Bell Ringers","LowKeys","Manifesta Magazine","Mathematics Association (HUMA)","Medical Humanities Forum","Men's Basketball (Crimson Classics)","Men's Basketball (Harvard Hoopsters)","Men's Ice Hockey","Men's Lacrosse","Men's Rugby","Men's Soccer","Men's Tennis","Mentors for Urban Debate","Mirch","Mock Trial","Model Congress San Francisco","Model United Nations (HMUN)","Modern Dance Company (HRMDC)","Mountaineering Club","Music in Hospitals and Nursing Homes Using Entertainment as Therapy (MIHNUET)","National Model United Nations (HNMUN)","Naturalist Club","Nordic Skiing","Noteables-Harvard's Broadway Beat","Ocean Sciences Club","On Harvard Time (OHT)","Open Philosophy Organization","Opportunes","Organ Society","Organization of Asian American Sisters in Service","Orthodox Christian Fellowship","Outing Club","Palestine Solidarity Committee (PSC)","Pan-African Dance and Music Ensemble (PADAME)","Partners in Health Engage","Passus: Harvard College Step Team","Philippine Forum","Photography Club","Piano Society","Pistol","Polish Society","Political Review (HPR)","Polo","Pops Orchestra","Powerlifting","Pre-Medical Society","Pre-Veterinary Society","Program for International Education (HPIE)","Progressive Jewish Alliance (PJA)","Project for Asian and International Relations (HPAIR)","Project SWIM","Quad Sound Studios (QSS)","Quantitative Trading Club","Quidditch","Radcliffe Choral Society (RCS)","Radcliffe Pitches","Radcliffe Union of Students (RUS)","Real Tennis","Recreational Experience and Arts Creativity with Harvard (REACH)","Red Cross","Republican Club","Reserve Officer Training Corps Association (HROTCA)","Response","Review of Environment and Society","Right to Life","River Charles Ensemble","Robotics Club","Romanian Association","Room 13","Rootstrikers","Running","Rural Health Association","Russian Speakers Association","Satire V","Scholars at Risk","School of Rock","Science Club for Girls","Science Fiction Association (HRSFA)","Science Review","Scientista","Scuba","Senior Class Committee","Seventh-day Adventist Fellowship (HCSDAF)","Sexual Health and Relationship Counselors (SHARC)","Sexual Health Education & Advocacy throughout Harvard College (SHEATH)","Shooting","Shotokan Karate","Sikh Student Association","Simplicissimus","Singaporean, Indonesia, and Malaysia Association (SIAMA)","Skiing","Social Enterprise Association (HCSEA)","Society for Mind, Brain, and Behavior (HSMBB)","Society for the Cinematic Arts","Society of Arab Students","Society of Black Scientists and Engineers (HSBSE)","Society of Physics Students (SPS)","SoulFood Christian Fellowship","South Asian Association (SAA)","South Asian Men's Collective (SAMC)","South Slavic Society","Speak Out Loud (SOL)","Special Olympics","Speedskating","Spikeball","Sports Analysis Collective","Sports Marketing Club","Springboard Design","Squash","Stand-Up Comic Society (HCSUCS)","Stories for Orphans","Story-Time Players","Student Astronomers at Harvard-Radcliffe (STAHR)","Student for Myanmar","Student Mental Health Liaisons (SMHL)","Students for Israel","Students for the Exploration and Development of Space (SEDS)","Swimming","Table Tennis","Taekwondo","Taiwan Leadership Conference","Taiwanese Cultural Society (TCS)","TAPS","Task Force on Asian and Pacific American Studies","Team HBV","TEATRO!","Tempus","Texas Club","Thai Society","The Advocate","The Happiness Project","The Harvard Callbacks","The Harvard Undergraduate Research Journal (THURJ)","The Ichthus","The Independent","The Review of Philosophy","Three Letter Acronym: Harold Team (TLA)","THUD (The Harvard Undergraduate Drummers)","Tough Mudder","Triathlon","Tuesday Magazine","Turkish Student Association","Ultimate Frisbee (Men)","Ultimate Frisbee (Women)","Under Construction","Undergraduate Council (UC)","Undergraduate Fellowship (HUF)","Undergraduate Research Association (HCURA)","United World Club","University Choir","US-India Initiative","Ventures (Harvard College)","Veritas Financial Group (VFG)","Veritones","Video Game Development Club","Vietnamese Association","VISION","Voice Actors' Guild","Volleyball (Men)","Volleyball (Women)","Water Polo","Wind Ensemble","Wine Society","Wireless Club","Wisconsin Club (H-COW)","Women in Business (HUWIB)","Women in Computer Science","Women's Basketball","Women's Ice Hockey","Women's Lacrosse","Women's Leadership Project (WLP)","Women's Soccer","Women's Tennis","Woodbridge International Society","World Model United Nations (WorldMUN)","Writers' Workshop","Writing and Public Service Initiative","Wushu","XFit","Yearbook","Youth Recreation Program- HOOPs","Asian American Christian Fellowship (AACF)","Korean Association (KA)","Korean International Student Association (KISA)","Korean Association (KA) Korean International Student Association (KISA)","Latinas Unidas","Native Americans at Harvard College (NAHC)","Nigerian Students Association (NSA)","Organization of Asian American Sisters in Service","Queer Students and Allies (QSA)","SHADE","Social Innovation Collaborative","South Asian Women's Collective","South Asian Dance Company","TEDx Harvard College","Philippine Forum","Hellenic Society"]
@@ -71,8 +81,9 @@ def rand_expense(small_grant=False):
     else:
         return choice(expenses)
 
-def request_new_grant(domain, email, small_grant):
-    """ Makes a GET request to create a new grant on the target domain """
+def new_grant_query_string(email, small_grant):
+    """ Generates a random grant application, returning its project name and the
+        query string which submits it to /new_grant """
     if small_grant:
         amount_requested = rand_dollar(200.00)
     else:
@@ -298,14 +309,200 @@ def request_new_grant(domain, email, small_grant):
     query_string += "app_expense12_description=" + app_expense12_description + "&"
     query_string += "app_expense12_amount=" + app_expense12_amount + "&"
     query_string += "application_comments=" + application_comments + "&"
-    query_string += "k=ZmL1kNBW1i"
+    query_string += "k=" + security_key
     
-    url = domain + "/new_grant?" + quote(query_string, "&=")
-    req = get(url)
+    return project, quote(query_string, "&=")
+
+def receipts_query_string(grant_id):
+    """ Generates a random receipts submission for a grant, returning the query string
+        which submits it to /receipts """
+    query_string = "grant_id=" + grant_id + "&"
+    for i in range(1, randrange(2,5)):
+        query_string += "expense" + str(i) + "_description=" + rand_sentence() + "&"
+        query_string += "expense" + str(i) + "_amount=" + rand_dollar(300.00) + "&"
+    query_string += "receipt_images=" + ", ".join(str(randrange(1000,10000)) + ".jpg" for i in range(randrange(1,4))) + "&"
+    query_string += "completed_proj_comments=" + rand_sentence()
+    return quote(query_string, "&=")
+
+def request_new_grant(domain, email, small_grant):
+    """ Makes a GET request to create a new grant on the target domain """
+    project, query_string = new_grant_query_string(email, small_grant)
+    req = get(domain + "/new_grant?" + query_string)
     print('\"' + project + '\" --> ' + str(req.status_code) + ", " + req.text)
     if req.status_code != 200:
         exit("Fatal: Bad Request Response")
         
+# Default mix of load test requests: {kind: relative weight}
+default_mix = {'new_grant': 4, 'receipts': 2, 'status': 3, 'search': 1}
+
+class LoadGenerator(object):
+    """ Sends a mix of requests to a server from a pool of worker threads, either at a
+        fixed target rate (open loop, so a slow server builds up a queue just as it would
+        during a real burst) or as fast as the workers allow, and records the latency of each """
+
+    def __init__(self, domain, email, workers, mix):
+        self.domain = domain
+        self.email = email
+        self.workers = workers
+        self.kinds = list(mix.keys())
+        self.weights = list(mix.values())
+        # Grant IDs created by this run, for receipts and status lookups
+        self.grant_ids = []
+        # Applications sent, including any which were not accepted
+        self.submissions = 0
+        # (kind, status, latency, service time) of every request
+        self.results = []
+        self.lock = Lock()
+        self.sessions = local()
+
+    def session(self):
+        """ Returns this thread's HTTP session (sessions must not be shared between threads) """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = Session()
+        return self.sessions.session
+
+    def request(self, kind):
+        """ Sends one request of the given kind, returning its response """
+        session = self.session()
+        with self.lock:
+            grant_id = choice(self.grant_ids) if self.grant_ids else None
+        if kind == 'receipts' and grant_id:
+            return session.get(self.domain + "/receipts?" + receipts_query_string(grant_id))
+        if kind == 'status' and grant_id:
+            return session.get(self.domain + "/grant/" + grant_id)
+        if kind == 'search':
+            url, params = choice([
+                ("/search/organizations", {'query': rand_club()[:3]}),
+                ("/search/projects", {'query': choice(s_verbs)}),
+                ("/search/lookup-grants", {'query': rand_club()}),
+            ])
+            params['k'] = security_key
+            return session.get(self.domain + url, params=params)
+        # New grants (also sent in place of receipts and lookups until a grant exists)
+        project, query_string = new_grant_query_string(self.email, rand_bool())
+        with self.lock:
+            self.submissions += 1
+        response = session.get(self.domain + "/new_grant?" + query_string)
+        # The application is redirected to /application-submitted/<grant_id>
+        if "/application-submitted/" in response.url:
+            with self.lock:
+                self.grant_ids.append(response.url.rsplit('/', 1)[1])
+        return response
+
+    def send(self, kind, scheduled, slots):
+        """ Sends a request and records how long it took from when it was scheduled
+            (latency) and from when it was actually sent (service time) """
+        start = perf_counter()
+        try:
+            status = self.request(kind).status_code
+        except RequestException:
+            status = 'error'
+        finally:
+            # Stop the clock before the slot is handed to the next request
+            end = perf_counter()
+            if slots:
+                slots.release()
+        self.results.append((kind, status, end - scheduled, end - start))
+
+    def run(self, duration, rate=None, limit=None):
+        """ Generates load for duration seconds (or until limit requests have been sent, if
+            given), at rate requests per second if given or else as fast as the workers allow.
+            Returns the elapsed time """
+        # Without a target rate, each worker sends its next request once its last one finishes
+        slots = None if rate else BoundedSemaphore(self.workers)
+        start = perf_counter()
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while limit is None or sent < limit:
+                if rate:
+                    scheduled = start + sent / rate
+                    if scheduled - start >= duration:
+                        break
+                    delay = scheduled - perf_counter()
+                    if delay > 0:
+                        sleep(delay)
+                else:
+                    slots.acquire()
+                    scheduled = perf_counter()
+                    if scheduled - start >= duration:
+                        break
+                kind = choices(self.kinds, self.weights)[0]
+                executor.submit(self.send, kind, scheduled, slots)
+                sent += 1
+        return perf_counter() - start
+
+    def report(self, elapsed):
+        """ Returns latency percentiles (in milliseconds), throughput and status counts for
+            each kind of request and for all requests together """
+        report = {}
+        for kind in self.kinds + ['all']:
+            results = [result for result in self.results if kind in ('all', result[0])]
+            if not results:
+                continue
+            latencies = sorted(result[2] * 1000 for result in results)
+            statuses = {}
+            for result in results:
+                statuses[str(result[1])] = statuses.get(str(result[1]), 0) + 1
+            report[kind] = {
+                'requests': len(results),
+                'per_second': round(len(results) / elapsed, 2),
+                'errors': sum(1 for result in results if result[1] == 'error' or result[1] >= 400),
+                'statuses': statuses,
+                'service_ms': round(sum(result[3] for result in results) * 1000 / len(results), 2),
+            }
+            for name, fraction in [('p50_ms', 0.5), ('p90_ms', 0.9), ('p95_ms', 0.95), ('p99_ms', 0.99)]:
+                report[kind][name] = round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 2)
+            report[kind]['max_ms'] = round(latencies[-1], 2)
+        return report
+
+    def check_submissions(self):
+        """ Returns the number of applications which were not accepted (each should have
+            been redirected to its confirmation page), and the number of Grant IDs which
+            were handed to more than one of them """
+        return self.submissions - len(self.grant_ids), len(self.grant_ids) - len(set(self.grant_ids))
+
+def parse_mix(mix):
+    """ Parses a request mix such as 'new_grant=4,status=1' into {kind: weight} """
+    weights = {}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in default_mix:
+            raise argparse.ArgumentTypeError("unknown request kind " + kind)
+        weights[kind] = float(weight)
+    return weights
+
+def load_test():
+    """ Runs the load generator with the options given on the command line """
+    parser = argparse.ArgumentParser(description="Generates concurrent load against a NOVA server")
+    parser.add_argument('--load', action='store_true', help="generate load rather than prompting to create grants")
+    parser.add_argument('--domain', default='http://localhost:5000', help="server to load (default: http://localhost:5000)")
+    parser.add_argument('--email', default='load@nova.local', help="contact email address for the applications")
+    parser.add_argument('--workers', type=int, default=16, help="concurrent requests (default: 16)")
+    parser.add_argument('--rate', type=float, help="target requests per second (default: as fast as the workers allow)")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to generate load for (default: 30)")
+    parser.add_argument('--requests', type=int, help="stop after sending this many requests (default: no limit)")
+    parser.add_argument('--mix', type=parse_mix, default=default_mix,
+                        help="relative weights of each kind of request (default: new_grant=4,receipts=2,status=3,search=1)")
+    parser.add_argument('--output', help="file to write the JSON report to")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.domain.rstrip('/'), args.email, args.workers, args.mix)
+    elapsed = generator.run(args.duration, args.rate, args.requests)
+    report = generator.report(elapsed)
+    print("kind".ljust(10) + "requests".rjust(10) + "req/s".rjust(10) + "errors".rjust(8) + "p50 ms".rjust(10) + "p90 ms".rjust(10) + "p99 ms".rjust(10) + "max ms".rjust(10))
+    for kind, result in report.items():
+        print(kind.ljust(10) + str(result['requests']).rjust(10) + str(result['per_second']).rjust(10) + str(result['errors']).rjust(8)
+              + str(result['p50_ms']).rjust(10) + str(result['p90_ms']).rjust(10) + str(result['p99_ms']).rjust(10) + str(result['max_ms']).rjust(10))
+    # Every application must be accepted under its own Grant ID, however many arrive at once
+    lost, duplicates = generator.check_submissions()
+    report['submissions'] = {'sent': generator.submissions, 'lost': lost, 'duplicate_ids': duplicates}
+    print(str(generator.submissions) + " applications sent, " + str(lost) + " lost, " + str(duplicates) + " duplicate Grant IDs")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if lost or duplicates:
+        exit("Fatal: Applications were lost or given duplicate Grant IDs")
+
 def main():
     # Prompt user for inputs
     domain = input("Domain: ").rstrip('/')
@@ -316,4 +513,7 @@ def main():
         request_new_grant(domain, email, rand_bool())
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--load" in argv:
+        load_test()
+    else:
+        main()
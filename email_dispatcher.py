@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#
+# email_dispatcher.py
+#
+# Contains a long-running script that sends the emails queued in
+# the email outbox by the web application. Run one or more copies
+# alongside the Flask deployment; each copy claims its own batches.
+#
+from argparse import ArgumentParser
+from time import sleep
+from os import environ
+# Only the web application runs the scheduled email jobs
+environ.setdefault('NOVA_DISABLE_SCHEDULER', '1')
+from application import app
+from helpers import dispatch_outbox_emails, close_mail_connections, mail_metrics, email_images
+
+def main():
+    parser = ArgumentParser(description="Sends emails queued in the NOVA email outbox")
+    parser.add_argument("--batch-size", type=int, default=50, help="number of emails to claim at a time")
+    parser.add_argument("--poll-interval", type=float, default=5, help="seconds to wait when the outbox is empty")
+    parser.add_argument("--once", action="store_true", help="send everything that is due, then exit")
+    args = parser.parse_args()
+
+    with app.app_context():
+        # Read every email image into memory up front
+        email_images.preload()
+        batch = 0
+        while True:
+            claimed = dispatch_outbox_emails(args.batch_size)
+            batch += claimed
+            if claimed:
+                continue
+            # Outbox is empty, so hang up until there is more to send
+            if batch:
+                close_mail_connections()
+                print("Sent batch of " + str(batch) + " emails: " + str(mail_metrics()) + ", images: " + str(email_images.metrics()))
+                batch = 0
+            if args.once:
+                break
+            sleep(args.poll_interval)
+
+if __name__ == "__main__":
+    main()
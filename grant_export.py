@@ -0,0 +1,206 @@
+#
+# grant_export.py
+#
+# Contains the streaming export of the grant archive. Grants are read
+# from the database in batches of plain rows (never whole Grant
+# objects), written with csv.writer into a reusable buffer, and sent
+# in chunks of about 64 KB, optionally gzipped, so exporting every
+# grant takes the same memory as exporting a few. The archive can
+# also be exported with typed columns as NDJSON, or (if pyarrow is
+# installed) as Parquet or an Arrow stream.
+#
+
+import csv
+import json
+import zlib
+from io import StringIO
+from datetime import datetime
+from sqlalchemy import select
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet and Arrow exports are optional
+    pyarrow = None
+from database_models import db, Grant, GrantRevenue, GrantApplicationExpense, GrantReceiptLine
+from helpers import summarize_line_items
+
+# Grant columns which can be exported, in export order
+export_fields = sorted(Grant.__table__.columns.keys())
+
+# Line item models exported as one summary column each, keyed by column name
+line_item_models = {
+    'revenues' : GrantRevenue,
+    'app_expenses' : GrantApplicationExpense,
+    'receipt_lines' : GrantReceiptLine,
+}
+
+# Grants read from the database at a time
+export_batch_size = 1000
+# Size (in characters) at which buffered CSV is sent
+export_chunk_size = 64 * 1024
+# Grants in each Parquet row group
+parquet_row_group_size = 10000
+
+# {format: (mimetype, file extension)} of each export format
+export_formats = {
+    'csv' : ('text/csv', 'csv'),
+    'ndjson' : ('application/x-ndjson', 'ndjson'),
+    'arrow' : ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet' : ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def export_batches(fields, *criteria):
+    """ Yields lists of rows of the given Grant columns for the grants matching the filter
+        criteria, in grant order. Each row is followed by a summary of each of its line
+        items columns requested in fields. Each batch is read by its own query, starting
+        after the last grant of the one before, so that no cursor (and so no SQLite read
+        lock) is held open while a batch is being sent """
+    columns = [Grant.id] + [getattr(Grant, field) for field in fields if field not in line_item_models]
+    line_items = [field for field in fields if field in line_item_models]
+    last_pk = 0
+    while True:
+        query = select(*columns).where(Grant.id > last_pk, *criteria).order_by(Grant.id).limit(export_batch_size)
+        partition = db.session.execute(query).all()
+        if not partition:
+            return
+        last_pk = partition[-1][0]
+        summaries = {}
+        if line_items:
+            grant_pks = [row[0] for row in partition]
+            for field in line_items:
+                summaries[field] = line_item_summaries(line_item_models[field], grant_pks)
+        batch = []
+        for row in partition:
+            values = dict(zip(fields, row[1:]))
+            for field in line_items:
+                values[field] = summaries[field].get(row[0], "")
+            batch.append([values[field] for field in fields])
+        yield batch
+
+def line_item_summaries(model, grant_pks):
+    """ Returns {grant primary key: summary} of the model's line items on the given grants """
+    columns = [model.grant_pk, model.description, model.amount] + ([model.type] if hasattr(model, 'type') else [])
+    lines = {}
+    for line in db.session.query(*columns).filter(model.grant_pk.in_(grant_pks)).order_by(model.grant_pk, model.line):
+        lines.setdefault(line.grant_pk, []).append(line)
+    return {grant_pk: summarize_line_items(grant_lines) for grant_pk, grant_lines in lines.items()}
+
+def csv_value(value):
+    """ Formats a value for a CSV cell, on a single line """
+    if value is None:
+        return None
+    return str(value).replace('\n', ' ').replace('\r', '')
+
+def export_csv(fields, *criteria):
+    """ Yields the CSV export of the given fields of the grants matching the filter criteria,
+        in chunks of about export_chunk_size characters """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for batch in export_batches(fields, *criteria):
+        for row in batch:
+            writer.writerow([csv_value(value) for value in row])
+            if buffer.tell() >= export_chunk_size:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """ Gzips a stream of text chunks, yielding compressed chunks as they fill """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def field_type(field):
+    """ Returns the Python type of an export field's values """
+    if field in line_item_models:
+        return str
+    return Grant.__table__.columns[field].type.python_type
+
+def json_value(value):
+    """ Formats values which JSON has no type for """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Cannot export " + repr(value))
+
+def export_ndjson(fields, *criteria):
+    """ Yields the export of the given fields of the grants matching the filter criteria as
+        one JSON object per line, in chunks of about export_chunk_size characters """
+    lines = []
+    size = 0
+    for batch in export_batches(fields, *criteria):
+        for row in batch:
+            line = json.dumps(dict(zip(fields, row)), default=json_value, separators=(',', ':')) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size >= export_chunk_size:
+                yield ''.join(lines)
+                lines = []
+                size = 0
+    yield ''.join(lines)
+
+class ChunkSink(object):
+    """ A write-only file which keeps what is written to it until it is taken, so that
+        pyarrow's output can be streamed as it is produced """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        """ Returns and forgets everything written since the last take """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_arrow(fields, format, *criteria):
+    """ Yields the export of the given fields of the grants matching the filter criteria as
+        a Parquet file or an Arrow IPC stream (format 'parquet' or 'arrow'), with each
+        column typed. Requires pyarrow """
+    arrow_types = {float: pyarrow.float64(), int: pyarrow.int64(), bool: pyarrow.bool_(),
+                   datetime: pyarrow.timestamp('us'), str: pyarrow.string()}
+    schema = pyarrow.schema([(field, arrow_types[field_type(field)]) for field in fields])
+    sink = ChunkSink()
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    rows = []
+    def write(rows):
+        columns = [pyarrow.array(column, type=schema.field(i).type) for i, column in enumerate(zip(*rows))]
+        writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+        return sink.take()
+
+    for batch in export_batches(fields, *criteria):
+        if format == 'arrow':
+            yield write(batch)
+            continue
+        # Parquet files are read a row group at a time, so larger groups read faster
+        rows += batch
+        if len(rows) >= parquet_row_group_size:
+            yield write(rows)
+            rows = []
+    if rows:
+        yield write(rows)
+    writer.close()
+    yield sink.take()
@@ -0,0 +1,80 @@
+#
+# grant_status.py
+#
+# Contains the grant lifecycle state machine. Every grant stores
+# its current stage in the indexed Grant.status column, which is
+# recomputed from the grant's progress flags whenever the grant
+# is saved, so pages can look grants up by status directly.
+#
+
+from database_models import Grant
+
+class GrantStatus(object):
+    """ The stages of a grant's lifecycle, as stored in Grant.status """
+    SUBMITTED = 'submitted' # Awaiting an interview (or small grant review)
+    INTERVIEW_SCHEDULED = 'interview_scheduled'
+    DOCKETED = 'docketed' # Interviewed or reviewed, awaiting the council vote
+    APPROVED = 'approved' # Passed by the council; upfront grants await payment, retroactive grants await receipts
+    DENIED = 'denied' # Passed by the council with nothing allocated (upfront grants only)
+    PAID = 'paid' # Upfront grant paid, awaiting receipts
+    RECEIPTS_SUBMITTED = 'receipts_submitted' # Awaiting review (upfront) or payment (retroactive)
+    OWES_MONEY = 'owes_money' # Upfront grant which did not spend everything and must pay the UC back
+    COMPLETE = 'complete'
+    HEARING = 'hearing' # A hearing has been requested and has not yet occurred
+
+def derive_status(grant):
+    """ Returns the GrantStatus a grant is in given its progress flags. This is the
+        single definition of a grant's stage; a pending hearing takes precedence
+        over everything else """
+    if grant.hearing_requested and not grant.hearing_occurred:
+        return GrantStatus.HEARING
+    if grant.is_upfront:
+        if grant.must_reimburse_uc:
+            return GrantStatus.COMPLETE if grant.reimbursed_uc else GrantStatus.OWES_MONEY
+        if grant.receipts_reviewed:
+            return GrantStatus.COMPLETE
+        if grant.receipts_submitted:
+            return GrantStatus.RECEIPTS_SUBMITTED
+        if grant.is_paid:
+            return GrantStatus.PAID
+        if grant.council_approved:
+            return GrantStatus.APPROVED if grant.amount_allocated else GrantStatus.DENIED
+    else:
+        if grant.is_paid:
+            return GrantStatus.COMPLETE
+        if grant.receipts_submitted:
+            return GrantStatus.RECEIPTS_SUBMITTED
+        if grant.council_approved:
+            return GrantStatus.APPROVED
+    if grant.small_grant_is_reviewed if grant.is_small_grant else grant.interview_occurred:
+        return GrantStatus.DOCKETED
+    if grant.interview_schedule_date and not grant.is_small_grant:
+        return GrantStatus.INTERVIEW_SCHEDULED
+    return GrantStatus.SUBMITTED
+
+def update_grant_status(session, flush_context, instances):
+    """ Moves every new or modified grant into the status matching its flags
+        before it is written, so Grant.status can never go stale. Registered by
+        application.py """
+    with session.no_autoflush:
+        for obj in session.new | session.dirty:
+            if isinstance(obj, Grant):
+                status = derive_status(obj)
+                if obj.status != status:
+                    obj.status = status
+
+# Fraction of the progress bar filled for each status, keyed by (is_upfront, is_small_grant)
+status_progress = {
+    (True, True) : { GrantStatus.SUBMITTED : 0.17, GrantStatus.DOCKETED : 0.34, GrantStatus.APPROVED : 0.51,
+                     GrantStatus.DENIED : 1.0, GrantStatus.PAID : 0.68, GrantStatus.RECEIPTS_SUBMITTED : 0.85,
+                     GrantStatus.OWES_MONEY : 0.9, GrantStatus.COMPLETE : 1.0, GrantStatus.HEARING : 0.9 },
+    (True, False) : { GrantStatus.SUBMITTED : 0.14, GrantStatus.INTERVIEW_SCHEDULED : 0.28, GrantStatus.DOCKETED : 0.42,
+                      GrantStatus.APPROVED : 0.56, GrantStatus.DENIED : 1.0, GrantStatus.PAID : 0.70,
+                      GrantStatus.RECEIPTS_SUBMITTED : 0.84, GrantStatus.OWES_MONEY : 0.9, GrantStatus.COMPLETE : 1.0,
+                      GrantStatus.HEARING : 0.9 },
+    (False, True) : { GrantStatus.SUBMITTED : 0.2, GrantStatus.DOCKETED : 0.4, GrantStatus.APPROVED : 0.6,
+                      GrantStatus.RECEIPTS_SUBMITTED : 0.8, GrantStatus.COMPLETE : 1.0, GrantStatus.HEARING : 0.9 },
+    (False, False) : { GrantStatus.SUBMITTED : 0.17, GrantStatus.INTERVIEW_SCHEDULED : 0.33, GrantStatus.DOCKETED : 0.49,
+                       GrantStatus.APPROVED : 0.65, GrantStatus.RECEIPTS_SUBMITTED : 0.81, GrantStatus.COMPLETE : 1.0,
+                       GrantStatus.HEARING : 0.9 },
+}
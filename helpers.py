@@ -8,22 +8,28 @@
 #
 
 from urllib.parse import parse_qs
+from re import match
 from pytz import timezone, utc
 from flask_login import LoginManager, current_user, login_required
-from flask import flash, redirect, url_for, render_template
+from flask import flash, redirect, url_for, render_template, g, current_app
 from hashlib import pbkdf2_hmac
 from binascii import hexlify
 from functools import wraps
-from os import urandom
+from os import urandom, makedirs
 from os.path import join, isdir, dirname
 from flask_mail import Message
 from sys import argv
-from threading import Thread
-from collections import namedtuple
-from queue import Queue
+from threading import Lock
+from collections import namedtuple, OrderedDict
+from smtplib import SMTPException
+from time import perf_counter, monotonic
 from datetime import datetime, timedelta
 from sqlalchemy.sql.expression import or_ as OR, and_ as AND
+from sqlalchemy.orm import load_only
+from sqlalchemy import event, cast, Integer, Text
 from database_models import *
+from grant_status import *
+from organization_standing import *
 
 # Avoid import errors for installation script
 if "installation" not in argv[0]:
@@ -92,8 +98,9 @@ def install_secret_key(app, filename='secret.key'):
     except IOError:
         if not isdir(dirname(filename)):
             makedirs(dirname(filename))
+        app.config['SECRET_KEY'] = urandom(24)
         with open(filename, 'wb+') as f:
-            f.write(urandom(24))
+            f.write(app.config['SECRET_KEY'])
         print("Generated Random Secret Key")
 
 def get_grant_args(query_string):
@@ -109,8 +116,8 @@ def get_grant_args(query_string):
     valid_queries = tuple(grant_fields)
     parsed_args = []
     for arg in raw_data:
-        # Skip first param, check if if arg starts with acceptable field
-        if len(parsed_args) == 0 or arg.startswith(valid_queries):
+        # Skip first param, check if if arg starts with acceptable field or numbered line item
+        if len(parsed_args) == 0 or arg.startswith(valid_queries) or match(line_item_field, arg):
             # add argument to list and escapse ';', '+', and '#'
             parsed_args.append(arg.replace(';','%3B').replace('+','%2B').replace('#','%23'))
         else:
@@ -120,30 +127,146 @@ def get_grant_args(query_string):
     clean_query = "&".join(parsed_args)
     return parse_qs(clean_query)
 
-def serialize_grant(grant):
-    """ Turns grant object into a dictionary that can be easily JSONified for API calls """
-    return {
-            'grant_id' : grant.grant_id,
-            'organization' : grant.organization,
-            'project' : grant.project,
-            'grants_pack' : grant.grants_pack,
-            'interview_or_review_occurred' : grant.small_grant_is_reviewed if grant.is_small_grant else grant.interview_occurred,
-            'cpf_submitted' : grant.receipts_submitted,
-            'funds_dispensed' : grant.amount_dispensed
-        }
+def next_grant_id(grant_prefix):
+    """ Atomically reserves the next Grant ID in the given grants week. The counter is
+        incremented by the database itself, so simultaneous submissions (even from
+        separate worker processes) can never be handed the same ID. Returns None if
+        the grants week does not exist """
 
-def serialize_grant_full(grant):
-    """ Serializes every data member in the grant object to a dictionary for multithreading """
-
-    # create empty dict
-    _grant = {}
-
-    # Populate with data
-    for c in Grant.__table__.columns:
-        _grant[c.name] = getattr(grant, c.name)
+    # Increment in a single UPDATE statement, which takes the database write lock
+    updated = Grants_Week.query.filter_by(grant_week=grant_prefix).update({ Grants_Week.num_grants : Grants_Week.num_grants + 1 }, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        return None
 
-    # return populated dict
-    return _grant
+    # Read back our own increment before releasing the lock
+    num_grants = db.session.query(Grants_Week.num_grants).filter_by(grant_week=grant_prefix).scalar()
+    db.session.commit()
+    return grant_prefix + "-" + str(num_grants)
+
+# Matches numbered line item query fields, e.g. 'revenue3_amount' or 'app_expense12_type'
+line_item_field = r'(revenue|app_expense|expense)(\d+)_(type|description|amount)='
+
+def get_line_items(args, prefix, model):
+    """ Builds a list of line item objects of the given model from numbered
+        query string arguments (e.g. prefix 'revenue' reads 'revenue1_type',
+        'revenue1_amount', 'revenue2_type', ...). There is no limit on the
+        number of lines, and empty values are ignored. """
+    lines = {}
+    for key, value in args.items():
+        field = match(line_item_field, key + '=')
+        if field and field.group(1) == prefix and hasattr(model, field.group(3)) and value[0]:
+            line = lines.setdefault(int(field.group(2)), {})
+            line[field.group(3)] = float(value[0]) if field.group(3) == 'amount' else value[0]
+    return [model(number, **fields) for number, fields in sorted(lines.items())]
+
+def summarize_line_items(lines):
+    """ Formats a list of grant line items as a single human-readable string
+        (e.g. 'Food: Pizza ($40.00); Publicity: Posters ($12.50)') """
+    summary = []
+    for line in lines:
+        label = ": ".join(filter(None, [getattr(line, 'type', None), line.description]))
+        summary.append(label + " (" + usd(line.amount) + ")")
+    return "; ".join(summary)
+
+def grant_query(profile):
+    """ Returns a Grant query which only loads the columns in the named profile
+        (see grant_profiles in database_models.py). Accessing any other column on
+        the results costs an extra query per grant, so profiles must match the
+        templates that use them """
+    return Grant.query.options(load_only(*[getattr(Grant, column) for column in grant_profiles[profile]]))
+
+# Statuses of the grants which can appear on the treasurer dashboard
+treasurer_dashboard_statuses = [GrantStatus.APPROVED, GrantStatus.RECEIPTS_SUBMITTED]
+
+def treasurer_dashboard():
+    """ Fetches every grant which needs the treasurer's attention in a single query and
+        sorts them into the dashboard's lists in one pass. The grants are read-only rows
+        holding the treasurer_dashboard profile's columns. Returns a dictionary of the
+        lists (retroactive_grants, upfront_grants and upfront_receipts), along with
+        bad_orgs, the set of names of the organizations in bad standing """
+    dashboard = {'retroactive_grants': [], 'upfront_grants': [], 'upfront_receipts': []}
+    # Plain rows rather than Grant objects, since building thousands of objects costs more than the query
+    columns = [getattr(Grant, column) for column in grant_profiles['treasurer_dashboard']]
+    grants = db.session.query(*columns).filter(Grant.status.in_(treasurer_dashboard_statuses)).order_by(Grant.id).all()
+    for grant in grants:
+        if grant.status == GrantStatus.RECEIPTS_SUBMITTED and not grant.is_upfront and grant.council_approved:
+            dashboard['retroactive_grants'].append(grant)
+        elif grant.status == GrantStatus.RECEIPTS_SUBMITTED and grant.is_upfront and grant.is_paid:
+            dashboard['upfront_receipts'].append(grant)
+        elif grant.is_upfront and not grant.is_paid and grant.council_approved and grant.amount_allocated not in (0, None):
+            dashboard['upfront_grants'].append(grant)
+    dashboard['bad_orgs'] = organizations_in_bad_standing()
+    return dashboard
+
+def update_grants_pack_membership(grants_pack, grants):
+    """ Moves the selected grants into grants_pack and the unselected ones out of it with
+        one UPDATE each, in a single transaction. grants is the list of {grant_id, selected}
+        dictionaries POSTed by the grants pack edit page; if a grant is listed twice, the last
+        entry wins. Returns the IDs of the grants which were added, removed, already where
+        they belonged, or not found """
+    selections = OrderedDict()
+    for grant in grants:
+        grant_id = grant.get('grant_id')
+        selected = grant.get('selected')
+        # Ignore entries without a grant_id or a valid selected value
+        if grant_id and selected != None:
+            selections[grant_id] = bool(selected)
+
+    # Work out what will change before changing it
+    current = dict(db.session.query(Grant.grant_id, Grant.grants_pack).filter(Grant.grant_id.in_(list(selections))))
+    diff = {'added': [], 'removed': [], 'unchanged': [], 'not_found': []}
+    for grant_id, selected in selections.items():
+        if grant_id not in current:
+            diff['not_found'].append(grant_id)
+        elif selected and current[grant_id] != grants_pack:
+            diff['added'].append(grant_id)
+        elif not selected and current[grant_id] == grants_pack:
+            diff['removed'].append(grant_id)
+        else:
+            diff['unchanged'].append(grant_id)
+
+    # Only grants in this pack can be removed from it
+    if diff['added']:
+        Grant.query.filter(Grant.grant_id.in_(diff['added'])).update({'grants_pack': grants_pack}, synchronize_session=False)
+    if diff['removed']:
+        Grant.query.filter(Grant.grant_id.in_(diff['removed']), Grant.grants_pack==grants_pack).update({'grants_pack': None}, synchronize_session=False)
+    db.session.commit()
+    return diff
+
+# {field: (Grant columns it is computed from, function computing it from a grant)} of each
+# field of a serialized grant, in the order they are serialized
+serialized_grant_fields = OrderedDict([
+    ('grant_id', (['grant_id'], lambda grant: grant.grant_id)),
+    ('organization', (['organization'], lambda grant: grant.organization)),
+    ('project', (['project'], lambda grant: grant.project)),
+    ('grants_pack', (['grants_pack'], lambda grant: grant.grants_pack)),
+    ('interview_or_review_occurred', (['is_small_grant', 'small_grant_is_reviewed', 'interview_occurred'],
+        lambda grant: grant.small_grant_is_reviewed if grant.is_small_grant else grant.interview_occurred)),
+    ('cpf_submitted', (['receipts_submitted'], lambda grant: grant.receipts_submitted)),
+    ('funds_dispensed', (['amount_dispensed'], lambda grant: grant.amount_dispensed)),
+])
+
+def serialize_grant(grant, fields=serialized_grant_fields):
+    """ Turns grant object (or a row with the columns the fields need) into a dictionary
+        of the given fields that can be easily JSONified for API calls """
+    return OrderedDict((field, serialized_grant_fields[field][1](grant)) for field in fields)
+
+def lookup_grants_page(queries, after=0, limit=None, fields=serialized_grant_fields):
+    """ Returns (serialized grants, primary key of the last one, whether there are more) for
+        the grants whose organization or project name is one of the queries, in grant order,
+        starting after the given primary key. Grants matching more than one query (or both
+        by organization and project) are listed once. Only the columns the fields need are read """
+    names = sorted(set(column for field in fields for column in serialized_grant_fields[field][0]))
+    query = db.session.query(Grant.id, *[getattr(Grant, name) for name in names]) \
+        .filter(OR(Grant.organization.in_(queries), Grant.project.in_(queries)), Grant.id > after) \
+        .order_by(Grant.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = query.all()
+    more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    return [serialize_grant(row, fields) for row in rows], (rows[-1].id if rows else after), more
 
 def encrypt(password, salt):
     """ Provides a default implementation of the encryption algorithm used by nova """
@@ -186,6 +309,42 @@ def treasurer_required(func):
         return func(*args, **kwargs)
     return decorated_view
 
+class QueryBudgetExceeded(AssertionError):
+    """ Raised when a view runs more SQL statements than its query_budget allows """
+
+def query_budget(limit):
+    """ Sets the most SELECTs a view may run, however many grants it handles, as counted
+        by request_metrics. Going over is logged, and raises QueryBudgetExceeded when the
+        ENFORCE_QUERY_BUDGETS setting is on (as it is in benchmark.py's query_budgets
+        check). Should wrap below @login_required and the privilege wrappers, so that only
+        the view is counted """
+    def wrapper(func):
+        @wraps(func)
+        def decorated_view(*args, **kwargs):
+            start = g.get('sql_selects', 0)
+            response = func(*args, **kwargs)
+            used = g.get('sql_selects', 0) - start
+            if used > limit:
+                message = func.__name__ + " ran " + str(used) + " queries, over its budget of " + str(limit)
+                if current_app.config.get('ENFORCE_QUERY_BUDGETS'):
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+            return response
+        # (read by benchmark.py to find the budgeted views)
+        decorated_view.query_budget = limit
+        return decorated_view
+    return wrapper
+
+def prefetch_grants(grant_ids, query=None):
+    """ Loads the grants with the given grant IDs in a single query, for batch forms.
+        query defaults to Grant.query, and may be a grant_query() profile. Returns a
+        {grant_id: grant} dictionary and a sorted list of the grant IDs which do not exist """
+    grant_ids = set(grant_ids)
+    if query is None:
+        query = Grant.query
+    grants = {grant.grant_id: grant for grant in query.filter(Grant.grant_id.in_(grant_ids))} if grant_ids else {}
+    return grants, sorted(grant_ids - set(grants))
+
 def isfloat(value):
     """ Simple function that return a Boolean representing whether
         the input string was in valid float form """
@@ -195,422 +354,339 @@ def isfloat(value):
         return False
     return True
 
-class DictObj(object):
-    """ Simple class which will let us create object from dict """
-    def __init__(self, d):
-        self.__dict__ = d
-
-# We want to send email in the background, but sending multiple
-# simultaneously causes problems with Google's SMPTP server.
-# As such, we will use a single background worker thread with
-# a thread-safe queue to handle sneding emails.
-q = Queue()
-def worker():
-    while True:
-        (func,grant) = q.get()
-        func(grant)
-        q.task_done()
-thr = Thread(target=worker)
-thr.daemon = True
-thr.start()
-
-def async_grant(func):
-    """ Runs function on separate thread with a dictionary-serialized-object version
-        of the grant argument to eliminate SQL-Alchemy multithreading issues.
-        Should wrap like: @async_grants """
-    def inner_wrapper(_grant):
-        # Retrieve app context in separate thread
-        with application.app.app_context():
-            func(_grant)
-    def wrapper(grant):
-        _grant = DictObj(serialize_grant_full(grant))
-        q.put((inner_wrapper,_grant))
-    return wrapper
+class ConfigCache(object):
+    """ Process-wide copy of the Config table, so that configuration lookups don't
+        cost a database round trip each. Any change to a Config row also increments
+        the config_version row, and each process re-reads the whole table when it
+        sees a new version (checked at most once every check_interval seconds) """
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.values = None
+        self.version = None
+        self.checked = 0.0
+        self.lock = Lock()
+
+    def get(self, key, type=str):
+        """ Returns the value of the Config key converted to type (str, int, float
+            or bool), or None if the key is not set """
+        self.refresh()
+        value = self.values.get(key)
+        if value is None or type is str:
+            return value
+        if type is bool:
+            return value in ('1', 'True', 'true')
+        return type(value)
+
+    def refresh(self):
+        """ Reloads the table if another process (or this one) has changed it """
+        with self.lock:
+            now = monotonic()
+            if self.values is not None and now - self.checked < self.check_interval:
+                return
+            version = db.session.query(Config.value).filter_by(key=config_version_key).scalar()
+            if self.values is None or version != self.version:
+                self.values = dict(db.session.query(Config.key, Config.value).all())
+                self.version = version
+            self.checked = now
+
+    def invalidate(self):
+        """ Forces the table to be re-read on the next lookup """
+        with self.lock:
+            self.values = None
+
+# The Config row which counts changes to every other Config row
+config_version_key = 'config_version'
+config_cache = ConfigCache(1.0)
+
+@event.listens_for(db.session, 'before_flush')
+def bump_config_version(session, flush_context, instances):
+    """ Increments the config version whenever a Config row is added, changed or
+        deleted, so that every process reloads its ConfigCache """
+    if not any(isinstance(obj, Config) and obj.key != config_version_key for obj in session.new | session.dirty | session.deleted):
+        return
+    bumped = session.connection().execute(Config.__table__.update().where(Config.__table__.c.key == config_version_key)
+                                          .values(value=cast(cast(Config.__table__.c.value, Integer) + 1, Text)))
+    if not bumped.rowcount:
+        session.add(Config(config_version_key, '1'))
+    session.info['config_changed'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def reload_config(session):
+    """ Drops this process's cached config as soon as its own changes are committed """
+    if session.info.pop('config_changed', False):
+        config_cache.invalidate()
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_config_change(session):
+    session.info.pop('config_changed', None)
+
+class MailSender(object):
+    """ Keeps one SMTP connection open for a Flask-Mail sender so that a batch of
+        messages shares a single TLS handshake and login, reconnecting (and retrying
+        the message once) if the server drops the connection. Also keeps simple
+        throughput counters for the sender. """
+    def __init__(self, mail):
+        self.mail = mail
+        self.connection = None
+        self.lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.connects = 0
+        self.send_seconds = 0.0
+
+    def send(self, msg):
+        with self.lock:
+            start = perf_counter()
+            try:
+                for attempt in range(2):
+                    try:
+                        if self.connection is None:
+                            self.connection = self.mail.connect().__enter__()
+                            self.connects += 1
+                        self.connection.send(msg)
+                        self.sent += 1
+                        return
+                    except (SMTPException, OSError):
+                        # Stale or broken connection, so start over with a fresh one
+                        self.drop()
+                        if attempt:
+                            self.failed += 1
+                            raise
+            finally:
+                self.send_seconds += perf_counter() - start
+
+    def close(self):
+        """ Politely ends the current connection, if there is one """
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection.__exit__(None, None, None)
+                except (SMTPException, OSError):
+                    pass
+                self.connection = None
+
+    def drop(self):
+        """ Abandons the current connection without talking to the server """
+        if self.connection is not None and self.connection.host is not None:
+            self.connection.host.close()
+        self.connection = None
+
+    def metrics(self):
+        """ Returns the throughput counters for this sender """
+        return {
+                'sent' : self.sent,
+                'failed' : self.failed,
+                'connections' : self.connects,
+                'send_seconds' : round(self.send_seconds, 3),
+                'emails_per_second' : round(self.sent / self.send_seconds, 2) if self.send_seconds else 0.0
+            }
+
+# One persistent sender per Flask-Mail instance (application.mail and application.treasurer_mail)
+mail_senders = {}
+
+def send_email(mail, msg):
+    """ Sends msg through the persistent connection for the given Flask-Mail instance """
+    if mail not in mail_senders:
+        mail_senders[mail] = MailSender(mail)
+    mail_senders[mail].send(msg)
+
+def mail_metrics():
+    """ Returns throughput counters for each sender, keyed by sender address """
+    return { sender.mail.default_sender[1] if isinstance(sender.mail.default_sender, tuple) else sender.mail.default_sender : sender.metrics() for sender in mail_senders.values() }
 
 def if_email(func):
     """ Simple wrapper to only run function if the email_enabled Config
         option is set to True """
-    def wrapper(grant):
-        email = Config.query.filter_by(key='enable_email').first()
-        if email.value == '1':
-            func(grant)
+    def wrapper(*args):
+        if config_cache.get('enable_email', bool):
+            func(*args)
     return wrapper
 
-@if_email
-@async_grant
-def email_application_submitted(grant):
-    """ Sends an application submitted confirmation email to the grant applicant """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Application Submitted: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "submitted.gif"
-
-    # Attach HTML Body
-    html = render_template("email/grant_submit.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-    print(html)
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_application_passed(grant):
-    """ Sends an email to the grant applicant stating the grant has passed the council
-        and requesting receipts """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Application Passed: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "receipts.gif"
-
-    # Attach HTML Body
-    html = render_template("email/grant_passed.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_application_denied(grant):
-    """ Sends an email to the grant applicant stating the grant has been denied
-        by the council """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Application Denied: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "denied.gif"
-
-    # Attach HTML Body
-    html = render_template("email/grant_denied.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_interview_scheduled(grant):
-    """ Sends an email to the grant applicant stating the interview for the grant
-        has been scheduled """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Interview Scheduled: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "scheduled.gif"
-
-    # Attach HTML Body
-    html = render_template("email/interview_scheduled.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_interview_completed(grant):
-    """ Sends an email to the grant applicant stating the interview for the grant
-        has been completed """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Interview Completed: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "interviewed.gif"
-
-    # Attach HTML Body
-    html = render_template("email/interview_complete.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_direct_deposit(grant):
-    """ Sends an email to the grant applicant stating the funds have been direct deposited
-        into their bank account """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Funds Deposited: " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Define attached image
-    image = "deposited.gif"
-
-    # Attach HTML Body
-    html = render_template("email/direct_deposit.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.treasurer_mail.send(msg)
+# Describes each kind of templated email. The subject and image may also be
+# functions of the grant when they depend on the grant's state.
+EmailKind = namedtuple('EmailKind', ['subject', 'template', 'image', 'treasurer'])
+
+def owes_money(grant):
+    """ Returns whether the grant still has to pay money back to the UC """
+    return grant.must_reimburse_uc and not grant.reimbursed_uc
+
+email_kinds = {
+    'application_submitted' : EmailKind("Grant Application Submitted", "email/grant_submit.html", "submitted.gif", False),
+    'application_passed' : EmailKind("Grant Application Passed", "email/grant_passed.html", "receipts.gif", False),
+    'application_denied' : EmailKind("Grant Application Denied", "email/grant_denied.html", "denied.gif", False),
+    'interview_scheduled' : EmailKind("Grant Interview Scheduled", "email/interview_scheduled.html", "scheduled.gif", False),
+    'interview_completed' : EmailKind("Grant Interview Completed", "email/interview_complete.html", "interviewed.gif", False),
+    'receipts_submitted' : EmailKind("Grant Receipts Submitted", "email/receipts_submitted.html", "receipts_submitted.gif", False),
+    'submit_receipts' : EmailKind("Submit Receipts", "email/submit_receipts.html", "receipts.gif", False),
+    'direct_deposit' : EmailKind("Grant Funds Deposited", "email/direct_deposit.html", "deposited.gif", True),
+    'check' : EmailKind("Grant Check Ready", "email/check.html", "check.gif", True),
+    'receipts_reviewed' : EmailKind(lambda grant: "Owed Money on Grant" if owes_money(grant) else "Grant Receipts Reviewed",
+                                    "email/receipts_reviewed.html", lambda grant: "owe.gif" if owes_money(grant) else "done.gif", True),
+    'receipts_not_submitted' : EmailKind("Receipts Deadline Passed", "email/receipts_not_submitted.html",
+                                         lambda grant: "owe.gif" if grant.is_upfront else "denied.gif", True),
+    'owed_money' : EmailKind("Owed Money Reminder", "email/owed_money_notice.html", "owe.gif", True),
+    'reimbursement_complete' : EmailKind("Grant Process Complete", "email/reimbursement_complete.html", "done.gif", True),
+}
+
+# Treasurer emails are sent from the treasurer account under this name
+treasurer_sender = ("UC Treasurer", "harvarductreasurer@gmail.com")
+
+class AttachmentCache(object):
+    """ Holds email images in memory so that each file is read from disk once rather
+        than once per message. The least recently used images are evicted when the
+        total size would exceed max_bytes. """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        with self.lock:
+            if name in self.images:
+                self.hits += 1
+                self.images.move_to_end(name)
+                return self.images[name]
+            self.misses += 1
+            with open(join(self.directory, name), 'rb') as fp:
+                data = fp.read()
+            # Too big to cache, so just hand it back
+            if len(data) > self.max_bytes:
+                return data
+            while self.size + len(data) > self.max_bytes:
+                self.size -= len(self.images.popitem(last=False)[1])
+            self.images[name] = data
+            self.size += len(data)
+            return data
+
+    def preload(self):
+        """ Reads every image used by an email kind into the cache """
+        for kind in email_kinds.values():
+            if isinstance(kind.image, str):
+                self.get(kind.image)
+
+    def metrics(self):
+        """ Returns the hit/miss counters and memory used by the cache """
+        return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'images' : len(self.images),
+                'bytes' : self.size
+            }
+
+# All of the email images (about 12 MB) fit comfortably within the default bound
+email_images = AttachmentCache(join(dirname(__file__), "templates", "email", "images"), 32 * 1024 * 1024)
 
 @if_email
-@async_grant
-def email_receipts_submitted(grant):
-    """ Sends an email to the grant applicant stating the the receipts have been
-        submitted """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
+def send_templated_email(kind, grant):
+    """ Queues the email of the given kind (see email_kinds) about the grant in the
+        email outbox. The email is only queued once the caller commits the session,
+        and is then sent by the email dispatcher (email_dispatcher.py) """
+    db.session.add(EmailOutbox(kind, grant))
+
+def build_templated_email(kind, grant):
+    """ Renders the email of the given kind about the grant to the grant applicant.
+        Returns the message along with the Flask-Mail instance which should send it
+        (the treasurer account for treasurer emails) """
+    kind = email_kinds[kind]
+    subject = kind.subject(grant) if callable(kind.subject) else kind.subject
+    image = kind.image(grant) if callable(kind.image) else kind.image
 
     # Create Message
-    msg = Message("Grant Receipts Submitted: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "receipts_submitted.gif"
-
-    # Attach HTML Body
-    html = render_template("email/receipts_submitted.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_check(grant):
-    """ Sends an email to the grant applicant stating the a check is ready to be picked
-        up for their grant """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Check Ready: " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Define attached image
-    image = "check.gif"
-
-    # Attach HTML Body
-    html = render_template("email/check.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.treasurer_mail.send(msg)
-
-@if_email
-@async_grant
-def email_receipts_reviewed(grant):
-    """ Sends an email to the grant applicant stating the their receipts have been reviewed
-        and approved/owe money """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Define subject and image
-    if grant.must_reimburse_uc and not grant.reimbursed_uc:
-        subject = "Owed Money on Grant"
-        image = "owe.gif"
-        grant.owed_money_email_date = datetime.now()
-        db.session.commit()
+    if kind.treasurer:
+        msg = Message(subject + ": " + grant.project, recipients=[grant.contact_email], sender=treasurer_sender)
     else:
-        subject = "Grant Receipts Reviewed"
-        image = "done.gif"
-
-    # Create Message
-    msg = Message(subject + ": " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Attach HTML Body
-    html = render_template("email/receipts_reviewed.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.treasurer_mail.send(msg)
-
-@if_email
-@async_grant
-def email_submit_receipts(grant):
-    """ Sends a reminder email to the grant applicant to submit receipts """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Submit Receipts: " + grant.project, recipients=[grant.contact_email])
-
-    # Define attached image
-    image = "receipts.gif"
+        msg = Message(subject + ": " + grant.project, recipients=[grant.contact_email])
 
     # Attach HTML Body
-    html = render_template("email/submit_receipts.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
+    msg.html = render_template(kind.template, grant=grant, image=image, treasurer_name=config_cache.get('treasurer_name'))
 
     # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.mail.send(msg)
-
-@if_email
-@async_grant
-def email_receipts_not_submitted(grant):
-    _email_receipts_not_submitted(grant)
-
-def _email_receipts_not_submitted(grant):
-    """ Sends an email to the grant applicant letting them know that they did not submit receipts
-        before the deadline """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Receipts Deadline Passed: " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Define attached image
-    if grant.is_upfront:
-        image = "owe.gif"
-    else:
-        image = "denied.gif"
-
-    # Attach HTML Body
-    html = render_template("email/receipts_not_submitted.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.treasurer_mail.send(msg)
-
-@if_email
-@async_grant
-def email_owed_money(grant):
-    _email_owed_money(grant)
-
-def _email_owed_money(grant):
-    """ Send an email to the grant applicant reminding them that they owe money """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Owed Money Reminder: " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Define attached image
-    image = "owe.gif"
-
-    # Attach HTML Body
-    html = render_template("email/owed_money_notice.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
-
-    # Send Email
-    application.treasurer_mail.send(msg)
-
-@if_email
-@async_grant
-def email_reimbursement_complete(grant):
-    """ Send an email to the grant applicant notifying them that the grant UC reimbursement process is complete """
-
-    # Get treasurer name
-    treasurer_name = Config.query.filter_by(key='treasurer_name').first()
-
-    # Create Message
-    msg = Message("Grant Process Complete: " + grant.project, recipients=[grant.contact_email], sender=("UC Treasurer", "harvarductreasurer@gmail.com"))
-
-    # Define attached image
-    image = "done.gif"
-
-    # Attach HTML Body
-    html = render_template("email/reimbursement_complete.html", grant=grant, image=image, treasurer_name=treasurer_name.value)
-    msg.html = html
-
-    # Attach Image
-    with application.app.open_resource("templates/email/images/%s" % image) as fp:
-        msg.attach(image, "image/gif", fp.read(), headers=[['Content-ID', '<%s>' % image],])
+    msg.attach(image, "image/gif", email_images.get(image), headers=[['Content-ID', '<%s>' % image],])
+
+    return msg, application.treasurer_mail if kind.treasurer else application.mail
+
+# Failed emails are retried after 1, 2, 4, ... minutes (at most an hour apart),
+# and given up on after email_max_attempts tries
+email_retry_base = timedelta(minutes=1)
+email_retry_max = timedelta(hours=1)
+email_max_attempts = 8
+# Emails claimed by a dispatcher which hasn't finished them within this time
+# (e.g. because it crashed) are claimed again by another dispatcher
+email_claim_timeout = timedelta(minutes=10)
+
+def claim_outbox_emails(batch_size):
+    """ Atomically claims up to batch_size due emails from the outbox for this
+        dispatcher, so that several dispatchers never send the same email """
+    now = datetime.utcnow()
+    token = hexlify(urandom(16)).decode('utf-8')
+    due = db.session.query(EmailOutbox.id).filter(OR(AND(EmailOutbox.status=='pending', EmailOutbox.next_attempt<=now),
+                                                     AND(EmailOutbox.status=='sending', EmailOutbox.claimed_at<now - email_claim_timeout))) \
+                                          .order_by(EmailOutbox.id).limit(batch_size)
+    # Re-check the status in the UPDATE itself, in case another dispatcher got there first
+    EmailOutbox.query.filter(EmailOutbox.id.in_(due.scalar_subquery()), EmailOutbox.status.in_(['pending', 'sending'])) \
+                     .update({ EmailOutbox.status : 'sending', EmailOutbox.claimed_by : token, EmailOutbox.claimed_at : now }, synchronize_session=False)
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claimed_by=token, status='sending').order_by(EmailOutbox.id).all()
+
+def dispatch_outbox_emails(batch_size=50):
+    """ Sends one batch of emails from the outbox, recording the outcome of each and
+        scheduling failed emails for a retry with exponential backoff. Returns the
+        number of emails claimed """
+    emails = claim_outbox_emails(batch_size)
+    for email in emails:
+        try:
+            msg, mail = build_templated_email(email.kind, email.grant)
+            send_email(mail, msg)
+        except Exception as e:
+            email.attempts += 1
+            email.last_error = repr(e)
+            if email.attempts >= email_max_attempts:
+                email.status = 'failed'
+            else:
+                email.status = 'pending'
+                email.next_attempt = datetime.utcnow() + min(email_retry_base * 2 ** (email.attempts - 1), email_retry_max)
+            print("Error sending email " + str(email.id) + ": " + email.last_error)
+        else:
+            email.attempts += 1
+            email.status = 'sent'
+            email.sent = datetime.utcnow()
+        email.claimed_by = None
+        # Record each outcome straight away so a crash can't cause a resend
+        db.session.commit()
+    return len(emails)
 
-    # Send Email
-    application.treasurer_mail.send(msg)
+def close_mail_connections():
+    """ Closes the open SMTP connections of every sender """
+    for sender in mail_senders.values():
+        sender.close()
 
 def send_owe_money_emails():
     """ Sends emails to all groups that owe money to the UC reminding them to pay """
     with application.app.app_context():
-        email = Config.query.filter_by(key='enable_email').first()
-        if email.value == '1':
+        if config_cache.get('enable_email', bool):
             # Don't bug people if we bugged them within past 2 days
             print("Sending Owed Money Emails")
             now = datetime.now()
             two_days_ago = now - timedelta(days=2)
             # Query for no receipts grants
-            no_receipts = Grant.query.filter(AND(AND(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.receipts_submitted==False), Grant.receipts_due < datetime.now()), Grant.amount_dispensed>0), Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
+            no_receipts = Grant.query.filter(Grant.status==GrantStatus.PAID, Grant.receipts_due < datetime.now(), Grant.amount_dispensed>0).all()
             for grant in no_receipts:
                 print(grant.grant_id)
                 if grant.owed_money_email_date and grant.owed_money_email_date < two_days_ago:
-                    email_owed_money(grant)
+                    send_templated_email('owed_money', grant)
                 elif not grant.owed_money_email_date:
-                    email_receipts_not_submitted(grant)
+                    send_templated_email('receipts_not_submitted', grant)
                     grant.owed_money_email_date = now
             # Query for grants that didn't spend all money
-            unspent_money = Grant.query.filter(AND(AND(AND(AND(Grant.council_approved==True,Grant.amount_allocated>0),Grant.must_reimburse_uc==True),Grant.reimbursed_uc==False, OR(OR(Grant.hearing_requested==False,Grant.hearing_requested==None),Grant.hearing_occurred==True)))).all()
+            unspent_money = Grant.query.filter_by(status=GrantStatus.OWES_MONEY).all()
             for grant in unspent_money:
                 print(grant.grant_id)
                 if not grant.owed_money_email_date or grant.owed_money_email_date < two_days_ago:
-                    email_owed_money(grant)
+                    send_templated_email('owed_money', grant)
                     if not grant.owed_money_email_date:
                         grant.owed_money_email_date = now
             db.session.commit()
@@ -618,11 +694,11 @@ def send_owe_money_emails():
 def send_receipt_reminder_emails():
     """ Sends emails to all groups that need to submit receipts reminding them to do so """
     with application.app.app_context():
-        email = Config.query.filter_by(key='enable_email').first()
-        if email.value == '1':
+        if config_cache.get('enable_email', bool):
             print("Sending Receipt Reminder Emails")
             # Query for no receipts grants
             grants = Grant.query.filter(AND(AND(Grant.receipts_submitted==False,Grant.council_approved==True), Grant.amount_allocated>0)).all()
             for grant in grants:
                 print(grant.grant_id)
-                email_submit_receipts(grant)
+                send_templated_email('submit_receipts', grant)
+            db.session.commit()
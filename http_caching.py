@@ -0,0 +1,133 @@
+#
+# http_caching.py
+#
+# Lets browsers reuse what they have already downloaded. Read-only
+# pages and files are sent with an ETag (and Last-Modified) computed
+# from the version of the data behind them (a grant's updated_at, an
+# uploaded file's contents), so a browser revalidating a page it has
+# is answered 304 Not Modified before anything is rendered. Static
+# files are linked with a hash of their contents and may be cached
+# for a year.
+#
+
+from os import walk, stat
+from os.path import join
+from hashlib import sha1
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from flask import request, session, make_response, send_from_directory, Response
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from page_cache import grant_version
+
+# Cache-Control of static files linked with the hash of their contents
+immutable = 'public, max-age=31536000, immutable'
+
+class HttpCaching(object):
+    """ Computes validators for an app's responses. Static files linked through url_for get
+        a v= argument with the hash of their contents, and are served with a year-long
+        Cache-Control when it matches """
+    def __init__(self, app=None):
+        # {path: ((modification time, size), hash of its contents)}
+        self.hashes = {}
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # Rendered pages change when their templates do, so their validators include the
+        # templates' version (the hash of every template) and Last-Modified time
+        versions = []
+        self.templates_modified = datetime.utcfromtimestamp(0)
+        for folder, folders, files in walk(join(app.root_path, app.template_folder)):
+            for name in sorted(files):
+                path = join(folder, name)
+                versions.append(self.file_hash(path))
+                self.templates_modified = max(self.templates_modified, datetime.utcfromtimestamp(stat(path).st_mtime))
+        self.templates_version = sha1(''.join(sorted(versions)).encode('utf-8')).hexdigest()[:16]
+        app.url_defaults(self.version_static_url)
+        app.after_request(self.cache_static_file)
+
+    def file_hash(self, path):
+        """ Returns a hash of the file's contents (re-read only when the file changes), or
+            None if there is no such file """
+        try:
+            info = stat(path)
+        except OSError:
+            return None
+        key = (info.st_mtime, info.st_size)
+        with self.lock:
+            cached = self.hashes.get(path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+        with open(path, 'rb') as file:
+            digest = sha1(file.read()).hexdigest()[:16]
+        with self.lock:
+            self.hashes[path] = (key, digest)
+        return digest
+
+    def static_version(self, filename):
+        """ Returns the hash of a static file, or None if there is no such file """
+        return self.file_hash(join(self.app.static_folder, filename))
+
+    def version_static_url(self, endpoint, values):
+        """ Adds the hash of a static file's contents to its URL """
+        if endpoint == 'static' and 'v' not in values:
+            version = self.static_version(values.get('filename', ''))
+            if version:
+                values['v'] = version
+
+    def cache_static_file(self, response):
+        """ Lets browsers keep static files requested by their current hash """
+        if request.endpoint == 'static' and response.status_code in (200, 304):
+            version = request.args.get('v')
+            if version and version == self.static_version(request.view_args['filename']):
+                response.headers['Cache-Control'] = immutable
+        return response
+
+    def conditional(self, etag, last_modified, cache_control, render):
+        """ Returns 304 Not Modified, without calling render, if the request's If-None-Match
+            or If-Modified-Since matches the validators. Otherwise returns render()'s
+            response, with the validators if it succeeded """
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response(render())
+        else:
+            response = Response(status=304)
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control
+            # Pages differ for each logged in user
+            response.vary.add('Cookie')
+        return response
+
+    def send_upload(self, filename, max_age=None):
+        """ Sends an uploaded file with an ETag of its contents. Browsers may use it without
+            revalidating for max_age seconds (if given) """
+        folder = self.app.config['UPLOAD_FOLDER']
+        return send_from_directory(folder, filename, etag=self.file_hash(join(folder, filename)) or True, max_age=max_age)
+
+http_caching = HttpCaching()
+
+def conditional_grant_page(*args):
+    """ Decorator which answers a browser revalidating a grant page with 304 Not Modified
+        if neither the grant nor the templates have changed since it was sent. Validators
+        differ for each grant_id, value of the named request args and logged in user """
+    def wrapper(view):
+        @wraps(view)
+        def decorated_view(grant_id):
+            # Flashed messages are only shown once
+            if '_flashes' in session:
+                return view(grant_id)
+            version = grant_version(grant_id)
+            if version is None:
+                return view(grant_id)
+            user = current_user.get_id() if current_user.is_authenticated else ''
+            parts = [view.__name__, grant_id, version.isoformat(), str(user), http_caching.templates_version] + [request.args.get(arg) or '' for arg in args]
+            etag = sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+            last_modified = max(version, http_caching.templates_modified)
+            return http_caching.conditional(etag, last_modified, 'private, no-cache', lambda: view(grant_id))
+        return decorated_view
+    return wrapper
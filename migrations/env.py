@@ -22,6 +22,12 @@ config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+def include_object(object, name, type_, reflected, compare_to):
+    """ Leaves the project search index out of autogenerated migrations. It is an FTS5
+        table (with shadow tables grant_search_data, _idx, _docsize and _config) which
+        project_search.py creates outside the models, so it is never in the metadata """
+    return not (type_ == 'table' and name.startswith('grant_search'))
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -41,7 +47,7 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -73,6 +79,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_object=include_object,
                       render_as_batch=True,
                       **current_app.extensions['migrate'].configure_args)
 
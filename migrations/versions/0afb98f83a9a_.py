@@ -0,0 +1,91 @@
+"""move grant revenues, expenses and receipts into line item tables
+
+Revision ID: 0afb98f83a9a
+Revises: de948ef6929a
+Create Date: 2026-10-18 01:52:17.402913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0afb98f83a9a'
+down_revision = 'de948ef6929a'
+branch_labels = None
+depends_on = None
+
+# (table, column prefix, number of flattened columns, fields) for each kind of line item
+line_items = [
+    ('grant_revenue', 'revenue', 10, ['type', 'description', 'amount']),
+    ('grant_application_expense', 'app_expense', 12, ['type', 'description', 'amount']),
+    ('grant_receipt_line', 'expense', 12, ['description', 'amount']),
+]
+
+field_types = {'type': sa.Text, 'description': sa.Text, 'amount': sa.Float}
+
+
+def flattened_columns(prefix, count, fields):
+    """ Returns the names of the old per-line columns on the grant table """
+    return [prefix + str(line) + '_' + field for line in range(1, count + 1) for field in fields]
+
+
+def line_item_table(table, fields):
+    """ Returns a lightweight table definition used to move data """
+    return sa.table(table, sa.column('grant_pk', sa.Integer), sa.column('line', sa.Integer),
+                    *[sa.column(field, field_types[field]) for field in fields])
+
+
+def upgrade():
+    for table, prefix, count, fields in line_items:
+        op.create_table(table,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('grant_pk', sa.Integer(), nullable=False),
+        sa.Column('line', sa.Integer(), nullable=True),
+        *[sa.Column(field, field_types[field](), nullable=True) for field in fields],
+        sa.ForeignKeyConstraint(['grant_pk'], ['grant.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index(batch_op.f('ix_' + table + '_grant_pk'), ['grant_pk'], unique=False)
+
+    # Move every non-empty line from the flattened grant columns into the new tables
+    connection = op.get_bind()
+    for table, prefix, count, fields in line_items:
+        columns = flattened_columns(prefix, count, fields)
+        grant = sa.table('grant', sa.column('id', sa.Integer), *[sa.column(c) for c in columns])
+        rows = []
+        for row in connection.execute(sa.select(grant)).mappings():
+            for line in range(1, count + 1):
+                values = {field: row[prefix + str(line) + '_' + field] for field in fields}
+                if any(value not in (None, '') for value in values.values()):
+                    rows.append(dict(values, grant_pk=row['id'], line=line))
+        if rows:
+            op.bulk_insert(line_item_table(table, fields), rows)
+
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        for table, prefix, count, fields in line_items:
+            for column in flattened_columns(prefix, count, fields):
+                batch_op.drop_column(column)
+
+
+def downgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        for table, prefix, count, fields in line_items:
+            for column in flattened_columns(prefix, count, fields):
+                batch_op.add_column(sa.Column(column, field_types[column.rsplit('_', 1)[1]](), nullable=True))
+
+    # Copy lines back into the flattened columns (lines beyond the old caps are discarded)
+    connection = op.get_bind()
+    for table, prefix, count, fields in line_items:
+        lines = line_item_table(table, fields)
+        grant = sa.table('grant', sa.column('id', sa.Integer), *[sa.column(c) for c in flattened_columns(prefix, count, fields)])
+        for row in connection.execute(sa.select(lines).where(lines.c.line.between(1, count))).mappings():
+            values = {prefix + str(row['line']) + '_' + field: row[field] for field in fields}
+            connection.execute(grant.update().where(grant.c.id == row['grant_pk']).values(**values))
+
+    for table, prefix, count, fields in reversed(line_items):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(batch_op.f('ix_' + table + '_grant_pk'))
+
+        op.drop_table(table)
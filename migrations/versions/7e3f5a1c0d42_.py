@@ -0,0 +1,27 @@
+"""add partial index for outstanding receipts
+
+Revision ID: 7e3f5a1c0d42
+Revises: 4c1d7e2a9b30
+Create Date: 2026-10-18 10:03:27.184096
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3f5a1c0d42'
+down_revision = '4c1d7e2a9b30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.create_index('ix_grant_receipts_outstanding', ['reimbursed_uc', 'receipts_due'], unique=False,
+                              sqlite_where=sa.text('council_approved = 1 AND receipts_submitted = 0'))
+
+
+def downgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.drop_index('ix_grant_receipts_outstanding')
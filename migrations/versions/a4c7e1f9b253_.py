@@ -0,0 +1,29 @@
+"""index grant organization and project names for grant lookup
+
+Revision ID: a4c7e1f9b253
+Revises: f3b8d2a6c417
+Create Date: 2026-10-18 19:12:44.081562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e1f9b253'
+down_revision = 'f3b8d2a6c417'
+branch_labels = None
+depends_on = None
+
+# Created without batch_alter_table, which would recreate the grant table and drop the
+# project search triggers
+
+
+def upgrade():
+    op.create_index(op.f('ix_grant_organization'), 'grant', ['organization'], unique=False)
+    op.create_index(op.f('ix_grant_project'), 'grant', ['project'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_grant_project'), table_name='grant')
+    op.drop_index(op.f('ix_grant_organization'), table_name='grant')
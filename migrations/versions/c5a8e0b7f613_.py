@@ -0,0 +1,71 @@
+"""add grant status column
+
+Revision ID: c5a8e0b7f613
+Revises: 7e3f5a1c0d42
+Create Date: 2026-10-18 11:26:05.730418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a8e0b7f613'
+down_revision = '7e3f5a1c0d42'
+branch_labels = None
+depends_on = None
+
+# Grant flags which determine a grant's status
+status_flags = ['is_upfront', 'is_small_grant', 'hearing_requested', 'hearing_occurred', 'must_reimburse_uc', 'reimbursed_uc',
+                'receipts_reviewed', 'receipts_submitted', 'is_paid', 'council_approved', 'amount_allocated',
+                'small_grant_is_reviewed', 'interview_occurred', 'interview_schedule_date']
+
+
+def derive_status(grant):
+    """ Returns the status of a grant given its flags, as grant_status.derive_status
+        defined it when this migration was written (later changes to the app must not
+        change what this migration does) """
+    if grant.hearing_requested and not grant.hearing_occurred:
+        return 'hearing'
+    if grant.is_upfront:
+        if grant.must_reimburse_uc:
+            return 'complete' if grant.reimbursed_uc else 'owes_money'
+        if grant.receipts_reviewed:
+            return 'complete'
+        if grant.receipts_submitted:
+            return 'receipts_submitted'
+        if grant.is_paid:
+            return 'paid'
+        if grant.council_approved:
+            return 'approved' if grant.amount_allocated else 'denied'
+    else:
+        if grant.is_paid:
+            return 'complete'
+        if grant.receipts_submitted:
+            return 'receipts_submitted'
+        if grant.council_approved:
+            return 'approved'
+    if grant.small_grant_is_reviewed if grant.is_small_grant else grant.interview_occurred:
+        return 'docketed'
+    if grant.interview_schedule_date and not grant.is_small_grant:
+        return 'interview_scheduled'
+    return 'submitted'
+
+
+def upgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.Text(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_grant_status'), ['status'], unique=False)
+
+    # Work out the status of every existing grant
+    connection = op.get_bind()
+    grant = sa.table('grant', sa.column('id', sa.Integer), sa.column('status', sa.Text), *[sa.column(flag) for flag in status_flags])
+    statuses = [{'grant_pk': row.id, 'status': derive_status(row)} for row in connection.execute(sa.select(grant))]
+    if statuses:
+        connection.execute(grant.update().where(grant.c.id == sa.bindparam('grant_pk')).values(status=sa.bindparam('status')), statuses)
+
+
+def downgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_grant_status'))
+        batch_op.drop_column('status')
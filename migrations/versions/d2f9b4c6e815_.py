@@ -0,0 +1,50 @@
+"""add organization standing table
+
+Revision ID: d2f9b4c6e815
+Revises: c5a8e0b7f613
+Create Date: 2026-10-18 14:02:41.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f9b4c6e815'
+down_revision = 'c5a8e0b7f613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    standing = op.create_table('organization_standing',
+    sa.Column('organization', sa.Text(), nullable=False),
+    sa.Column('amount_owed', sa.Float(), nullable=True),
+    sa.Column('grants_owing_money', sa.Integer(), nullable=True),
+    sa.Column('open_hearings', sa.Integer(), nullable=True),
+    sa.Column('amount_requested', sa.Float(), nullable=True),
+    sa.Column('amount_allocated', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('organization')
+    )
+
+    # Count the standing of every organization with grants (as organization_standing.py
+    # counted a grant's contribution when this migration was written)
+    grant = sa.table('grant', sa.column('organization', sa.Text), sa.column('status', sa.Text), sa.column('reimburse_uc_amount', sa.Float),
+                     sa.column('amount_requested', sa.Float), sa.column('amount_allocated', sa.Float))
+    owes_money = grant.c.status == 'owes_money'
+    query = sa.select(
+            grant.c.organization,
+            sa.func.sum(sa.case((owes_money, sa.func.coalesce(grant.c.reimburse_uc_amount, 0.0)), else_=0.0)),
+            sa.func.sum(sa.case((owes_money, 1), else_=0)),
+            sa.func.sum(sa.case((grant.c.status == 'hearing', 1), else_=0)),
+            sa.func.sum(sa.func.coalesce(grant.c.amount_requested, 0.0)),
+            sa.func.sum(sa.func.coalesce(grant.c.amount_allocated, 0.0))
+        ).where(grant.c.organization != None).group_by(grant.c.organization)
+    columns = ['organization', 'amount_owed', 'grants_owing_money', 'open_hearings', 'amount_requested', 'amount_allocated']
+    rows = [dict(zip(columns, row)) for row in op.get_bind().execute(query)]
+    if rows:
+        op.bulk_insert(standing, rows)
+
+
+def downgrade():
+    op.drop_table('organization_standing')
@@ -0,0 +1,46 @@
+"""add updated_at columns for the change feed
+
+Revision ID: e7a3c9d1f052
+Revises: d2f9b4c6e815
+Create Date: 2026-10-18 16:40:12.508731
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a3c9d1f052'
+down_revision = 'd2f9b4c6e815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_grant_updated_at'), ['updated_at'], unique=False)
+    with op.batch_alter_table('organization', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+    with op.batch_alter_table('expense', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # Existing grants last changed no earlier than when they were submitted. (Timestamps are
+    # bound as DateTimes so they are stored in the same format the change feed compares)
+    now = datetime.utcnow()
+    grant = sa.table('grant', sa.column('application_submit_time', sa.DateTime), sa.column('updated_at', sa.DateTime))
+    op.execute(grant.update().values(updated_at=sa.func.coalesce(grant.c.application_submit_time, sa.bindparam('now', now, sa.DateTime))))
+    for name in ['organization', 'expense']:
+        table = sa.table(name, sa.column('updated_at', sa.DateTime))
+        op.execute(table.update().values(updated_at=sa.bindparam('now', now, sa.DateTime)))
+
+
+def downgrade():
+    with op.batch_alter_table('expense', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+    with op.batch_alter_table('organization', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+    with op.batch_alter_table('grant', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_grant_updated_at'))
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,54 @@
+"""add full-text project search index
+
+Revision ID: f3b8d2a6c417
+Revises: e7a3c9d1f052
+Create Date: 2026-10-18 18:05:27.193640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2a6c417'
+down_revision = 'e7a3c9d1f052'
+branch_labels = None
+depends_on = None
+
+# Note: batch_alter_table recreates the grant table on SQLite, which drops these
+# triggers. Later migrations which batch alter the grant table must recreate them
+
+# The index stores no copy of the text (content='grant'), so deletes must repeat the old values
+search_index_ddl = [
+    "CREATE VIRTUAL TABLE grant_search USING fts5(project, project_description, organization, interviewer_notes, "
+        "content='grant', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    "CREATE TRIGGER grant_search_insert AFTER INSERT ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(rowid, project, project_description, organization, interviewer_notes) "
+        "VALUES (new.id, new.project, new.project_description, new.organization, new.interviewer_notes); END",
+    "CREATE TRIGGER grant_search_delete AFTER DELETE ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(grant_search, rowid, project, project_description, organization, interviewer_notes) "
+        "VALUES ('delete', old.id, old.project, old.project_description, old.organization, old.interviewer_notes); END",
+    "CREATE TRIGGER grant_search_update AFTER UPDATE OF project, project_description, organization, interviewer_notes ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(grant_search, rowid, project, project_description, organization, interviewer_notes) "
+        "VALUES ('delete', old.id, old.project, old.project_description, old.organization, old.interviewer_notes); "
+        "INSERT INTO grant_search(rowid, project, project_description, organization, interviewer_notes) "
+        "VALUES (new.id, new.project, new.project_description, new.organization, new.interviewer_notes); END",
+]
+drop_search_index_ddl = [
+    "DROP TRIGGER IF EXISTS grant_search_update",
+    "DROP TRIGGER IF EXISTS grant_search_delete",
+    "DROP TRIGGER IF EXISTS grant_search_insert",
+    "DROP TABLE IF EXISTS grant_search",
+]
+
+
+def upgrade():
+    for statement in search_index_ddl:
+        op.execute(statement)
+    # Index every existing grant
+    op.execute("INSERT INTO grant_search(grant_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    for statement in drop_search_index_ddl:
+        op.execute(statement)
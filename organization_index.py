@@ -0,0 +1,79 @@
+#
+# organization_index.py
+#
+# Contains the in-process index behind organization autocomplete.
+# Every organization name is held in memory alongside a sorted list
+# of the suffixes of the lower-cased names, so names which start with
+# or contain a query are found by binary search instead of a query.
+#
+
+import json
+from bisect import bisect_left
+from hashlib import sha1
+from threading import Lock
+from time import monotonic
+from sqlalchemy import func
+from database_models import db, Organization
+
+class OrganizationIndex(object):
+    """ Process-wide index of organization names. The index is rebuilt when an organization
+        is added, renamed or removed, by this process (see invalidate) or any other (checked
+        at most once every check_interval seconds) """
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        # (names in alphabetical order, sorted suffixes, index into names of each suffix's name)
+        self.index = None
+        self.state = None
+        self.checked = 0.0
+        # (version identifying the current names, for prefetch URLs and ETags, JSON list of every name)
+        self.prefetched = None
+        self.lock = Lock()
+
+    def refresh(self):
+        """ Rebuilds the index if the organization table has changed """
+        with self.lock:
+            now = monotonic()
+            if self.index is not None and now - self.checked < self.check_interval:
+                return
+            state = tuple(db.session.query(func.count(Organization.id), func.max(Organization.id), func.max(Organization.updated_at)).one())
+            if state != self.state:
+                names = sorted(name for (name,) in db.session.query(Organization.name) if name)
+                suffixes = sorted((name.lower()[i:], n) for n, name in enumerate(names) for i in range(len(name)))
+                self.index = (names, [suffix for suffix, n in suffixes], [n for suffix, n in suffixes])
+                self.state = state
+                payload = json.dumps(names)
+                self.prefetched = (sha1(payload.encode('utf-8')).hexdigest()[:16], payload)
+            self.checked = now
+
+    def invalidate(self):
+        """ Forces the index to be rebuilt on the next lookup """
+        with self.lock:
+            self.state = None
+            self.checked = 0.0
+
+    def search(self, query, limit=None):
+        """ Returns the names which contain the query (ignoring case), those which start
+            with it first, each group in alphabetical order """
+        self.refresh()
+        names, suffixes, owners = self.index
+        query = query.lower()
+        prefix, infix = set(), set()
+        for i in range(bisect_left(suffixes, query), len(suffixes)):
+            if not suffixes[i].startswith(query):
+                break
+            n = owners[i]
+            if n in prefix:
+                continue
+            if names[n].lower().startswith(query):
+                prefix.add(n)
+            else:
+                infix.add(n)
+        matches = sorted(prefix) + sorted(infix - prefix)
+        return [names[n] for n in matches[:limit]]
+
+    def prefetch(self):
+        """ Returns (version, JSON list of every name) """
+        self.refresh()
+        return self.prefetched
+
+organization_index = OrganizationIndex(1.0)
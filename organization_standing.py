@@ -0,0 +1,119 @@
+#
+# organization_standing.py
+#
+# Keeps the OrganizationStanding table in step with the grants.
+# Every grant contributes to its organization's totals, and saving
+# a grant applies the difference between its old and new
+# contributions, so pages can read an organization's standing
+# without scanning its grants. Receipts become overdue as time
+# passes rather than when a grant is saved, so they are counted
+# from the paid grants whenever a standing is read.
+#
+
+from datetime import datetime
+from sqlalchemy import select, func, or_
+from database_models import db, Grant, OrganizationStanding
+from grant_status import GrantStatus
+
+# Columns of OrganizationStanding which are totals over the organization's grants
+standing_totals = ['amount_owed', 'grants_owing_money', 'open_hearings', 'amount_requested', 'amount_allocated']
+
+# Grant columns which a grant's contribution depends on
+standing_columns = ['organization', 'status', 'reimburse_uc_amount', 'amount_requested', 'amount_allocated']
+
+def grant_contribution(grant):
+    """ Returns a grant's contribution to each of the standing_totals """
+    owes_money = grant.status == GrantStatus.OWES_MONEY
+    return ((grant.reimburse_uc_amount or 0.0) if owes_money else 0.0, int(owes_money), int(grant.status == GrantStatus.HEARING),
+            grant.amount_requested or 0.0, grant.amount_allocated or 0.0)
+
+def update_organization_standing(session, flush_context, instances):
+    """ Applies the change in each new, modified or deleted grant's contribution to its
+        organization's standing. Registered by application.py to run after
+        update_grant_status, so the grants' statuses are already current """
+    changed = [obj for obj in session.new | session.dirty if isinstance(obj, Grant) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Grant)]
+    if not changed and not deleted:
+        return
+    with session.no_autoflush:
+        # The database still holds the grants as they were before this flush
+        saved_ids = [grant.id for grant in changed + deleted if grant.id is not None]
+        saved = {}
+        if saved_ids:
+            columns = [Grant.id] + [getattr(Grant, column) for column in standing_columns]
+            saved = {row.id: row for row in session.execute(select(*columns).where(Grant.id.in_(saved_ids)))}
+
+        # (saved values or None, grant or None if deleted) for each grant
+        moves = [(saved.get(grant.id), grant) for grant in changed] + [(saved.get(grant.id), None) for grant in deleted]
+        names = set(old.organization for old, new in moves if old is not None) | set(new.organization for old, new in moves if new is not None)
+        names.discard(None)
+        if not names:
+            return
+        standings = {standing.organization: standing for standing in
+                     session.query(OrganizationStanding).filter(OrganizationStanding.organization.in_(names))}
+
+        # Add up the change to each organization's totals
+        deltas = {}
+        for old, new in moves:
+            for grant, sign in ((old, -1), (new, 1)):
+                if grant is None or grant.organization is None:
+                    continue
+                contribution = grant_contribution(grant)
+                delta = deltas.setdefault(grant.organization, [0] * len(standing_totals))
+                for i, value in enumerate(contribution):
+                    delta[i] += sign * value
+
+        for name, delta in deltas.items():
+            standing = standings.get(name)
+            if standing is None:
+                standing = OrganizationStanding(name)
+                for column, value in zip(standing_totals, delta):
+                    setattr(standing, column, value)
+                session.add(standing)
+            else:
+                # Increment in SQL so that concurrent saves cannot overwrite each other
+                for column, value in zip(standing_totals, delta):
+                    if value:
+                        setattr(standing, column, getattr(OrganizationStanding, column) + value)
+
+def apply_standing_deltas(session, deltas):
+    """ Adds {organization: {column: change}} to the organizations' standing. For bulk
+        UPDATEs of grants, which skip update_organization_standing """
+    standing = OrganizationStanding.__table__
+    for organization, changes in deltas.items():
+        changes = {column: change for column, change in changes.items() if change}
+        if not changes:
+            continue
+        result = session.execute(standing.update().where(standing.c.organization == organization)
+                                 .values({column: standing.c[column] + change for column, change in changes.items()}))
+        if not result.rowcount:
+            row = dict((column, 0) for column in standing_totals)
+            row.update(changes, organization=organization)
+            session.execute(standing.insert().values(row))
+
+def overdue_receipts_query(overdue_as_of):
+    """ Returns a query of each organization's number of paid grants whose receipts were
+        due before overdue_as_of, and the money paid out for them. Only paid grants can
+        have overdue receipts, so this is answered from the status index """
+    return select(Grant.organization, func.count(), func.sum(Grant.amount_dispensed)) \
+        .where(Grant.status == GrantStatus.PAID, Grant.receipts_due < overdue_as_of, Grant.amount_dispensed > 0) \
+        .group_by(Grant.organization)
+
+def add_overdue_receipts(standings):
+    """ Sets the overdue_receipts and overdue_amount of each of the OrganizationStandings
+        (any of which may be None) as of now, with a single query """
+    standings = dict((standing.organization, standing) for standing in standings if standing is not None)
+    if not standings:
+        return
+    query = overdue_receipts_query(datetime.now()).where(Grant.organization.in_(list(standings)))
+    for organization, count, amount in db.session.execute(query):
+        standings[organization].overdue_receipts = count
+        standings[organization].overdue_amount = amount
+
+def organizations_in_bad_standing():
+    """ Returns the set of names of the organizations in bad standing: those owing money,
+        with an open hearing or with overdue receipts """
+    names = set(organization for (organization,) in db.session.query(OrganizationStanding.organization).filter(
+        or_(OrganizationStanding.grants_owing_money > 0, OrganizationStanding.open_hearings > 0)))
+    names.update(organization for organization, count, amount in db.session.execute(overdue_receipts_query(datetime.now())))
+    return names
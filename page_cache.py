@@ -0,0 +1,116 @@
+#
+# page_cache.py
+#
+# Caches the rendered public grant pages. Each page is stored with
+# its grant's updated_at, which change_feed.py advances whenever the
+# grant or any of its line items change, so a page is only reused
+# while its grant is unchanged. A hit costs one indexed lookup
+# instead of loading the grant and rendering its template.
+#
+
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from flask import request, session, g
+from flask_login import current_user
+from database_models import db, Grant
+
+class PageCache(object):
+    """ Process-wide cache of rendered pages, each stored with the version it was rendered
+        at. The least recently used pages are dropped beyond max_pages. Concurrent misses
+        for the same page wait for a single render rather than each rendering it """
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        # {key: (version, page)}, least recently used first
+        self.pages = OrderedDict()
+        # {key: Lock held while the page is being rendered}
+        self.rendering = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # Misses which waited for another request's render instead of rendering
+        self.coalesced = 0
+
+    def lookup(self, key, version):
+        """ Returns the cached page if it was rendered at this version, or None. Must be
+            called holding the lock """
+        cached = self.pages.get(key)
+        if cached is None or cached[0] != version:
+            return None
+        self.pages.move_to_end(key)
+        return cached[1]
+
+    def get(self, key, version, render):
+        """ Returns the page rendered at this version, calling render() to render it if
+            it is not cached. Only rendered text is cached """
+        with self.lock:
+            page = self.lookup(key, version)
+            if page is not None:
+                self.hits += 1
+                return page
+            render_lock = self.rendering.setdefault(key, Lock())
+        with render_lock:
+            try:
+                with self.lock:
+                    page = self.lookup(key, version)
+                    if page is not None:
+                        self.coalesced += 1
+                        return page
+                    self.misses += 1
+                page = render()
+                if isinstance(page, str):
+                    with self.lock:
+                        self.pages[key] = (version, page)
+                        self.pages.move_to_end(key)
+                        while len(self.pages) > self.max_pages:
+                            self.pages.popitem(last=False)
+                return page
+            finally:
+                with self.lock:
+                    self.rendering.pop(key, None)
+
+    def clear(self):
+        """ Drops every cached page """
+        with self.lock:
+            self.pages.clear()
+
+    def prometheus(self):
+        """ Returns the cache's hit rate and size in the Prometheus text exposition format """
+        with self.lock:
+            counters = [
+                ('nova_page_cache_hits_total', 'counter', 'Grant pages served from the page cache', self.hits),
+                ('nova_page_cache_coalesced_total', 'counter', 'Grant page cache misses served by a concurrent render', self.coalesced),
+                ('nova_page_cache_misses_total', 'counter', 'Grant pages rendered on a page cache miss', self.misses),
+                ('nova_page_cache_pages', 'gauge', 'Grant pages in the page cache', len(self.pages)),
+            ]
+        lines = []
+        for name, kind, description, value in counters:
+            lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' ' + kind, name + ' ' + str(value)]
+        return '\n'.join(lines) + '\n'
+
+page_cache = PageCache(1000)
+
+def grant_version(grant_id):
+    """ Returns the grant's updated_at, or None if it does not exist. Looked up once per request """
+    versions = g.setdefault('grant_versions', {})
+    if grant_id not in versions:
+        versions[grant_id] = db.session.query(Grant.updated_at).filter_by(grant_id=grant_id.upper()).scalar()
+    return versions[grant_id]
+
+def cached_page(*args):
+    """ Decorator which serves a grant page from the page cache to visitors who are not
+        logged in. Pages are cached per grant_id and per value of each of the named
+        request args, and re-rendered whenever the grant changes """
+    def wrapper(view):
+        @wraps(view)
+        def decorated_view(grant_id):
+            # Logged in users see their own navigation, and flashed messages are shown once
+            if current_user.is_authenticated or '_flashes' in session:
+                return view(grant_id)
+            version = grant_version(grant_id)
+            if version is None:
+                return view(grant_id)
+            key = (view.__name__, grant_id, tuple(request.args.get(arg) for arg in args))
+            return page_cache.get(key, version, lambda: view(grant_id))
+        return decorated_view
+    return wrapper
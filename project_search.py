@@ -0,0 +1,72 @@
+#
+# project_search.py
+#
+# Contains the full-text index behind project search. An SQLite FTS5
+# table indexes each grant's project name, description, organization
+# and interviewer notes, and triggers on the grant table keep it in
+# step with every insert, update and delete (including bulk UPDATEs),
+# so a typeahead keystroke is an index lookup rather than a scan of
+# every grant.
+#
+
+from re import findall
+from sqlalchemy import event, text, DDL
+from database_models import db, Grant
+
+# Grant columns in the index, with the weight of a match in each when ranking
+search_columns = [('project', 10.0), ('project_description', 2.0), ('organization', 5.0), ('interviewer_notes', 1.0)]
+# Columns searched for users who are not logged in (interviewer notes are internal)
+public_search_columns = ['project', 'project_description', 'organization']
+# Matches ranked per search, newest first. Ranking costs time for every match, and the
+# first letters typed can match most of the archive, so only the newest matches are ranked
+search_rank_window = 1000
+
+def column_list(prefix=''):
+    """ Returns the indexed column names, each with the given prefix, separated by commas """
+    return ', '.join(prefix + column for column, weight in search_columns)
+
+# Statements which create the index and its triggers. The index stores no copy of the
+# text (content='grant'), so deletes must repeat the old values
+search_index_ddl = [
+    "CREATE VIRTUAL TABLE grant_search USING fts5(" + column_list() + ", content='grant', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    "CREATE TRIGGER grant_search_insert AFTER INSERT ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(rowid, " + column_list() + ") VALUES (new.id, " + column_list('new.') + "); END",
+    "CREATE TRIGGER grant_search_delete AFTER DELETE ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(grant_search, rowid, " + column_list() + ") VALUES ('delete', old.id, " + column_list('old.') + "); END",
+    "CREATE TRIGGER grant_search_update AFTER UPDATE OF " + column_list() + " ON \"grant\" BEGIN "
+        "INSERT INTO grant_search(grant_search, rowid, " + column_list() + ") VALUES ('delete', old.id, " + column_list('old.') + "); "
+        "INSERT INTO grant_search(rowid, " + column_list() + ") VALUES (new.id, " + column_list('new.') + "); END",
+]
+# Create the index alongside the grant table (migration f3b8d2a6c417 creates it for existing databases)
+for statement in search_index_ddl:
+    event.listen(Grant.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Grant.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS grant_search").execute_if(dialect='sqlite'))
+
+def match_expression(query, columns=None):
+    """ Returns the FTS5 MATCH expression finding every word of the query (the last as a
+        prefix, since it may still be being typed) in the given columns, or None if the
+        query has no words """
+    words = findall(r'\w+', query)
+    if not words:
+        return None
+    expression = ' '.join('"' + word + '"' for word in words[:-1]) + ' "' + words[-1] + '"*'
+    if columns:
+        expression = '{' + ' '.join(columns) + '}: (' + expression.strip() + ')'
+    return expression.strip()
+
+def search_projects(query, page=1, per_page=20, columns=public_search_columns):
+    """ Returns the grants (as (grant_id, organization, project) rows) whose indexed columns
+        match every word in the query, best match first, a page at a time. Only the newest
+        search_rank_window matches (or enough to fill the page) are ranked """
+    expression = match_expression(query, columns)
+    if expression is None:
+        return []
+    weights = ', '.join(str(weight) for column, weight in search_columns)
+    offset = (page - 1) * per_page
+    return db.session.execute(text(
+        "SELECT \"grant\".grant_id, \"grant\".organization, \"grant\".project FROM "
+        "(SELECT rowid, bm25(grant_search, " + weights + ") AS score FROM grant_search WHERE grant_search MATCH :expression "
+        "ORDER BY rowid DESC LIMIT :window) AS matches JOIN \"grant\" ON \"grant\".id = matches.rowid "
+        "ORDER BY matches.score, matches.rowid DESC LIMIT :limit OFFSET :offset"),
+        {'expression': expression, 'window': max(search_rank_window, offset + per_page), 'limit': per_page, 'offset': offset}).all()
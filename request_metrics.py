@@ -0,0 +1,176 @@
+#
+# request_metrics.py
+#
+# Records how long each page takes to build, and where that time
+# goes: the number of SQL statements run, time spent in the
+# database, time spent rendering templates and the size of the
+# response. Totals are kept per endpoint and served in Prometheus
+# text format. Sampled requests can also be profiled with cProfile.
+#
+
+from cProfile import Profile
+from random import random
+from threading import Lock
+from time import perf_counter, strftime
+from os import getpid, makedirs
+from os.path import join, exists
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from database_models import db
+
+# Upper bounds (in seconds) of the request duration histogram's buckets
+duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class EndpointMetrics(object):
+    """ Running totals for the requests to one endpoint with one method """
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(duration_buckets)
+        self.count = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.response_bytes = 0
+
+class RequestMetrics(object):
+    """ Collects EndpointMetrics for every request handled by an app. Sampled requests
+        (a PROFILE_SAMPLE_RATE fraction, 0 by default) are profiled with cProfile and
+        their stats written to the PROFILE_FOLDER """
+    def __init__(self, app=None):
+        self.endpoints = {}
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_FOLDER', join(app.instance_path, "profiles"))
+        self.app = app
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        before_render_template.connect(self.start_template, app)
+        template_rendered.connect(self.finish_template, app)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self.start_statement)
+            event.listen(db.engine, 'after_cursor_execute', self.finish_statement)
+
+    def start_request(self):
+        g.metrics_start = perf_counter()
+        g.sql_statements = 0
+        g.sql_selects = 0
+        g.sql_seconds = 0.0
+        g.template_seconds = 0.0
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random() < rate:
+            g.profiler = Profile()
+            try:
+                g.profiler.enable()
+            except ValueError:
+                # Another profiler is already running in this process
+                g.profiler = None
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'metrics_start' in g:
+            conn.info.setdefault('statement_start', []).append(perf_counter())
+
+    def finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'metrics_start' in g and conn.info.get('statement_start'):
+            g.sql_statements += 1
+            # (read by query_budget, which does not count writes, since on SQLite the ORM
+            # saves each changed row with its own UPDATE)
+            if statement.lstrip()[:6].upper() == 'SELECT':
+                g.sql_selects += 1
+            g.sql_seconds += perf_counter() - conn.info['statement_start'].pop()
+
+    def start_template(self, app, template, context, **extra):
+        if 'metrics_start' in g:
+            g.setdefault('template_starts', []).append(perf_counter())
+
+    def finish_template(self, app, template, context, **extra):
+        if g.get('template_starts'):
+            start = g.template_starts.pop()
+            # Templates rendered while rendering another are already timed by the outer one
+            if not g.template_starts:
+                g.template_seconds += perf_counter() - start
+
+    def finish_request(self, response):
+        """ Adds the request to its endpoint's totals """
+        if 'metrics_start' in g:
+            # Streamed responses have no length until they are sent
+            self.record(response.status_code, response.content_length or 0)
+        return response
+
+    def teardown_request(self, exception=None):
+        """ Counts requests which failed with an exception as errors, and writes the
+            stats of a sampled request """
+        if exception is not None and 'metrics_start' in g and not g.get('metrics_recorded'):
+            self.record(500, 0)
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        folder = self.app.config['PROFILE_FOLDER']
+        if not exists(folder):
+            makedirs(folder, exist_ok=True)
+        name = (request.endpoint or 'unknown') + '-' + strftime('%Y%m%d-%H%M%S') + '-' + str(getpid()) + '-' + str(id(profiler)) + '.prof'
+        profiler.dump_stats(join(folder, name))
+
+    def record(self, status, size):
+        seconds = perf_counter() - g.metrics_start
+        g.metrics_recorded = True
+        key = (request.endpoint or 'unknown', request.method)
+        with self.lock:
+            metrics = self.endpoints.get(key)
+            if metrics is None:
+                metrics = self.endpoints[key] = EndpointMetrics()
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            for i, bound in enumerate(duration_buckets):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.sql_statements += g.sql_statements
+            metrics.sql_seconds += g.sql_seconds
+            metrics.template_seconds += g.template_seconds
+            metrics.response_bytes += size
+
+    def prometheus(self):
+        """ Returns the totals in the Prometheus text exposition format """
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+            def family(name, kind, description):
+                lines.append('# HELP ' + name + ' ' + description)
+                lines.append('# TYPE ' + name + ' ' + kind)
+            def labels(endpoint, method, **extra):
+                pairs = [('endpoint', endpoint), ('method', method)] + sorted(extra.items())
+                return '{' + ','.join(key + '="' + str(value) + '"' for key, value in pairs) + '}'
+
+            family('nova_requests_total', 'counter', 'Requests handled, by response status')
+            for (endpoint, method), metrics in endpoints:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append('nova_requests_total' + labels(endpoint, method, status=status) + ' ' + str(count))
+
+            family('nova_request_duration_seconds', 'histogram', 'Time taken to handle requests')
+            for (endpoint, method), metrics in endpoints:
+                for bound, count in zip(duration_buckets, metrics.buckets):
+                    lines.append('nova_request_duration_seconds_bucket' + labels(endpoint, method, le=bound) + ' ' + str(count))
+                lines.append('nova_request_duration_seconds_bucket' + labels(endpoint, method, le='+Inf') + ' ' + str(metrics.count))
+                lines.append('nova_request_duration_seconds_sum' + labels(endpoint, method) + ' ' + repr(metrics.seconds))
+                lines.append('nova_request_duration_seconds_count' + labels(endpoint, method) + ' ' + str(metrics.count))
+
+            totals = [
+                ('nova_sql_statements_total', 'sql_statements', 'SQL statements run'),
+                ('nova_sql_seconds_total', 'sql_seconds', 'Time spent running SQL statements'),
+                ('nova_template_seconds_total', 'template_seconds', 'Time spent rendering templates'),
+                ('nova_response_bytes_total', 'response_bytes', 'Size of response bodies (streamed responses count as 0)'),
+            ]
+            for name, attribute, description in totals:
+                family(name, 'counter', description)
+                for (endpoint, method), metrics in endpoints:
+                    lines.append(name + labels(endpoint, method) + ' ' + repr(getattr(metrics, attribute)))
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()